@@ -10,3 +10,5 @@ from event_mappers import *
 from station_mappers import *
 from waveform_mappers import *
 from generic_mappers import *
+from job_mappers import *
+from distance_mappers import *
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Size-bounded least recently used cache for decoded traces and converted
+waveform payloads. Repeated downloads of the same waveform can then be
+answered without reading, decoding, and encoding the file again.
+
+The keys always contain the id, the md5 checksum, and the modification time
+of the file so modified files are never served from the cache. Entries of
+reindexed files are additionally invalidated to free the memory right away.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import collections
+import threading
+
+
+# One cache per database engine.
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache bounded by the total size of its
+    values in bytes. The size of every value has to be given when it is
+    added.
+
+    :type max_size: Integer
+    :param max_size: The maximum size of all values in bytes. 0 disables
+        the cache.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Returns the value for the given key and marks it as recently used.
+        Returns default if the key is not in the cache.
+        """
+        with self._lock:
+            try:
+                item = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, value, size):
+        """
+        Adds a value to the cache evicting the least recently used values if
+        necessary. Values bigger than the whole cache are not added.
+
+        Returns True if the value has been added.
+        """
+        if size > self.max_size:
+            return False
+        with self._lock:
+            previous = self._items.pop(key, None)
+            if previous is not None:
+                self.size -= previous[1]
+            self._items[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+        return True
+
+    def invalidate(self, predicate):
+        """
+        Removes all values whose key fulfills the given predicate.
+        """
+        with self._lock:
+            for key in [_i for _i in self._items if predicate(_i)]:
+                self.size -= self._items.pop(key)[1]
+
+    def clear(self):
+        """
+        Removes all values.
+        """
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def get_statistics(self):
+        """
+        Returns a dictionary with the size and the hit and miss counters of
+        the cache.
+        """
+        with self._lock:
+            return {
+                "max_size": self.max_size,
+                "size": self.size,
+                "count": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions}
+
+
+def get_waveform_cache(env):
+    """
+    Returns the waveform cache of the database of the given environment,
+    creating it if necessary. Its size is determined by the
+    waveform_cache_size option in MB.
+    """
+    with _caches_lock:
+        cache = _caches.get(env.db.engine, None)
+        if cache is None:
+            cache = LRUCache(env.config.getint("event_based_data",
+                "waveform_cache_size") * 1024 * 1024)
+            _caches[env.db.engine] = cache
+    return cache
+
+
+def invalidate_cached_file(env, filepath_id):
+    """
+    Removes all cached values belonging to the file with the given filepath
+    id.
+    """
+    get_waveform_cache(env).invalidate(lambda key: key[0] == filepath_id)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Event-station distance mappers.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+from seishub.core.core import Component, implements
+from seishub.core.db.util import formatResults
+from seishub.core.exceptions import InvalidParameterError, NotFoundError
+from seishub.core.packages.interfaces import IMapper
+
+import sqlalchemy
+
+from distances import get_event_locations
+from table_definitions import EventStationDistanceObject, StationObject
+from util import wildcard_filter, get_float_parameter, get_limit, \
+    set_next_cursor
+
+
+def _get_range_filters(request, column, name, maximum, periodic=False):
+    """
+    Returns the filters of the optional min_NAME and max_NAME parameters.
+    For periodic values, ranges with min_NAME bigger than max_NAME wrap
+    around, e.g. azimuths from 350 to 10 degree.
+    """
+    minimum = get_float_parameter(request, "min_" + name, 0, maximum)
+    maximum = get_float_parameter(request, "max_" + name, 0, maximum)
+    if periodic and minimum is not None and maximum is not None and \
+            minimum > maximum:
+        return [sqlalchemy.or_(column >= minimum, column <= maximum)]
+    filters = []
+    if minimum is not None:
+        filters.append(column >= minimum)
+    if maximum is not None:
+        filters.append(column <= maximum)
+    return filters
+
+
+class DistanceMapper(Component):
+    """
+    Returns the precomputed epicentral distances, azimuths, and back
+    azimuths in degree between events and stations ordered by event and
+    distance.
+
+    SEISHUB_SERVER/event_based_data/distance?event=EVENT_NAME
+
+    The list can be filtered by the network and station codes with the
+    wildcards "*" and "?" and by ranges of the distance, the azimuth and the
+    back azimuth. Azimuth ranges with a minimum bigger than their maximum
+    wrap around north. limit and after paginate the list.
+
+    SEISHUB_SERVER/event_based_data/distance?event=EVENT_NAME&\
+min_distance=30&max_distance=90&min_azimuth=340&max_azimuth=20
+
+    The distances are only read. If they have not yet been computed for
+    the current coordinates of the requested event, the stored ones are
+    returned with the x-outdated header set to "true".
+    """
+    implements(IMapper)
+
+    package_id = "event_based_data"
+    version = "0.0.0."
+    mapping_url = "/event_based_data/distance"
+
+    def process_GET(self, request):
+        """
+        Function that will be called upon receiving a GET request for the
+        aforementioned URL.
+        """
+        limit = get_limit(request)
+        after = request.args0.get("after", None)
+        if after is not None:
+            after = after.split(",", 2)
+            try:
+                after = (after[2], float(after[1]), int(after[0]))
+            except (IndexError, ValueError):
+                msg = "'after' has to be the value of the x-next-after " \
+                    "header of the previous page."
+                raise InvalidParameterError(msg)
+
+        filters = _get_range_filters(request,
+            EventStationDistanceObject.distance_in_degree, "distance", 180)
+        filters.extend(_get_range_filters(request,
+            EventStationDistanceObject.azimuth, "azimuth", 360,
+            periodic=True))
+        filters.extend(_get_range_filters(request,
+            EventStationDistanceObject.back_azimuth, "back_azimuth", 360,
+            periodic=True))
+        network = request.args0.get("network", None)
+        if network:
+            filters.append(wildcard_filter(StationObject.network, network))
+        station = request.args0.get("station", None)
+        if station:
+            filters.append(wildcard_filter(StationObject.station, station))
+
+        event = request.args0.get("event", None)
+        if event is not None:
+            filters.append(
+                EventStationDistanceObject.event_resource_id == event)
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        try:
+            if event is not None:
+                current, stored = get_event_locations(self.env, session,
+                    [event])
+                if event not in current and event not in stored:
+                    msg = "Event '%s' not found or its location is not " \
+                        "known." % event
+                    raise NotFoundError(msg)
+                # Events might have been uploaded or changed without the
+                # event mapper. They are updated by the distances job.
+                if current.get(event, None) != stored.get(event, None):
+                    request.setHeader("x-outdated", "true")
+
+            query = session.query(
+                    EventStationDistanceObject.event_resource_id,
+                    EventStationDistanceObject.station_id,
+                    StationObject.network, StationObject.station,
+                    EventStationDistanceObject.distance_in_degree,
+                    EventStationDistanceObject.azimuth,
+                    EventStationDistanceObject.back_azimuth)\
+                .join(StationObject,
+                    EventStationDistanceObject.station_id == StationObject.id)
+            for _filter in filters:
+                query = query.filter(_filter)
+            if after is not None:
+                event_column = EventStationDistanceObject.event_resource_id
+                distance_column = EventStationDistanceObject.distance_in_degree
+                query = query.filter(sqlalchemy.or_(
+                    event_column > after[0],
+                    sqlalchemy.and_(event_column == after[0],
+                        distance_column > after[1]),
+                    sqlalchemy.and_(event_column == after[0],
+                        distance_column == after[1],
+                        EventStationDistanceObject.station_id > after[2])))
+            query = query.order_by(
+                EventStationDistanceObject.event_resource_id,
+                EventStationDistanceObject.distance_in_degree,
+                EventStationDistanceObject.station_id)
+            # Get one more to know if there is another page.
+            if limit is not None:
+                query = query.limit(limit + 1)
+            rows = query.all()
+        finally:
+            session.close()
+
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            # The event name goes last as it might contain commas.
+            set_next_cursor(request, "%i,%r,%s" % (rows[-1].station_id,
+                rows[-1].distance_in_degree, rows[-1].event_resource_id))
+
+        return formatResults(request, [{
+            "event": row.event_resource_id,
+            "network": row.network,
+            "station": row.station,
+            "distance_in_degree": row.distance_in_degree,
+            "azimuth": row.azimuth,
+            "back_azimuth": row.back_azimuth} for row in rows])
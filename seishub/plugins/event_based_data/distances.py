@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Precomputed epicentral distances, azimuths, and back azimuths between all
+events and stations.
+
+The values of every pair of an event and a station with known coordinates
+are stored in the ebd_event_station_distances table so they can be filtered
+and sorted by the database. They are computed on a sphere for whole blocks
+of events and stations at once.
+
+Stations are updated in the same transaction in which they get their
+coordinates. Events are stored as XML resources and the coordinates they
+have been processed with are kept in the ebd_event_locations table. The
+location of an event is the one of its preferred origin.
+update_event_distances() compares these with the indexed coordinates and
+recomputes the distances of new and moved events. It runs whenever events
+are uploaded through the event mapper and for the "distances" maintenance
+job. Reading the distances never updates them.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import numpy as np
+from sqlalchemy import Table, sql
+from xml.etree import cElementTree
+
+from jobs import register_job_handler, update_job_progress
+from spatial import azimuth, great_circle_distance
+from table_definitions import EventLocationObject, \
+    EventStationDistanceObject, StationObject
+
+
+# Maximum number of event-station pairs computed and inserted at once.
+BATCH_SIZE = 100000
+
+# Maximum number of ids per query.
+ID_BATCH_SIZE = 500
+
+
+def compute_distances(event_latitudes, event_longitudes, station_latitudes,
+        station_longitudes):
+    """
+    Computes the epicentral distances, azimuths, and back azimuths in degree
+    of all combinations of the given events and stations.
+
+    Returns three arrays with one row per event and one column per station.
+    """
+    event_latitudes = np.asarray(event_latitudes,
+        dtype=np.float64)[:, np.newaxis]
+    event_longitudes = np.asarray(event_longitudes,
+        dtype=np.float64)[:, np.newaxis]
+    station_latitudes = np.asarray(station_latitudes,
+        dtype=np.float64)[np.newaxis, :]
+    station_longitudes = np.asarray(station_longitudes,
+        dtype=np.float64)[np.newaxis, :]
+    return (
+        great_circle_distance(event_latitudes, event_longitudes,
+            station_latitudes, station_longitudes),
+        azimuth(event_latitudes, event_longitudes, station_latitudes,
+            station_longitudes),
+        azimuth(station_latitudes, station_longitudes, event_latitudes,
+            event_longitudes))
+
+
+def _insert_distances(open_session, events, stations):
+    """
+    Computes and inserts the distances of all pairs of the given events and
+    stations. Existing rows of these pairs have to be deleted beforehand.
+
+    :param events: List of (event_resource_id, latitude, longitude) tuples.
+    :param stations: List of (station_id, latitude, longitude) tuples.
+    """
+    if not events or not stations:
+        return
+    station_ids = [_i[0] for _i in stations]
+    station_latitudes = [_i[1] for _i in stations]
+    station_longitudes = [_i[2] for _i in stations]
+    table = EventStationDistanceObject.__table__
+    step = max(1, BATCH_SIZE // len(stations))
+    for i in xrange(0, len(events), step):
+        batch = events[i:i + step]
+        distances, azimuths, back_azimuths = compute_distances(
+            [_i[1] for _i in batch], [_i[2] for _i in batch],
+            station_latitudes, station_longitudes)
+        rows = []
+        for event, event_distances, event_azimuths, event_back_azimuths in \
+                zip(batch, distances.tolist(), azimuths.tolist(),
+                    back_azimuths.tolist()):
+            rows.extend({
+                "event_resource_id": event[0],
+                "station_id": station_id,
+                "distance_in_degree": distance,
+                "azimuth": station_azimuth,
+                "back_azimuth": back_azimuth}
+                for station_id, distance, station_azimuth, back_azimuth in
+                zip(station_ids, event_distances, event_azimuths,
+                    event_back_azimuths))
+        open_session.execute(table.insert(), rows)
+
+
+def update_station_distances(open_session, stations):
+    """
+    Recomputes the distances between the given station objects and all
+    events. Expects an open SQLAlchemy session with the stations flushed and
+    does not commit it.
+    """
+    station_ids = [_i.id for _i in stations]
+    for i in xrange(0, len(station_ids), ID_BATCH_SIZE):
+        open_session.query(EventStationDistanceObject).filter(
+            EventStationDistanceObject.station_id.in_(
+                station_ids[i:i + ID_BATCH_SIZE]))\
+            .delete(synchronize_session=False)
+    stations = [(_i.id, _i.latitude, _i.longitude) for _i in stations
+        if _i.latitude is not None and _i.longitude is not None]
+    if not stations:
+        return
+    events = open_session.query(EventLocationObject.event_resource_id,
+        EventLocationObject.latitude, EventLocationObject.longitude).all()
+    _insert_distances(open_session, events, stations)
+
+
+def _get_children(element, name):
+    """
+    Returns all child elements with the given name in any namespace.
+    """
+    return [_i for _i in element if isinstance(_i.tag, basestring) and
+        _i.tag.rsplit("}", 1)[-1] == name]
+
+
+def get_preferred_origin_location(xml_data):
+    """
+    Returns the (latitude, longitude) of the preferred origin of the first
+    event in the given QuakeML document. If the preferred origin is not
+    given or has no coordinates, the first origin with coordinates is used.
+    Returns None if no origin has coordinates.
+    """
+    root = cElementTree.fromstring(xml_data)
+    events = [_j for _i in _get_children(root, "eventParameters")
+        for _j in _get_children(_i, "event")]
+    if not events:
+        return None
+    preferred = [_i.text.strip() for _i in
+        _get_children(events[0], "preferredOriginID") if _i.text]
+    origins = _get_children(events[0], "origin")
+    # Sorting is stable so the other origins keep their order.
+    origins.sort(key=lambda x: x.get("publicID") not in preferred)
+    for origin in origins:
+        try:
+            return tuple(float(_get_children(_get_children(origin, _i)[0],
+                "value")[0].text) for _i in ("latitude", "longitude"))
+        except (IndexError, TypeError, ValueError):
+            continue
+    return None
+
+
+def _get_event_location(env, event_resource_id, locations):
+    """
+    Chooses the location of an event from the given distinct coordinates of
+    its rows in the event view. The view contains all combinations of the
+    indexed values so events with several origins have several rows whose
+    order is undefined. Their location is read from the preferred origin in
+    the document.
+    """
+    if len(locations) == 1:
+        return locations.pop()
+    try:
+        resource = env.catalog.getResource("event_based_data", "event",
+            event_resource_id)
+        data = resource.document.data
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        location = get_preferred_origin_location(data)
+    except Exception, e:
+        env.log.error("Could not read the origins of event %s: %s" % (
+            event_resource_id, str(e)))
+        location = None
+    # Any deterministic choice is better than none.
+    return location if location is not None else min(locations)
+
+
+def get_event_locations(env, open_session, event_resource_ids=None):
+    """
+    Returns two dictionaries mapping the names of the given events to their
+    (latitude, longitude). The first has the currently indexed coordinates
+    of all events that have some, the second the coordinates their stored
+    distances have been computed with. If no events are given, all events
+    are returned. Does not write to the database.
+    """
+    event_view = Table("/event_based_data/event", env.db.metadata,
+        autoload=True)
+    query = sql.select([event_view.c["resource_name"],
+        event_view.c["latitude"], event_view.c["longitude"]])
+    stored = open_session.query(EventLocationObject.event_resource_id,
+        EventLocationObject.latitude, EventLocationObject.longitude)
+    if event_resource_ids is not None:
+        query = query.where(
+            event_view.c["resource_name"].in_(event_resource_ids))
+        stored = stored.filter(EventLocationObject.event_resource_id.in_(
+            event_resource_ids))
+    stored = dict((_i[0], (_i[1], _i[2])) for _i in stored)
+    # Events with multiple origins or magnitudes appear multiple times in the
+    # view.
+    locations = {}
+    for row in open_session.execute(query):
+        if row["latitude"] is None or row["longitude"] is None:
+            continue
+        locations.setdefault(row["resource_name"], set()).add(
+            (row["latitude"], row["longitude"]))
+    current = dict((_i, _get_event_location(env, _i, _j))
+        for _i, _j in locations.iteritems())
+    return current, stored
+
+
+def update_event_distances(env, event_resource_ids=None):
+    """
+    Brings the distances of the given events up to date with their indexed
+    coordinates. If no events are given, all events are checked. The
+    distances of removed events and of events without coordinates are
+    deleted.
+
+    Returns the number of events whose distances have been recomputed.
+    """
+    session = env.db.session(bind=env.db.engine)
+    try:
+        current, stored = get_event_locations(env, session,
+            event_resource_ids)
+        changed = sorted(_i for _i, location in current.iteritems()
+            if stored.get(_i, None) != location)
+        outdated = changed + [_i for _i in stored if _i not in current]
+        if not outdated:
+            return 0
+
+        for i in xrange(0, len(outdated), ID_BATCH_SIZE):
+            batch = outdated[i:i + ID_BATCH_SIZE]
+            session.query(EventStationDistanceObject).filter(
+                EventStationDistanceObject.event_resource_id.in_(batch))\
+                .delete(synchronize_session=False)
+            session.query(EventLocationObject).filter(
+                EventLocationObject.event_resource_id.in_(batch))\
+                .delete(synchronize_session=False)
+        for event_resource_id in changed:
+            latitude, longitude = current[event_resource_id]
+            session.add(EventLocationObject(
+                event_resource_id=event_resource_id, latitude=latitude,
+                longitude=longitude))
+
+        stations = [_i for _i in session.query(StationObject.id,
+            StationObject.latitude, StationObject.longitude)
+            if _i[1] is not None and _i[2] is not None]
+        _insert_distances(session, [(_i,) + current[_i] for _i in changed],
+            stations)
+        session.commit()
+    finally:
+        session.close()
+    return len(changed)
+
+
+def _run_distance_job(env, job_id):
+    """
+    Brings the distances of all events up to date.
+    """
+    count = update_event_distances(env)
+    session = env.db.session(bind=env.db.engine)
+    try:
+        update_job_progress(session, job_id, total_count=count,
+            processed_count=count)
+        session.commit()
+    finally:
+        session.close()
+
+
+register_job_handler("distances", _run_distance_job)
@@ -15,15 +15,34 @@ from seishub.core.exceptions import InvalidParameterError, NotFoundError
 from seishub.core.packages.interfaces import IMapper
 from seishub.core.processor import GET, POST, Processor
 
+import json
 import matplotlib.pyplot as plt
+from obspy import UTCDateTime
 from obspy.imaging.beachball import Beachball
 from sqlalchemy import Table, sql
 from StringIO import StringIO
 
+from distances import update_event_distances
+from util import get_bounding_box_filters, get_float_parameter, get_limit, \
+    lowercase_true_strings, set_next_cursor, wildcard_filter
+
+
+# The indexed columns of the event view the event list can be sorted by.
+EVENT_ORDER_COLUMNS = ("resource_name", "time", "latitude", "longitude",
+    "depth", "magnitude", "magnitude_type")
+
 
 class EventMapper(Component):
     """
     Event mapper.
+
+    A GET request without a postpath lists the events. They can be filtered
+    with starttime, endtime, min_magnitude, max_magnitude, min_depth,
+    max_depth, a bounding box, and magnitude_type, sorted with order_by and
+    descending, and paginated with limit and after.
+
+    SEISHUB_SERVER/event_based_data/event?min_magnitude=6&order_by=time&\
+descending=true&limit=100
     """
     implements(IMapper)
 
@@ -50,35 +69,199 @@ class EventMapper(Component):
 
     def process_POST(self, request):
         """
-        Just remap to the xml rest interface.
+        Just remap to the xml rest interface and update the distances of the
+        event to all stations afterwards.
         """
         # Otherwise, just pass to the event xml resource handler.
         proc = Processor(self.env)
         path = "/xml/event_based_data/event"
         if request.postpath:
             path += "/" + "/".join(request.postpath)
-        return proc.run(POST, path, StringIO(request.data))
+        result = proc.run(POST, path, StringIO(request.data))
+        # The name of unnamed events is not known so all events are checked.
+        if len(request.postpath) == 1:
+            update_event_distances(self.env, request.postpath)
+        else:
+            update_event_distances(self.env)
+        return result
 
     def get_event_list(self, request):
         """
         Return a formatted list of events.
+
+        All filters, the sorting, and the pagination run in the database on
+        the indexed columns of the event view. The list can be filtered by
+        the origin time with starttime and endtime, by ranges of the
+        magnitude, the depth and the coordinates, and by the magnitude type
+        with the wildcards "*" and "?". It is sorted by the column given with
+        order_by, events without a value come last.
+
+        With limit only that many events are returned. The x-next-after
+        header then contains the sort value and the name of the last event
+        which are passed as the after parameter to get the next page.
+
+        Events with several origins or magnitudes have one row per
+        combination in the event view. Rows of the same event with the same
+        sort value are never split across pages so a page might contain
+        fewer rows than requested or, if a single event has more such rows,
+        more.
         """
         # Directly access the database via an SQLView which is automatically
         # created for every resource type and filled with all indexed values.
         tab = Table("/event_based_data/event", request.env.db.metadata,
                     autoload=True)
 
+        limit = get_limit(request)
+        after = request.args0.get("after", None)
+        order_by = request.args0.get("order_by", "resource_name")
+        if order_by not in EVENT_ORDER_COLUMNS:
+            msg = "'order_by' has to be one of %s." % \
+                ", ".join(EVENT_ORDER_COLUMNS)
+            raise InvalidParameterError(msg)
+        descending = request.args0.get("descending", "false").lower() in \
+            lowercase_true_strings
+
         # Build up the query.
         query = sql.select([tab])
+        for _filter in self._get_event_filters(request, tab):
+            query = query.where(_filter)
 
-        # Execute the query.
-        result = request.env.db.query(query)
+        name = tab.c["resource_name"]
+        column = tab.c[order_by]
+        if after is not None:
+            query = query.where(self._get_after_filter(tab, column,
+                descending, self._parse_cursor(order_by, after)))
+        if column is name:
+            query = query.order_by(name.desc() if descending else name)
+        else:
+            query = query.order_by(column.is_(None),
+                column.desc() if descending else column, name)
+
+        def get_key(row):
+            if column is name:
+                return (row["resource_name"],)
+            return (row[order_by], row["resource_name"])
+
+        # Execute the query. Get one more to know if there is another page.
+        rows = request.env.db.query(query if limit is None else
+            query.limit(limit + 1)).fetchall()
+        if limit is not None and len(rows) > limit:
+            # Do not split the rows of an event with the same sort value.
+            next_key = get_key(rows[limit])
+            rows = rows[:limit]
+            while rows and get_key(rows[-1]) == next_key:
+                rows.pop()
+            if not rows:
+                rows = request.env.db.query(query.where(
+                    self._get_key_filter(tab, column, next_key))).fetchall()
+            set_next_cursor(request, self._get_cursor(order_by,
+                get_key(rows[-1])))
 
         # Use a convenience function provided by SeisHub to get a nicely
         # formatted output.
-        result = formatResults(request, result)
+        result = formatResults(request, [dict(row.items()) for row in rows])
         return result
 
+    def _get_event_filters(self, request, tab):
+        """
+        Returns the filters of the event list given with the parameters of
+        the request.
+        """
+        filters = []
+        for name in ("starttime", "endtime"):
+            value = request.args0.get(name, None)
+            if value is None:
+                continue
+            try:
+                value = UTCDateTime(value).datetime
+            except:
+                msg = "'%s' is not a valid time." % name
+                raise InvalidParameterError(msg)
+            if name == "starttime":
+                filters.append(tab.c["time"] >= value)
+            else:
+                filters.append(tab.c["time"] <= value)
+        for name in ("magnitude", "depth"):
+            minimum = get_float_parameter(request, "min_" + name)
+            if minimum is not None:
+                filters.append(tab.c[name] >= minimum)
+            maximum = get_float_parameter(request, "max_" + name)
+            if maximum is not None:
+                filters.append(tab.c[name] <= maximum)
+        filters.extend(get_bounding_box_filters(request, tab.c["latitude"],
+            tab.c["longitude"]))
+        magnitude_type = request.args0.get("magnitude_type", None)
+        if magnitude_type:
+            filters.append(wildcard_filter(tab.c["magnitude_type"],
+                magnitude_type))
+        return filters
+
+    def _get_cursor(self, order_by, key):
+        """
+        Returns the cursor of the event list pointing after the given sort
+        key. It is the plain event name if the list is sorted by the names,
+        otherwise a JSON list of the sort value and the event name.
+        """
+        if order_by == "resource_name":
+            return key[0]
+        value, name = key
+        if hasattr(value, "isoformat"):
+            value = value.isoformat()
+        return json.dumps([value, name])
+
+    def _parse_cursor(self, order_by, after):
+        """
+        Returns the sort key encoded in the given cursor.
+        """
+        if order_by == "resource_name":
+            return (after,)
+        msg = "'after' has to be the value of the x-next-after header of " \
+            "the previous page."
+        try:
+            value, name = json.loads(after)
+        except (TypeError, ValueError):
+            raise InvalidParameterError(msg)
+        if not isinstance(name, basestring):
+            raise InvalidParameterError(msg)
+        if value is None:
+            return (None, name)
+        try:
+            if order_by == "time":
+                value = UTCDateTime(value).datetime
+            elif order_by == "magnitude_type":
+                if not isinstance(value, basestring):
+                    raise TypeError
+            else:
+                value = float(value)
+        except:
+            raise InvalidParameterError(msg)
+        return (value, name)
+
+    def _get_key_filter(self, tab, column, key):
+        """
+        Returns the filter selecting all rows with the given sort key.
+        """
+        name = tab.c["resource_name"]
+        if column is name:
+            return name == key[0]
+        value = column.is_(None) if key[0] is None else column == key[0]
+        return sql.and_(value, name == key[1])
+
+    def _get_after_filter(self, tab, column, descending, key):
+        """
+        Returns the filter selecting all rows following the given sort key
+        in the event list sorted by the given column.
+        """
+        name = tab.c["resource_name"]
+        if column is name:
+            return name < key[0] if descending else name > key[0]
+        value, after = key
+        # Events without a value come last.
+        if value is None:
+            return sql.and_(column.is_(None), name > after)
+        return sql.or_(column < value if descending else column > value,
+            sql.and_(column == value, name > after), column.is_(None))
+
     def get_beachball(self, request):
         """
         Takes the resource_name of an event and returns a beachball.
@@ -8,11 +8,20 @@ from seishub.core.packages.interfaces import IMapper
 import os
 
 from table_definitions import FilepathObject
+from util import get_file_etag, set_validators, is_not_modified, \
+    respond_not_modified, send_file
 
 
 class FileDownloadMapper(Component):
     """
     Download a file with a given filepath id
+
+    The responses carry ETag and Last-Modified headers derived from the
+    stored checksum and modification time of the file. Conditional requests
+    for unchanged files are answered with 304 Not Modified.
+
+    Files are streamed in chunks. Single byte ranges can be requested with
+    the Range header, e.g. to resume interrupted downloads.
     """
     implements(IMapper)
 
@@ -30,20 +39,27 @@ class FileDownloadMapper(Component):
         query = session.query(FilepathObject)\
             .filter(FilepathObject.id == filepath_id).first()
         if not query:
+            session.close()
             msg = "File with the given id not found."
             raise NotFoundError(msg)
         filename = query.filepath
-        try:
-            with open(filename, "rb") as open_file:
-                data = open_file.read()
-        except:
+        session.close()
+
+        # The stored checksum and modification time allow answering
+        # conditional requests without opening the file.
+        etag = get_file_etag(query.md5_hash)
+        set_validators(request, etag, query.mtime)
+        if is_not_modified(request, etag, query.mtime):
+            return respond_not_modified(request)
+
+        if not os.path.isfile(filename) or not os.access(filename, os.R_OK):
             msg = "Error reading data."
             raise InternalServerError(msg)
 
         # Set the corresponding headers.
         request.setHeader("content-type", "application/octet-stream")
-        filename = os.path.basename(query.filepath).encode("utf-8")
         request.setHeader("content-disposition", "attachment; filename=%s" %
-            filename)
+            os.path.basename(filename).encode("utf-8"))
 
-        return data
+        # The file is streamed in chunks.
+        return send_file(request, filename, etag)
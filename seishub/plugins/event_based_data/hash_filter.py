@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+In-process membership filter over the md5 checksums of all files known to
+the database. It is used to answer the common "this file is definitely new"
+case of the duplicate detection without a database round trip.
+
+The filter is a Bloom filter so it can return false positives (which will
+then be checked against the database) but never false negatives. It is
+warmed once per database engine and updated whenever a file is added. Files
+added by other processes using the same database are not seen.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import math
+import threading
+
+from table_definitions import FilepathObject
+
+
+# Minimal capacity of the filters.
+MIN_CAPACITY = 1000000
+# Desired false positive rate.
+ERROR_RATE = 0.01
+
+# One filter per database engine.
+_filters = {}
+_filters_lock = threading.Lock()
+
+
+class BloomFilter(object):
+    """
+    Simple Bloom filter for md5 hex digests. The digests are already
+    uniformly distributed so the bit indices are directly derived from them
+    by double hashing.
+    """
+    def __init__(self, capacity, error_rate=ERROR_RATE):
+        self.capacity = capacity
+        self.count = 0
+        self.bit_count = int(math.ceil(-capacity * math.log(error_rate) /
+            math.log(2) ** 2))
+        self.hash_count = max(1, int(round(
+            self.bit_count / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+
+    def _indices(self, md5_hash):
+        value = int(md5_hash, 16)
+        h1 = value & 0xFFFFFFFFFFFFFFFF
+        h2 = (value >> 64) | 1
+        for i in xrange(self.hash_count):
+            yield (h1 + i * h2) % self.bit_count
+
+    def add(self, md5_hash):
+        for index in self._indices(md5_hash):
+            self.bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, md5_hash):
+        for index in self._indices(md5_hash):
+            if not self.bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+
+def _build_filter(env):
+    """
+    Builds a new filter containing all md5 checksums in the database.
+    """
+    session = env.db.session(bind=env.db.engine)
+    count = session.query(FilepathObject.id).count()
+    bloom_filter = BloomFilter(max(MIN_CAPACITY, 2 * count))
+    for md5_hash, in session.query(FilepathObject.md5_hash)\
+            .yield_per(10000):
+        bloom_filter.add(md5_hash)
+    session.close()
+    return bloom_filter
+
+
+def warm_hash_filter(env):
+    """
+    Builds the filter for the database of the given environment if it does
+    not yet exist.
+    """
+    with _filters_lock:
+        if env.db.engine not in _filters:
+            _filters[env.db.engine] = _build_filter(env)
+
+
+def might_be_known(env, md5_hash):
+    """
+    Returns False if no file with the given md5 checksum is known to the
+    database. True means that it might be known.
+    """
+    with _filters_lock:
+        bloom_filter = _filters.get(env.db.engine, None)
+        # Rebuild overfull filters to keep the false positive rate low.
+        if bloom_filter is None or \
+                bloom_filter.count > bloom_filter.capacity:
+            bloom_filter = _build_filter(env)
+            _filters[env.db.engine] = bloom_filter
+        return md5_hash in bloom_filter
+
+
+def add_known_hash(engine, md5_hash):
+    """
+    Adds the md5 checksum of a new file to the filter of the given engine.
+    Called before the file is committed which at worst causes an additional
+    false positive.
+    """
+    with _filters_lock:
+        bloom_filter = _filters.get(engine, None)
+        if bloom_filter is not None:
+            bloom_filter.add(md5_hash)
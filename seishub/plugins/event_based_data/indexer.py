@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Indexing of whole directory trees. The files are hashed and parsed in
+parallel by a pool of worker processes. The results are written to the
+database in batches, each batch in a single transaction together with the
+progress of the corresponding job.
+
+The indexed files are never touched, they are not managed by SeisHub.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import fnmatch
+import itertools
+import multiprocessing
+import os
+
+from seishub.core.exceptions import InvalidParameterError
+
+from obspy import read
+from sqlalchemy.exc import IntegrityError
+
+from hash_filter import might_be_known
+from ingest import read_station_channels
+from jobs import create_job, run_job, submit_job, register_job_handler, \
+    update_job_progress
+from table_definitions import FilepathObject
+from util import get_md5_of_file, get_file_mtime, \
+    add_filepath_to_database, get_waveform_channel_info, \
+    add_waveform_channels_to_database, add_station_channels_to_database
+
+
+# Number of files committed to the database in one transaction.
+BATCH_SIZE = 500
+
+
+def find_files(directory, pattern=None):
+    """
+    Recursively walks the given directory and yields all files. If pattern is
+    given, only files whose name matches the given glob pattern will be
+    returned.
+    """
+    for dirpath, dirnames, filenames in os.walk(directory):
+        # Walk in a deterministic order.
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if pattern and not fnmatch.fnmatch(filename, pattern):
+                continue
+            yield os.path.join(dirpath, filename)
+
+
+def read_waveform_file(filename):
+    """
+    Hashes and parses a single waveform file. Only the headers are read. Runs
+    in the worker processes and must thus not access the database.
+
+    Returns a dictionary. If the file cannot be used it will contain an
+    "error" key.
+    """
+    try:
+        # Take the modification time before hashing so later changes will
+        # be picked up by a rescan.
+        mtime = get_file_mtime(filename)
+        md5_hash, size = get_md5_of_file(filename)
+    except Exception, e:
+        return {"filename": filename,
+            "error": "Could not read the file: %s" % str(e)}
+    try:
+        st = read(filename, headonly=True)
+    except:
+        return {"filename": filename,
+            "error": ("The data does not appear to be a valid waveform file. "
+                "Only data readable by ObsPy is acceptable.")}
+    return {"filename": filename, "md5_hash": md5_hash, "size": size,
+        "mtime": mtime,
+        "channels": get_waveform_channel_info(st, filename)}
+
+
+def read_station_file(filename):
+    """
+    Hashes and parses a single station file. Runs in the worker processes
+    and must thus not access the database.
+
+    Returns a dictionary. If the file cannot be used it will contain an
+    "error" key.
+    """
+    try:
+        # Take the modification time before hashing so later changes will
+        # be picked up by a rescan.
+        mtime = get_file_mtime(filename)
+        md5_hash, size = get_md5_of_file(filename)
+    except Exception, e:
+        return {"filename": filename,
+            "error": "Could not read the file: %s" % str(e)}
+    try:
+        channels = read_station_channels(filename)
+    except Exception, e:
+        return {"filename": filename, "error": str(e)}
+    if channels is False:
+        return {"filename": filename,
+            "error": "Could not read the station information file."}
+    return {"filename": filename, "md5_hash": md5_hash, "size": size,
+        "mtime": mtime, "channels": channels}
+
+
+def _add_file_to_database(open_session, result, file_type, event_id, tag,
+        is_synthetic):
+    """
+    Adds a single parsed file to the database without committing.
+    """
+    filepath = add_filepath_to_database(open_session, result["filename"],
+        result["size"], result["md5_hash"], is_managed_by_seishub=False,
+        mtime=result["mtime"])
+    open_session.flush()
+    if file_type == "waveform":
+        add_waveform_channels_to_database(open_session, filepath,
+            result["channels"], event_id, tag, is_synthetic)
+    else:
+        add_station_channels_to_database(open_session, filepath,
+            result["channels"])
+
+
+def _write_batch(env, job_id, batch, seen_hashes, total_count, file_type,
+        event_id, tag, is_synthetic):
+    """
+    Writes a batch of parsed files to the database in a single transaction.
+    If that fails, e.g. due to a violated uniqueness constraint, every file
+    is retried in its own transaction so only the offending files fail.
+    """
+    errors = []
+    valid = []
+    for result in batch:
+        if "error" in result:
+            errors.append((result["filename"], result["error"]))
+        elif result["md5_hash"] in seen_hashes:
+            errors.append((result["filename"],
+                "This file already exists in the database."))
+        else:
+            seen_hashes.add(result["md5_hash"])
+            valid.append(result)
+
+    session = env.db.session(bind=env.db.engine)
+    # Check all checksums that might be known with a single query.
+    candidates = [_i["md5_hash"] for _i in valid
+        if might_be_known(env, _i["md5_hash"])]
+    if candidates:
+        existing = set(_i[0] for _i in session.query(FilepathObject.md5_hash)
+            .filter(FilepathObject.md5_hash.in_(candidates)))
+        for result in [_i for _i in valid if _i["md5_hash"] in existing]:
+            valid.remove(result)
+            errors.append((result["filename"],
+                "This file already exists in the database."))
+
+    try:
+        for result in valid:
+            _add_file_to_database(session, result, file_type, event_id, tag,
+                is_synthetic)
+        update_job_progress(session, job_id, total_count, len(batch),
+            len(errors), errors)
+        session.commit()
+        session.close()
+        return
+    except:
+        session.rollback()
+        session.close()
+
+    # Retry file by file.
+    for result in valid:
+        session = env.db.session(bind=env.db.engine)
+        try:
+            _add_file_to_database(session, result, file_type, event_id, tag,
+                is_synthetic)
+            session.commit()
+        except IntegrityError, e:
+            session.rollback()
+            if file_type == "waveform":
+                msg = "Tag already exists for the given channel id and event."
+            else:
+                msg = ("The information for at least one timespan is "
+                    "already existant in the database.")
+            errors.append((result["filename"], msg))
+        except Exception, e:
+            session.rollback()
+            errors.append((result["filename"], "(%s) %s" % (
+                e.__class__.__name__, e.message)))
+        session.close()
+    session = env.db.session(bind=env.db.engine)
+    update_job_progress(session, job_id, total_count, len(batch), len(errors),
+        errors)
+    session.commit()
+    session.close()
+
+
+def index_directory(env, job_id, directory, file_type, pattern=None,
+        event_id=None, tag="", is_synthetic=False, processes=None):
+    """
+    Indexes all files in the given directory tree. Progress and per-file
+    errors are recorded for the given job. Files that fail to be indexed do
+    not affect the other files. The status of the job is not changed, use
+    run_job() to run it as a job.
+
+    :type file_type: String
+    :param file_type: "waveform" or "station".
+    :param pattern: Optional glob pattern the filenames have to match.
+    :param event_id: The event the waveforms are bound to. Only for
+        waveforms.
+    :param processes: The number of worker processes. None will use the
+        number of CPUs, 1 will not start any extra processes.
+    """
+    directory = os.path.abspath(directory)
+    worker = read_waveform_file if file_type == "waveform" else \
+        read_station_file
+
+    # Files already in the database do not have to be hashed again.
+    session = env.db.session(bind=env.db.engine)
+    known_filepaths = set(_i[0] for _i in
+        session.query(FilepathObject.filepath).filter(
+            FilepathObject.filepath.like(directory + os.path.sep + "%")))
+    session.close()
+
+    # Also count the files while they are discovered. The generator might be
+    # consumed in a different thread of the pool.
+    counter = {"total": 0}
+    skipped = []
+
+    def _filenames():
+        for filename in find_files(directory, pattern):
+            counter["total"] += 1
+            if filename in known_filepaths:
+                skipped.append({"filename": filename,
+                    "error": "This file already exists in the database."})
+                continue
+            yield filename
+
+    pool = None
+    try:
+        if processes == 1:
+            results = itertools.imap(worker, _filenames())
+        else:
+            pool = multiprocessing.Pool(processes)
+            results = pool.imap_unordered(worker, _filenames(), chunksize=16)
+
+        seen_hashes = set()
+        batch = []
+        for result in results:
+            batch.append(result)
+            while skipped:
+                batch.append(skipped.pop())
+            if len(batch) >= BATCH_SIZE:
+                _write_batch(env, job_id, batch, seen_hashes,
+                    counter["total"], file_type, event_id, tag, is_synthetic)
+                batch = []
+        while skipped:
+            batch.append(skipped.pop())
+        _write_batch(env, job_id, batch, seen_hashes, counter["total"],
+            file_type, event_id, tag, is_synthetic)
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+def _run_index_directory_job(env, job_id, **kwargs):
+    """
+    Job handler indexing a directory. The number of worker processes is
+    determined by the indexing_processes option.
+    """
+    processes = env.config.getint("event_based_data", "indexing_processes")
+    index_directory(env, job_id, processes=processes or None, **kwargs)
+
+
+register_job_handler("index_directory", _run_index_directory_job)
+
+
+def start_directory_indexing(env, directory, file_type, pattern=None,
+        event_id=None, tag="", is_synthetic=False, asynchronous=False):
+    """
+    Creates a job for indexing the given directory. The job is either run
+    right away or submitted to the job queue if asynchronous is True.
+
+    Returns the id of the job.
+    """
+    directory = os.path.abspath(directory)
+    if not os.path.isdir(directory):
+        msg = "Directory '%s' cannot be found by the SeisHub server." % \
+            directory
+        raise InvalidParameterError(msg)
+    arguments = {"directory": directory, "file_type": file_type,
+        "pattern": pattern, "event_id": event_id, "tag": tag,
+        "is_synthetic": is_synthetic}
+    if asynchronous:
+        return submit_job(env, "index_directory", arguments)
+    job_id = create_job(env, "index_directory", arguments)
+    run_job(env, job_id)
+    return job_id
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Ingestion of single waveform and station files into the database. Used by
+the mappers for synchronous requests and by the job queue for asynchronous
+ones.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+from seishub.core.exceptions import DuplicateObjectError, \
+    InvalidObjectError, InternalServerError, InvalidParameterError
+
+from obspy import read
+import os
+from sqlalchemy.exc import IntegrityError
+
+from jobs import register_job_handler
+from mseed_index import MSEEDIndexError, validate_records
+from overview import submit_overview_job
+from util import check_if_hash_exists_in_db, get_md5_of_file, \
+    store_managed_file, add_filepath_to_database, \
+    get_waveform_channel_info, add_waveform_channels_to_database, \
+    add_station_channels_to_database, get_all_tags
+
+
+def read_station_channels(filename):
+    """
+    Reads the channels of a SEED, XSEED or RESP file.
+
+    Returns a list of channel dictionaries or False if the file cannot be
+    read.
+    """
+    # Avoid circular imports.
+    from station_mappers import _read_SEED, _read_RESP
+
+    with open(filename, "rb") as open_file:
+        # Attempt to read as a SEED/XSEED file.
+        channels = _read_SEED(open_file)
+        # Otherwise attempt to read as a RESP file.
+        if channels is False:
+            open_file.seek(0, 0)
+            channels = _read_RESP(open_file)
+    return channels
+
+
+def _validate_mseed_data(filename, st):
+    """
+    Decodes the data of the MiniSEED file whose headers have been read to st
+    a few records at a time. Raises if any part of it cannot be decoded.
+    """
+    try:
+        validate_records(filename)
+    except MSEEDIndexError:
+        # Not parsable by the minimal record parser. Decode one trace at a
+        # time instead.
+        for trace_id in sorted(set(_i.id for _i in st)):
+            read(filename, format="MSEED", sourcename=trace_id)
+
+
+def ingest_waveform_file(env, filename, md5_hash, filesize,
+        is_managed_by_seishub, event_id, tag, is_synthetic):
+    """
+    Validates the given waveform file and adds it to the database.
+
+    Files managed by SeisHub are expected to have been spooled next to their
+    final location. They will be moved there and removed if anything goes
+    wrong.
+
+    Returns the final filename.
+    """
+    try:
+        # Check if file exists. Raises on failure.
+        check_if_hash_exists_in_db(md5_hash, env)
+
+        msg = ("The data does not appear to be a valid waveform file. "
+               "Only data readable by ObsPy is acceptable.")
+        # Only valid waveforms files will be stored in the database. Valid is
+        # defined by being readable by ObsPy. Only the headers are needed for
+        # the database so no samples are decoded here.
+        try:
+            st = read(filename, headonly=True)
+        except:
+            raise InvalidObjectError(msg)
+        # The data of uploaded MiniSEED files is additionally decoded a few
+        # records at a time. ObsPy can only read files of the other formats
+        # as a whole, so these are only validated by their headers to never
+        # decode big uploads in full.
+        if is_managed_by_seishub and \
+                all(_i.stats._format == "MSEED" for _i in st):
+            try:
+                _validate_mseed_data(filename, st)
+            except:
+                raise InvalidObjectError(msg)
+
+        # Replace network, station and channel codes with placeholders if they
+        # do not exist. Location can be an empty string.
+        network = st[0].stats.network if st[0].stats.network else "XX"
+        station = st[0].stats.station if st[0].stats.station else "XX"
+        location = st[0].stats.location
+        channel = st[0].stats.channel if st[0].stats.channel else "XX"
+
+        # Check if the tag is valid, e.g. that it fulfulls the constraints of
+        # being unique per channel_id and event.
+        tags = get_all_tags(network, station, location, channel, event_id,
+            env)
+        if tag in tags:
+            msg = "Tag already exists for the given channel id and event."
+            raise InvalidParameterError(msg)
+    except:
+        # Remove the temporary file in case something goes wrong.
+        if is_managed_by_seishub is True:
+            os.remove(filename)
+        raise
+
+    if is_managed_by_seishub is True:
+        # Otherwise create the filename for the file, and check if it exists.
+        final_filename = os.path.join(env.config.get("event_based_data",
+            "waveform_filepath"), event_id,
+            ("{network}.{station}.{location}.{channel}-"
+            "{year}_{month}_{day}_{hour}"))
+        t = st[0].stats.starttime
+        final_filename = final_filename.format(network=network,
+            station=station, channel=channel, location=location, year=t.year,
+            month=t.month, day=t.day, hour=t.hour)
+
+        # Move the spooled data to its final place. The final filename is
+        # returned.
+        filename = store_managed_file(env, filename, final_filename,
+            env.config.get("event_based_data", "waveform_filepath"), md5_hash)
+
+    # Use only one session to be able to take advantage of transactions.
+    session = env.db.session(bind=env.db.engine)
+
+    # Wrap in try/except and rollback changes in case something fails.
+    try:
+        # Add information about the uploaded file into the database.
+        filepath = add_filepath_to_database(session, filename, filesize,
+            md5_hash, is_managed_by_seishub=is_managed_by_seishub)
+
+        # Flush to get the id of the filepath.
+        session.flush()
+
+        # Add all traces in the file.
+        add_waveform_channels_to_database(session, filepath,
+            get_waveform_channel_info(st, filename), event_id, tag,
+            is_synthetic)
+
+        # Commit only once so the file is either added completely or not at
+        # all.
+        session.commit()
+        filepath_id = filepath.id
+    except Exception, e:
+        # Rollback session.
+        session.rollback()
+        session.close()
+
+        # Remove the file if something failes..
+        if is_managed_by_seishub:
+            os.remove(filename)
+        # Concurrent uploads can violate the uniqueness constraints even if
+        # the checks above passed. Report them as conflicts.
+        if isinstance(e, IntegrityError):
+            msg = ("Tag already exists for one of the channel ids and the "
+                "event or the file has already been added. - Rolling back "
+                "all changes.")
+            raise DuplicateObjectError(msg)
+        msg = e.message + " - Rolling back all changes."
+        raise InternalServerError(msg)
+    session.close()
+
+    # The overviews for plotting of uploaded files are computed in the
+    # background. Those of indexed files are computed on the first request.
+    if is_managed_by_seishub:
+        submit_overview_job(env, [filepath_id])
+    return filename
+
+
+def ingest_station_file(env, filename, md5_hash, filesize,
+        is_managed_by_seishub):
+    """
+    Validates the given station file and adds it to the database.
+
+    Files managed by SeisHub are expected to have been spooled next to their
+    final location. They will be moved there and removed if anything goes
+    wrong.
+
+    Returns the final filename.
+    """
+    try:
+        # Check if file exists. Raises on failure.
+        check_if_hash_exists_in_db(md5_hash, env)
+
+        channels = read_station_channels(filename)
+        # Raise an Error if the file cannot be read.
+        if channels is False:
+            msg = "Could not read the station information file."
+            raise InvalidObjectError(msg)
+    except:
+        # Remove the temporary file in case something goes wrong.
+        if is_managed_by_seishub is True:
+            os.remove(filename)
+        raise
+
+    if is_managed_by_seishub is True:
+        network = channels[0]["network"]
+
+        final_filename = os.path.join(env.config.get("event_based_data",
+            "station_filepath"), network,
+            ("{network}.{station}.{location}.{channel}-"
+            "{year}_{month}"))
+        final_filename = final_filename.format(network=network,
+            station=channels[0]["station"],
+            location=channels[0]["location"],
+            channel=channels[0]["channel"],
+            year=channels[0]["start_date"].year,
+            month=channels[0]["start_date"].month)
+
+        # Move the spooled data to its final place. The final filename is
+        # returned.
+        filename = store_managed_file(env, filename, final_filename,
+            env.config.get("event_based_data", "station_filepath"), md5_hash)
+
+    # Use only one session to be able to take advantage of transactions.
+    session = env.db.session(bind=env.db.engine)
+
+    # Wrap in try/except and rollback changes in case something fails.
+    try:
+        # Add information about the uploaded file into the database.
+        filepath = add_filepath_to_database(session, filename, filesize,
+            md5_hash, is_managed_by_seishub=is_managed_by_seishub)
+        # Add all channels. The file is committed at once so it is either
+        # added completely or not at all.
+        add_station_channels_to_database(session, filepath, channels)
+        session.commit()
+    except Exception, e:
+        # Rollback session.
+        session.rollback()
+        session.close()
+
+        # Attempt to return a meaningfull error message.
+        msg = ("(%s) " % e.__class__.__name__) + e.message + \
+            " -- Rolling back all changes."
+        # It is possible that two files with different hashes contain
+        # information about exactly the same time span. In this case the
+        # uniqueness constrains of the database will complain and an
+        # integrity error will be raised. Catch it to give a meaningful error
+        # message.
+        if isinstance(e, IntegrityError):
+            msg = ("\nThe information for at least one of the following "
+                "timespans is already existant in the database:\n")
+            for channel in channels:
+                msg += "%s.%s.%s.%s - %s-%s\n" % (channel["network"],
+                    channel["station"], channel["location"],
+                    channel["channel"], str(channel["start_date"]),
+                    str(channel["end_date"]))
+            msg += ("All information contained in this file will not be "
+                "added to the database.")
+        # Remove the file if something failed.
+        if is_managed_by_seishub is True:
+            os.remove(filename)
+        env.log.error(msg)
+        if isinstance(e, IntegrityError):
+            raise DuplicateObjectError(msg)
+        raise InternalServerError(msg)
+    session.close()
+    return filename
+
+
+def _run_waveform_file_job(env, job_id, filename, md5_hash, filesize,
+        is_managed_by_seishub, event_id, tag, is_synthetic):
+    """
+    Job handler ingesting a single waveform file.
+    """
+    if md5_hash is None:
+        md5_hash, filesize = get_md5_of_file(filename)
+    ingest_waveform_file(env, filename, md5_hash, filesize,
+        is_managed_by_seishub, event_id, tag, is_synthetic)
+
+
+def _run_station_file_job(env, job_id, filename, md5_hash, filesize,
+        is_managed_by_seishub):
+    """
+    Job handler ingesting a single station file.
+    """
+    if md5_hash is None:
+        md5_hash, filesize = get_md5_of_file(filename)
+    ingest_station_file(env, filename, md5_hash, filesize,
+        is_managed_by_seishub)
+
+
+register_job_handler("waveform_file", _run_waveform_file_job)
+register_job_handler("station_file", _run_station_file_job)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Job mappers.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+from seishub.core.core import Component, implements
+from seishub.core.db.util import formatResults
+from seishub.core.exceptions import InvalidParameterError
+from seishub.core.packages.interfaces import IMapper
+
+from jobs import JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED, \
+    get_job_info, get_job_list
+from maintenance import start_maintenance_job
+from util import lowercase_true_strings
+
+
+class JobMapper(Component):
+    """
+    Reports the status of ingest and indexing jobs.
+
+    A list of all jobs, optionally filtered by their status:
+
+    SEISHUB_SERVER/event_based_data/jobs?status=running
+
+    Details of a single job including the errors of all failed files:
+
+    SEISHUB_SERVER/event_based_data/jobs?job_id=JOB_ID
+
+    Maintenance jobs are started with a POST request. The rescan job checks
+    all indexed files for modifications and reindexes the modified ones:
+
+    SEISHUB_SERVER/event_based_data/jobs?job_type=rescan
+
+    The scrub job verifies the checksums of all files and reports missing,
+    corrupted, and orphaned files:
+
+    SEISHUB_SERVER/event_based_data/jobs?job_type=scrub
+    """
+    implements(IMapper)
+
+    package_id = "event_based_data"
+    version = "0.0.0."
+    mapping_url = "/event_based_data/jobs"
+
+    def process_GET(self, request):
+        """
+        Function that will be called upon receiving a GET request for the
+        aforementioned URL.
+        """
+        job_id = request.args0.get("job_id", None)
+        if job_id is not None:
+            try:
+                job_id = int(job_id)
+            except ValueError:
+                msg = "'job_id' has to be an integer."
+                raise InvalidParameterError(msg)
+            return formatResults(request, [get_job_info(self.env, job_id)])
+
+        status = request.args0.get("status", None)
+        valid_status = (JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED)
+        if status is not None and status not in valid_status:
+            msg = "'status' has to be one of %s." % ", ".join(valid_status)
+            raise InvalidParameterError(msg)
+        return formatResults(request, get_job_list(self.env, status))
+
+    def process_POST(self, request):
+        """
+        Function that will be called upon receiving a POST request for the
+        aforementioned URL.
+        """
+        job_type = request.args0.get("job_type", None)
+        if job_type is None:
+            msg = "'job_type' has to be given."
+            raise InvalidParameterError(msg)
+
+        asynchronous = request.args0.get("async", None)
+        if isinstance(asynchronous, basestring):
+            asynchronous = asynchronous.lower() in lowercase_true_strings
+        else:
+            asynchronous = self.env.config.getbool("event_based_data",
+                "asynchronous_ingest")
+
+        job_id = start_maintenance_job(self.env, job_type, asynchronous)
+        return formatResults(request, [get_job_info(self.env, job_id)])
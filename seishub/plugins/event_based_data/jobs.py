@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Bookkeeping and execution of jobs like the ingestion of uploaded files or
+the indexing of whole directories. Every job has a row in the ebd_jobs table
+with its status and progress counters and a row in ebd_job_errors for every
+file that failed.
+
+Jobs can either be run directly with run_job() or be submitted to the
+persistent job queue which processes them with a pool of background worker
+threads. Queued jobs survive restarts of the server.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+from seishub.core.exceptions import NotFoundError
+
+import datetime
+import json
+import Queue
+import threading
+
+from table_definitions import JobObject, JobErrorObject
+
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# Maps job types to the functions actually running the jobs.
+_job_handlers = {}
+
+# One job queue per SeisHub environment.
+_job_queues = {}
+_job_queues_lock = threading.Lock()
+
+
+def register_job_handler(job_type, handler):
+    """
+    Registers the function running jobs of the given type. It will be called
+    with the environment, the job id, and the arguments of the job as
+    keyword arguments. Raising an exception marks the job as failed.
+    """
+    _job_handlers[job_type] = handler
+
+
+def create_job(env, job_type, arguments):
+    """
+    Creates a new job with the status queued.
+
+    Returns the id of the job.
+
+    :type job_type: String
+    :param job_type: The type of job.
+    :type arguments: dictionary
+    :param arguments: The arguments of the job. Must be JSON serializable.
+    """
+    session = env.db.session(bind=env.db.engine)
+    job = JobObject(job_type=job_type, status=JOB_QUEUED,
+        arguments=json.dumps(arguments), created=datetime.datetime.now(),
+        total_count=0, processed_count=0, failed_count=0)
+    session.add(job)
+    session.commit()
+    job_id = job.id
+    session.close()
+    return job_id
+
+
+def set_job_status(env, job_id, status, message=None):
+    """
+    Sets the status of a job. The start and finish times are set
+    accordingly. If a message is given, it will be stored as an error of the
+    job not bound to any file.
+    """
+    session = env.db.session(bind=env.db.engine)
+    job = session.query(JobObject).filter(JobObject.id == job_id).one()
+    job.status = status
+    if status == JOB_RUNNING:
+        job.started = datetime.datetime.now()
+    elif status in (JOB_DONE, JOB_FAILED):
+        job.finished = datetime.datetime.now()
+    if message:
+        session.add(JobErrorObject(job_id=job_id, filename=None,
+            message=message))
+    session.commit()
+    session.close()
+
+
+def update_job_progress(open_session, job_id, total_count=None,
+        processed_count=0, failed_count=0, errors=None):
+    """
+    Updates the progress counters of a job. Expects an open SQLAlchemy
+    session and does not commit it so the progress can be committed in the
+    same transaction as the actual work.
+
+    :param total_count: The new total count. Will not be changed if None.
+    :param processed_count: Number of newly processed files.
+    :param failed_count: Number of newly failed files.
+    :param errors: List of (filename, message) tuples.
+    """
+    job = open_session.query(JobObject).filter(JobObject.id == job_id).one()
+    if total_count is not None:
+        job.total_count = total_count
+    job.processed_count += processed_count
+    job.failed_count += failed_count
+    for filename, message in errors or []:
+        open_session.add(JobErrorObject(job_id=job_id, filename=filename,
+            message=message))
+
+
+def get_job_info(env, job_id):
+    """
+    Returns a dictionary with all information about the job including all
+    errors. Raises a NotFoundError if the job does not exist.
+    """
+    session = env.db.session(bind=env.db.engine)
+    job = session.query(JobObject).filter(JobObject.id == job_id).first()
+    if job is None:
+        session.close()
+        msg = "Job %s could not be found." % str(job_id)
+        raise NotFoundError(msg)
+    result = {
+        "job_id": job.id,
+        "job_type": job.job_type,
+        "status": job.status,
+        "arguments": json.loads(job.arguments),
+        "created": job.created.isoformat(),
+        "started": job.started.isoformat() if job.started else None,
+        "finished": job.finished.isoformat() if job.finished else None,
+        "total_count": job.total_count,
+        "processed_count": job.processed_count,
+        "failed_count": job.failed_count,
+        "errors": [{"filename": _i.filename, "message": _i.message}
+            for _i in job.errors]}
+    session.close()
+    return result
+
+
+def get_job_list(env, status=None):
+    """
+    Returns a list of dictionaries describing all jobs, optionally only the
+    ones with the given status. The errors are not included.
+    """
+    session = env.db.session(bind=env.db.engine)
+    query = session.query(JobObject).order_by(JobObject.id)
+    if status:
+        query = query.filter(JobObject.status == status)
+    result = [{
+        "job_id": job.id,
+        "job_type": job.job_type,
+        "status": job.status,
+        "created": job.created.isoformat(),
+        "started": job.started.isoformat() if job.started else None,
+        "finished": job.finished.isoformat() if job.finished else None,
+        "total_count": job.total_count,
+        "processed_count": job.processed_count,
+        "failed_count": job.failed_count} for job in query]
+    session.close()
+    return result
+
+
+def run_job(env, job_id):
+    """
+    Runs the given job in the current thread. The job is only run if it is
+    still queued which makes it safe to call this from several workers.
+
+    Returns True if the job has been run, False otherwise.
+    """
+    # Atomically claim the job.
+    session = env.db.session(bind=env.db.engine)
+    claimed = session.query(JobObject)\
+        .filter(JobObject.id == job_id)\
+        .filter(JobObject.status == JOB_QUEUED)\
+        .update({"status": JOB_RUNNING,
+            "started": datetime.datetime.now()},
+            synchronize_session=False)
+    session.commit()
+    job = session.query(JobObject).filter(JobObject.id == job_id).one()
+    job_type = job.job_type
+    arguments = json.loads(job.arguments)
+    session.close()
+    if not claimed:
+        return False
+
+    try:
+        handler = _job_handlers[job_type]
+    except KeyError:
+        set_job_status(env, job_id, JOB_FAILED,
+            "Unknown job type '%s'." % job_type)
+        return True
+
+    try:
+        handler(env, job_id, **dict((str(key), value)
+            for key, value in arguments.iteritems()))
+    except Exception, e:
+        msg = "(%s) %s" % (e.__class__.__name__, e.message)
+        session = env.db.session(bind=env.db.engine)
+        update_job_progress(session, job_id, failed_count=1,
+            errors=[(arguments.get("filename", None), msg)])
+        session.commit()
+        session.close()
+        set_job_status(env, job_id, JOB_FAILED)
+        env.log.error("Job %i failed: %s" % (job_id, msg))
+        return True
+    set_job_status(env, job_id, JOB_DONE)
+    return True
+
+
+class JobQueue(object):
+    """
+    Processes queued jobs with a number of background worker threads.
+    """
+    def __init__(self, env, worker_count):
+        self.env = env
+        self.worker_count = worker_count
+        self._queue = Queue.Queue()
+        self._threads = []
+        for _ in xrange(worker_count):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, job_id):
+        """
+        Adds an already created job to the queue.
+        """
+        self._queue.put(job_id)
+
+    def _work(self):
+        while True:
+            job_id = self._queue.get()
+            try:
+                run_job(self.env, job_id)
+            except Exception, e:
+                self.env.log.error("Job %i could not be run: %s" % (job_id,
+                    str(e)))
+            self._queue.task_done()
+
+
+def get_job_queue(env):
+    """
+    Returns the job queue of the given environment, creating it if
+    necessary. The number of workers is determined by the ingest_workers
+    option.
+    """
+    with _job_queues_lock:
+        queue = _job_queues.get(id(env), None)
+        if queue is None:
+            queue = JobQueue(env, env.config.getint("event_based_data",
+                "ingest_workers"))
+            _job_queues[id(env)] = queue
+    return queue
+
+
+def submit_job(env, job_type, arguments):
+    """
+    Creates a new job and hands it to the job queue.
+
+    Returns the id of the job.
+    """
+    job_id = create_job(env, job_type, arguments)
+    get_job_queue(env).put(job_id)
+    return job_id
+
+
+def recover_jobs(env):
+    """
+    Hands all jobs left in the database from a previous run to the job
+    queue. Jobs that were running when the server stopped are queued again
+    and run from the start. Their progress and errors are therefore reset.
+    """
+    session = env.db.session(bind=env.db.engine)
+    running = [_i[0] for _i in session.query(JobObject.id)
+        .filter(JobObject.status == JOB_RUNNING)]
+    if running:
+        session.query(JobErrorObject)\
+            .filter(JobErrorObject.job_id.in_(running))\
+            .delete(synchronize_session=False)
+        session.query(JobObject)\
+            .filter(JobObject.id.in_(running))\
+            .update({"status": JOB_QUEUED, "started": None,
+                "total_count": 0, "processed_count": 0, "failed_count": 0},
+                synchronize_session=False)
+    session.commit()
+    job_ids = [_i[0] for _i in session.query(JobObject.id)
+        .filter(JobObject.status == JOB_QUEUED).order_by(JobObject.id)]
+    session.close()
+    if not job_ids:
+        return
+    queue = get_job_queue(env)
+    for job_id in job_ids:
+        queue.put(job_id)
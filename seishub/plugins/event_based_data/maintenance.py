@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Maintenance jobs keeping the database in sync with the files on disk.
+
+The rescan job checks all files not managed by SeisHub for modifications.
+Only files whose size or modification time changed are hashed again and only
+files whose checksum changed are parsed and reindexed. The files are checked
+in parallel by a pool of threads sharing a common I/O rate limit.
+
+The scrub job verifies the checksums of all files in the same way and
+reports missing and corrupted files as well as orphaned files, i.e. files in
+the data directories of SeisHub that are not known to the database.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import datetime
+import os
+from multiprocessing.pool import ThreadPool
+
+from seishub.core.exceptions import InvalidParameterError
+
+from obspy import read
+from sqlalchemy import not_
+from sqlalchemy.exc import IntegrityError
+
+from cache import invalidate_cached_file
+from hash_filter import add_known_hash
+from indexer import find_files
+from ingest import read_station_channels
+from overview import get_overview_directory
+from jobs import create_job, run_job, submit_job, register_job_handler, \
+    update_job_progress
+from table_definitions import ChannelMetadataObject, FilepathObject, \
+    WaveformChannelObject
+from util import IOThrottle, get_md5_of_file, get_waveform_channel_info, \
+    add_waveform_channels_to_database, add_station_channels_to_database
+
+
+# Number of files processed per database transaction.
+BATCH_SIZE = 500
+
+
+def _iter_filepaths(env, *filters):
+    """
+    Yields batches of (id, filepath, size, mtime, md5_hash) tuples of all
+    filepaths fulfilling the given filters ordered by their id. Every batch
+    is retrieved with a separate query so no cursor is kept open while the
+    files are processed.
+    """
+    last_id = 0
+    while True:
+        session = env.db.session(bind=env.db.engine)
+        query = session.query(FilepathObject.id, FilepathObject.filepath,
+            FilepathObject.size, FilepathObject.mtime,
+            FilepathObject.md5_hash).filter(FilepathObject.id > last_id)
+        for _filter in filters:
+            query = query.filter(_filter)
+        rows = query.order_by(FilepathObject.id).limit(BATCH_SIZE).all()
+        session.close()
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def _get_throttle(env):
+    """
+    Returns an IOThrottle for the maintenance_io_limit option.
+    """
+    return IOThrottle(env.config.getint("event_based_data",
+        "maintenance_io_limit") * 1024 * 1024)
+
+
+def _mtime_changed(old_mtime, new_mtime):
+    """
+    Compares two modification times. Some databases do not store fractional
+    seconds so only whole seconds are compared.
+    """
+    return old_mtime.replace(microsecond=0) != \
+        new_mtime.replace(microsecond=0)
+
+
+def _rescan_file(arguments):
+    """
+    Checks a single file for modifications. Runs in the worker threads and
+    must thus not access the database.
+
+    Returns a dictionary with a "status" key being one of "unchanged",
+    "touched" (only the size or modification time changed), "modified", or
+    "error". Modified files will also contain the new channels.
+    """
+    (filepath_id, filename, size, mtime, md5_hash), file_type, throttle = \
+        arguments
+    result = {"id": filepath_id, "filename": filename,
+        "file_type": file_type}
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        result.update({"status": "error",
+            "error": "The file does not exist anymore."})
+        return result
+    new_mtime = datetime.datetime.fromtimestamp(stat.st_mtime)
+    if stat.st_size == size and not _mtime_changed(mtime, new_mtime):
+        result["status"] = "unchanged"
+        return result
+
+    result["mtime"] = new_mtime
+    try:
+        result["md5_hash"], result["size"] = get_md5_of_file(filename,
+            throttle=throttle)
+    except Exception, e:
+        result.update({"status": "error",
+            "error": "Could not read the file: %s" % str(e)})
+        return result
+    if result["md5_hash"] == md5_hash:
+        result["status"] = "touched"
+        return result
+
+    msg = "The file has been modified and can no longer be read."
+    try:
+        if file_type == "waveform":
+            channels = get_waveform_channel_info(read(filename,
+                headonly=True), filename)
+        else:
+            channels = read_station_channels(filename)
+    except:
+        channels = False
+    if not channels:
+        result.update({"status": "error", "error": msg})
+        return result
+    result.update({"status": "modified", "channels": channels})
+    return result
+
+
+def _reindex_file(open_session, result):
+    """
+    Replaces the database entries of a modified file without committing.
+    Waveforms keep the event, tag and synthetic flag they were indexed with.
+    """
+    filepath = open_session.query(FilepathObject)\
+        .filter(FilepathObject.id == result["id"]).one()
+    if result["file_type"] == "waveform":
+        previous = open_session.query(WaveformChannelObject)\
+            .filter(WaveformChannelObject.filepath_id == result["id"]).first()
+        event_id = previous.event_resource_id
+        tag = previous.tag
+        is_synthetic = previous.is_synthetic
+        open_session.query(WaveformChannelObject)\
+            .filter(WaveformChannelObject.filepath_id == result["id"])\
+            .delete(synchronize_session=False)
+        add_waveform_channels_to_database(open_session, filepath,
+            result["channels"], event_id, tag, is_synthetic)
+    else:
+        open_session.query(ChannelMetadataObject)\
+            .filter(ChannelMetadataObject.filepath_id == result["id"])\
+            .delete(synchronize_session=False)
+        add_station_channels_to_database(open_session, filepath,
+            result["channels"])
+    filepath.md5_hash = result["md5_hash"]
+    filepath.size = result["size"]
+    filepath.mtime = result["mtime"]
+
+
+def _write_rescan_results(env, job_id, results, total_count):
+    """
+    Writes the results of the rescan of a batch of files to the database.
+    Every modified file is reindexed in its own transaction so a file that
+    can no longer be indexed does not affect the others.
+    """
+    errors = []
+    session = env.db.session(bind=env.db.engine)
+    for result in results:
+        if result["status"] == "error":
+            errors.append((result["filename"], result["error"]))
+        elif result["status"] == "touched":
+            session.query(FilepathObject)\
+                .filter(FilepathObject.id == result["id"])\
+                .update({"size": result["size"], "mtime": result["mtime"]},
+                    synchronize_session=False)
+            invalidate_cached_file(env, result["id"])
+    update_job_progress(session, job_id, total_count, len(results),
+        len(errors), errors)
+    session.commit()
+    session.close()
+
+    for result in results:
+        if result["status"] != "modified":
+            continue
+        session = env.db.session(bind=env.db.engine)
+        try:
+            _reindex_file(session, result)
+            session.commit()
+            add_known_hash(env.db.engine, result["md5_hash"])
+            invalidate_cached_file(env, result["id"])
+            env.log.info("Reindexed modified file '%s'." % result["filename"])
+            error = None
+        except IntegrityError:
+            session.rollback()
+            error = ("The modified file conflicts with data already in the "
+                "database. The old information has been kept.")
+        except Exception, e:
+            session.rollback()
+            error = "(%s) %s" % (e.__class__.__name__, e.message)
+        if error:
+            update_job_progress(session, job_id, failed_count=1,
+                errors=[(result["filename"], error)])
+            session.commit()
+        session.close()
+
+
+def rescan_unmanaged_files(env, job_id, threads=4):
+    """
+    Checks all files not managed by SeisHub for modifications and reindexes
+    the modified ones. Progress and per-file errors are recorded for the
+    given job. Files that disappeared are reported but stay in the database.
+
+    :param threads: The number of threads checking the files in parallel.
+    """
+    session = env.db.session(bind=env.db.engine)
+    total_count = session.query(FilepathObject.id)\
+        .filter(not_(FilepathObject.is_managed_by_seishub)).count()
+    session.close()
+
+    throttle = _get_throttle(env)
+    pool = ThreadPool(max(1, threads))
+    try:
+        for rows in _iter_filepaths(env,
+                not_(FilepathObject.is_managed_by_seishub)):
+            # Waveform files have waveform channels, everything else is a
+            # station file.
+            session = env.db.session(bind=env.db.engine)
+            waveform_ids = set(_i[0] for _i in
+                session.query(WaveformChannelObject.filepath_id)
+                .filter(WaveformChannelObject.filepath_id.in_(
+                    [_i[0] for _i in rows])))
+            session.close()
+            arguments = [(row, "waveform" if row[0] in waveform_ids
+                else "station", throttle) for row in rows]
+            results = pool.map(_rescan_file, arguments)
+            _write_rescan_results(env, job_id, results, total_count)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _run_rescan_job(env, job_id):
+    """
+    Job handler rescanning all unmanaged files. The number of threads is
+    determined by the maintenance_threads option.
+    """
+    rescan_unmanaged_files(env, job_id, threads=env.config.getint(
+        "event_based_data", "maintenance_threads"))
+
+
+register_job_handler("rescan", _run_rescan_job)
+
+
+def _verify_file(arguments):
+    """
+    Verifies the checksum of a single file. Runs in the worker threads and
+    must thus not access the database.
+
+    Returns the filepath id, the filename, and an error message or None if
+    the file is intact.
+    """
+    (filepath_id, filename, size, mtime, md5_hash), throttle = arguments
+    if not os.path.isfile(filename):
+        return filepath_id, filename, "The file does not exist anymore."
+    try:
+        new_hash, new_size = get_md5_of_file(filename, throttle=throttle)
+    except Exception, e:
+        return filepath_id, filename, "Could not read the file: %s" % str(e)
+    if new_hash != md5_hash:
+        return filepath_id, filename, ("The file is corrupted. Its checksum "
+            "does not match the one in the database.")
+    return filepath_id, filename, None
+
+
+def _find_orphaned_files(env, directory):
+    """
+    Yields all files in the given directory tree that are not known to the
+    database. Files still being uploaded and overviews are skipped.
+    """
+    overview_directory = get_overview_directory(env) + os.path.sep
+
+    def _check(filenames):
+        session = env.db.session(bind=env.db.engine)
+        known = set(_i[0] for _i in session.query(FilepathObject.filepath)
+            .filter(FilepathObject.filepath.in_(filenames)))
+        session.close()
+        return [_i for _i in filenames if _i not in known]
+
+    batch = []
+    for filename in find_files(os.path.abspath(directory)):
+        if os.path.basename(filename).startswith(".upload-") or \
+                filename.startswith(overview_directory):
+            continue
+        batch.append(filename)
+        if len(batch) >= BATCH_SIZE:
+            for orphan in _check(batch):
+                yield orphan
+            batch = []
+    if batch:
+        for orphan in _check(batch):
+            yield orphan
+
+
+def scrub_files(env, job_id, threads=4):
+    """
+    Verifies the checksums of all files known to the database and records
+    the time of the last successful verification of every file. Missing,
+    corrupted, and orphaned files are recorded as errors of the given job.
+    Nothing is changed on disk.
+
+    :param threads: The number of threads reading the files in parallel.
+    """
+    session = env.db.session(bind=env.db.engine)
+    total_count = session.query(FilepathObject.id).count()
+    session.close()
+
+    throttle = _get_throttle(env)
+    pool = ThreadPool(max(1, threads))
+    try:
+        for rows in _iter_filepaths(env):
+            results = pool.map(_verify_file,
+                [(row, throttle) for row in rows])
+            now = datetime.datetime.now()
+            verified = [_i[0] for _i in results if _i[2] is None]
+            errors = [(_i[1], _i[2]) for _i in results if _i[2] is not None]
+            session = env.db.session(bind=env.db.engine)
+            if verified:
+                session.query(FilepathObject)\
+                    .filter(FilepathObject.id.in_(verified))\
+                    .update({"last_verified": now},
+                        synchronize_session=False)
+            update_job_progress(session, job_id, total_count, len(results),
+                len(errors), errors)
+            session.commit()
+            session.close()
+    finally:
+        pool.close()
+        pool.join()
+
+    def _report_orphans(orphans):
+        msg = "The file is not known to the database."
+        session = env.db.session(bind=env.db.engine)
+        update_job_progress(session, job_id, total_count, len(orphans),
+            len(orphans), [(_i, msg) for _i in orphans])
+        session.commit()
+        session.close()
+
+    orphans = []
+    directories = set(os.path.abspath(env.config.get("event_based_data",
+        _i)) for _i in ("waveform_filepath", "station_filepath"))
+    for directory in sorted(directories):
+        if not os.path.isdir(directory):
+            continue
+        for orphan in _find_orphaned_files(env, directory):
+            orphans.append(orphan)
+            total_count += 1
+            if len(orphans) >= BATCH_SIZE:
+                _report_orphans(orphans)
+                orphans = []
+    if orphans:
+        _report_orphans(orphans)
+
+
+def _run_scrub_job(env, job_id):
+    """
+    Job handler scrubbing all files. The number of threads is determined by
+    the maintenance_threads option.
+    """
+    scrub_files(env, job_id, threads=env.config.getint("event_based_data",
+        "maintenance_threads"))
+
+
+register_job_handler("scrub", _run_scrub_job)
+
+# All maintenance jobs that can be started without further arguments.
+MAINTENANCE_JOBS = ("rescan", "scrub", "overviews", "distances")
+
+
+def start_maintenance_job(env, job_type, asynchronous=False):
+    """
+    Creates a maintenance job of the given type. The job is either run right
+    away or submitted to the job queue if asynchronous is True.
+
+    Returns the id of the job.
+    """
+    if job_type not in MAINTENANCE_JOBS:
+        msg = "'job_type' has to be one of %s." % ", ".join(MAINTENANCE_JOBS)
+        raise InvalidParameterError(msg)
+    if asynchronous:
+        return submit_job(env, job_type, {})
+    job_id = create_job(env, job_type, {})
+    run_job(env, job_id)
+    return job_id
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Minimal parser for the headers of MiniSEED records. It is used to determine
+the byte ranges of the traces in MiniSEED files so single traces can later
+be read without decoding the whole file.
+
+Only the fixed section of the data header and the blockettes 100 and 1000
+are parsed. Files that cannot be parsed, e.g. because they have records
+without a blockette 1000, are simply not indexed by byte range.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import bisect
+from cStringIO import StringIO
+import os
+import struct
+
+from obspy import read, UTCDateTime
+
+
+# Length of the fixed section of the data header.
+FIXED_HEADER_LENGTH = 48
+
+# Maximum size in bytes of the consecutive records decoded at once when
+# validating files.
+VALIDATION_CHUNK_BYTES = 1024 * 1024
+
+
+class MSEEDIndexError(Exception):
+    """
+    Raised if a file cannot be parsed.
+    """
+    pass
+
+
+def _get_byte_order(header):
+    """
+    Guesses the byte order of a record from the plausibility of its start
+    year and day of year.
+    """
+    for byte_order in (">", "<"):
+        year, day = struct.unpack(byte_order + "HH", header[20:24])
+        if 1900 <= year <= 2100 and 1 <= day <= 366:
+            return byte_order
+    raise MSEEDIndexError("Could not determine the byte order.")
+
+
+def _get_sampling_rate(factor, multiplier):
+    """
+    Calculates the sampling rate from the sample rate factor and multiplier
+    of a record according to the SEED manual.
+    """
+    if factor == 0 or multiplier == 0:
+        return 0.0
+    if factor > 0 and multiplier > 0:
+        return float(factor * multiplier)
+    elif factor > 0 and multiplier < 0:
+        return -float(factor) / multiplier
+    elif factor < 0 and multiplier > 0:
+        return -float(multiplier) / factor
+    return 1.0 / (factor * multiplier)
+
+
+def parse_record_header(open_file, offset):
+    """
+    Parses the header of the record starting at the given offset.
+
+    Returns a dictionary or None if the end of the file has been reached.
+    """
+    open_file.seek(offset, 0)
+    header = open_file.read(FIXED_HEADER_LENGTH)
+    if not header:
+        return None
+    if len(header) < FIXED_HEADER_LENGTH:
+        raise MSEEDIndexError("Truncated record at byte %i." % offset)
+    byte_order = _get_byte_order(header)
+
+    (year, day, hour, minute, second, _, fraction, npts, factor, multiplier,
+        activity_flags, _, _, _, time_correction, _, first_blockette) = \
+        struct.unpack(byte_order + "HHBBBBHHhhBBBBiHH", header[20:48])
+
+    # Walk the blockettes to find the record length and the actual sampling
+    # rate.
+    record_length = None
+    sampling_rate = _get_sampling_rate(factor, multiplier)
+    blockette_offset = first_blockette
+    visited = set()
+    while blockette_offset and blockette_offset not in visited:
+        visited.add(blockette_offset)
+        open_file.seek(offset + blockette_offset, 0)
+        blockette = open_file.read(8)
+        if len(blockette) < 8:
+            break
+        blockette_type, next_blockette = struct.unpack(byte_order + "HH",
+            blockette[:4])
+        if blockette_type == 1000:
+            record_length = 2 ** struct.unpack("B", blockette[6])[0]
+        elif blockette_type == 100:
+            sampling_rate = float(struct.unpack(byte_order + "f",
+                blockette[4:8])[0])
+        blockette_offset = next_blockette
+    if record_length is None:
+        raise MSEEDIndexError("No blockette 1000 in record at byte %i." %
+            offset)
+
+    starttime = UTCDateTime(year=year, julday=day, hour=hour, minute=minute,
+        second=min(second, 59)) + (second - min(second, 59)) + \
+        fraction * 1E-4
+    # Apply the time correction if it has not yet been applied.
+    if not activity_flags & 0x02:
+        starttime += time_correction * 1E-4
+
+    return {
+        "offset": offset,
+        "length": record_length,
+        "network": header[18:20].strip(),
+        "station": header[8:13].strip(),
+        "location": header[13:15].strip(),
+        "channel": header[15:18].strip(),
+        "starttime": starttime,
+        "npts": npts,
+        "sampling_rate": sampling_rate}
+
+
+def iter_record_headers(open_file, offset=0, length=None):
+    """
+    Yields the parsed headers of all records in the given file, optionally
+    only of the records in the given byte range.
+    """
+    end = offset + length if length is not None else None
+    while end is None or offset < end:
+        record = parse_record_header(open_file, offset)
+        if record is None:
+            return
+        yield record
+        offset += record["length"]
+
+
+def get_trace_byte_ranges(filename, st):
+    """
+    Determines the byte range of every trace of the given Stream object
+    which has been read from the given MiniSEED file.
+
+    Returns a list with one (offset, length) tuple per trace. It will be None
+    for traces whose records are not stored contiguously or cannot be
+    determined unambiguously.
+    """
+    try:
+        with open(filename, "rb") as open_file:
+            records = list(iter_record_headers(open_file))
+    except (MSEEDIndexError, IOError, struct.error):
+        return [None] * len(st)
+
+    # Group the position of the records in the file per channel sorted by
+    # their start times.
+    channels = {}
+    for position, record in enumerate(records):
+        key = (record["network"], record["station"], record["location"],
+            record["channel"])
+        channels.setdefault(key, []).append(
+            (float(record["starttime"]), position))
+    for value in channels.itervalues():
+        value.sort()
+
+    byte_ranges = []
+    for tr in st:
+        key = (tr.stats.network, tr.stats.station, tr.stats.location,
+            tr.stats.channel)
+        candidates = channels.get(key, [])
+        tolerance = 0.5 * tr.stats.delta if tr.stats.sampling_rate else 0.0
+        first = bisect.bisect_left(candidates,
+            (float(tr.stats.starttime) - tolerance, -1))
+        last = bisect.bisect_right(candidates,
+            (float(tr.stats.endtime) + tolerance, len(records)))
+        positions = sorted(_i[1] for _i in candidates[first:last])
+        # The records must directly follow each other and contain exactly
+        # the samples of the trace.
+        if not positions or \
+                positions[-1] - positions[0] + 1 != len(positions) or \
+                sum(records[_i]["npts"] for _i in positions) != \
+                tr.stats.npts:
+            byte_ranges.append(None)
+            continue
+        start = records[positions[0]]["offset"]
+        end = records[positions[-1]]["offset"] + \
+            records[positions[-1]]["length"]
+        byte_ranges.append((start, end - start))
+    return byte_ranges
+
+
+def get_overlapping_byte_range(filename, offset, length, starttime=None,
+        endtime=None):
+    """
+    Determines the byte range of the records in the given byte range of a
+    MiniSEED file that overlap the given time window. Only the headers of the
+    records are read.
+
+    Returns an (offset, length) tuple or None if no record overlaps.
+    """
+    first = None
+    last = None
+    with open(filename, "rb") as open_file:
+        for record in iter_record_headers(open_file, offset, length):
+            record_start = record["starttime"]
+            record_end = record_start
+            if record["sampling_rate"] and record["npts"]:
+                record_end += (record["npts"] - 1) / record["sampling_rate"]
+            if (endtime is not None and record_start > endtime) or \
+                    (starttime is not None and record_end < starttime):
+                continue
+            if first is None:
+                first = record
+            last = record
+    if first is None:
+        return None
+    return first["offset"], last["offset"] + last["length"] - \
+        first["offset"]
+
+
+def read_byte_range(filename, offset, length):
+    """
+    Reads only the given byte range of a MiniSEED file.
+
+    Returns an ObsPy Stream object.
+    """
+    with open(filename, "rb") as open_file:
+        open_file.seek(offset, 0)
+        data = open_file.read(length)
+    return read(StringIO(data), format="MSEED")
+
+
+def validate_records(filename, chunk_bytes=VALIDATION_CHUNK_BYTES):
+    """
+    Makes sure the data of all records of a MiniSEED file can be decoded.
+    The records are decoded in chunks of consecutive records of about
+    chunk_bytes so the memory needed does not depend on the size of the
+    file.
+
+    Raises an MSEEDIndexError if the records cannot be parsed and any
+    exception raised by ObsPy if they cannot be decoded.
+    """
+    with open(filename, "rb") as open_file:
+        size = os.fstat(open_file.fileno()).st_size
+        start = 0
+        end = 0
+        for record in iter_record_headers(open_file):
+            end = record["offset"] + record["length"]
+            if end > size:
+                raise MSEEDIndexError("Truncated record at byte %i." %
+                    record["offset"])
+            if end - start >= chunk_bytes:
+                read_byte_range(filename, start, end - start)
+                start = end
+    if end > start:
+        read_byte_range(filename, start, end - start)
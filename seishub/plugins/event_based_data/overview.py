@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Min/max overviews of waveforms for plotting. Every trace is reduced to a
+pyramid of envelopes at power-of-two decimation levels: level n has the
+minimum and the maximum of every 2 ** n consecutive samples. A plot of any
+time window then only needs the coarsest level that still has at least one
+bin per pixel, independent of the length of the trace.
+
+The overviews of uploaded waveforms are computed by background jobs. Those
+of indexed files are computed when they are first requested. All are stored
+as npz files in the overview directory. They are
+named after the checksum of the waveform file so overviews of modified files
+are never used.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import json
+import numpy as np
+import os
+import tempfile
+
+from sqlalchemy.orm import joinedload, joinedload_all
+
+from jobs import register_job_handler, submit_job, update_job_progress
+from table_definitions import WaveformChannelObject
+
+
+# The finest level that is stored. Finer levels would be almost as big as
+# the data itself which is then read directly.
+FIRST_LEVEL = 4
+
+# The coarsest level stored has at most this many bins.
+MIN_BINS = 64
+
+# Number of waveform channels loaded at once by the overview jobs.
+BATCH_SIZE = 500
+
+
+def get_overview_directory(env):
+    """
+    Returns the directory the overviews are stored in. Defaults to the
+    .overviews folder in the waveform directory.
+    """
+    directory = env.config.get("event_based_data", "overview_filepath")
+    if not directory:
+        directory = os.path.join(env.config.get("event_based_data",
+            "waveform_filepath"), ".overviews")
+    return os.path.abspath(directory)
+
+
+def get_overview_filename(env, md5_hash, waveform_channel_id):
+    """
+    Returns the filename of the overview of the given waveform channel.
+    """
+    return os.path.join(get_overview_directory(env), md5_hash[:2],
+        "%s_%i.npz" % (md5_hash, waveform_channel_id))
+
+
+def compute_overview(data):
+    """
+    Computes the min/max pyramid of the given data. The last bin of every
+    level only covers the remaining samples.
+
+    Returns a dictionary mapping the levels to (minima, maxima) tuples. It is
+    empty for data too short to need an overview.
+    """
+    levels = {}
+    minima = maxima = np.asarray(data)
+    level = 0
+    while len(minima) > MIN_BINS:
+        # Odd lengths are padded with the last value which does not change
+        # the extrema of the last bin.
+        if len(minima) % 2:
+            minima = np.append(minima, minima[-1])
+            maxima = np.append(maxima, maxima[-1])
+        minima = minima.reshape(-1, 2).min(axis=1)
+        maxima = maxima.reshape(-1, 2).max(axis=1)
+        level += 1
+        if level >= FIRST_LEVEL:
+            levels[level] = (minima, maxima)
+    return levels
+
+
+def write_overview(filename, levels):
+    """
+    Atomically writes the levels of an overview to an npz file.
+    """
+    directory = os.path.dirname(filename)
+    if not os.path.exists(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Might have been created in the meanwhile.
+            if not os.path.isdir(directory):
+                raise
+    arrays = {}
+    for level, (minima, maxima) in levels.iteritems():
+        arrays["min_%i" % level] = minima
+        arrays["max_%i" % level] = maxima
+    fd, temp_filename = tempfile.mkstemp(prefix=".overview-",
+        dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as open_file:
+            np.savez(open_file, **arrays)
+        os.rename(temp_filename, filename)
+    except:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
+
+
+def read_overview(filename):
+    """
+    Reads the levels of an overview written by write_overview().
+
+    Returns None if the overview does not exist.
+    """
+    if not os.path.exists(filename):
+        return None
+    levels = {}
+    with np.load(filename) as npz_file:
+        for name in npz_file.files:
+            if not name.startswith("min_"):
+                continue
+            level = int(name[4:])
+            levels[level] = (npz_file[name], npz_file["max_%i" % level])
+    return levels
+
+
+def get_overview_size(levels):
+    """
+    Returns the memory used by the levels of an overview in bytes.
+    """
+    return sum(_i[0].nbytes + _i[1].nbytes for _i in levels.itervalues())
+
+
+def select_level(levels, samples, width):
+    """
+    Returns the coarsest available level that still has at least width bins
+    for the given number of samples, or None if the samples themselves have
+    to be used.
+    """
+    selected = None
+    for level in sorted(levels):
+        if samples // 2 ** level < width:
+            break
+        selected = level
+    return selected
+
+
+def get_overview_window(levels, level, npts, first_sample, last_sample):
+    """
+    Returns the bins of the given level covering the given inclusive sample
+    range as a (first_bin, minima, maxima) tuple.
+    """
+    first_sample = max(0, first_sample)
+    last_sample = min(npts - 1, last_sample)
+    first_bin = first_sample >> level
+    last_bin = last_sample >> level
+    minima, maxima = levels[level]
+    return first_bin, minima[first_bin:last_bin + 1], \
+        maxima[first_bin:last_bin + 1]
+
+
+def overview_to_json(trace_id, starttime, sampling_rate, level, minima,
+        maxima):
+    """
+    Returns the JSON representation of the bins of an overview starting at
+    the given time. Level 0 are the samples themselves:
+
+    {"channel": "BW.FURT..EHZ", "sampling_rate": 2.0, "level": 4,
+     "samples_per_bin": 16, "starttime": "2009-04-06T01:32:00", "delta": 8.0,
+     "npts": 2, "min": [-3, -1], "max": [2, 5]}
+    """
+    return json.dumps({
+        "channel": trace_id,
+        "sampling_rate": sampling_rate,
+        "level": level,
+        "samples_per_bin": 2 ** level,
+        "starttime": starttime.isoformat(),
+        "delta": 2 ** level / float(sampling_rate),
+        "npts": len(minima),
+        "min": minima.tolist(),
+        "max": maxima.tolist()})
+
+
+def _iter_waveform_channels(open_session, filepath_ids=None):
+    """
+    Yields the waveform channels of the given files, or of all files if
+    None, in batches ordered by their id. The files, channels, and stations
+    of every batch are loaded with the same query.
+    """
+    last_id = None
+    while True:
+        query = open_session.query(WaveformChannelObject).options(
+            joinedload(WaveformChannelObject.filepath),
+            joinedload_all("channel.station"))
+        if filepath_ids is not None:
+            query = query.filter(
+                WaveformChannelObject.filepath_id.in_(filepath_ids))
+        if last_id is not None:
+            query = query.filter(WaveformChannelObject.id > last_id)
+        batch = query.order_by(WaveformChannelObject.id)\
+            .limit(BATCH_SIZE).all()
+        if not batch:
+            return
+        last_id = batch[-1].id
+        yield batch
+
+
+def compute_overviews(env, job_id, filepath_ids=None):
+    """
+    Computes and stores the overviews of all waveform channels of the given
+    files. If no files are given, all waveform channels without an overview
+    are processed.
+
+    The waveform channels are processed in batches and the progress is
+    committed once per batch so the objects of a batch do not have to be
+    loaded again.
+    """
+    # Avoid circular imports.
+    from waveform_mappers import _read_trace
+
+    session = env.db.session(bind=env.db.engine)
+    try:
+        total_count = 0
+        for batch in _iter_waveform_channels(session, filepath_ids):
+            if filepath_ids is None:
+                batch = [_i for _i in batch
+                    if not os.path.exists(get_overview_filename(env,
+                        _i.filepath.md5_hash, _i.id))]
+            total_count += len(batch)
+            update_job_progress(session, job_id, total_count)
+
+            for waveform_channel in batch:
+                filename = waveform_channel.filepath.filepath
+                try:
+                    trace = _read_trace(waveform_channel)
+                    if trace is None:
+                        raise ValueError("The trace could not be found in "
+                            "the file.")
+                    write_overview(get_overview_filename(env,
+                        waveform_channel.filepath.md5_hash,
+                        waveform_channel.id), compute_overview(trace.data))
+                except Exception, e:
+                    msg = "(%s) %s" % (e.__class__.__name__, str(e))
+                    update_job_progress(session, job_id, processed_count=1,
+                        failed_count=1, errors=[(filename, msg)])
+                else:
+                    update_job_progress(session, job_id, processed_count=1)
+            session.commit()
+    finally:
+        session.close()
+
+
+def submit_overview_job(env, filepath_ids):
+    """
+    Submits a job computing the overviews of the given files if enabled by
+    the compute_overviews option. None computes all missing overviews.
+
+    Only used for files uploaded to SeisHub. Overviews of indexed files are
+    computed when they are first requested so indexing an archive does not
+    decode all of it.
+
+    Returns the id of the job or None.
+    """
+    if not env.config.getbool("event_based_data", "compute_overviews"):
+        return None
+    return submit_job(env, "overviews", {"filepath_ids": filepath_ids})
+
+
+register_job_handler("overviews", compute_overviews)
@@ -3,15 +3,86 @@
 Event-based data plug-in for SeisHub.
 """
 from seishub.core.core import Component, implements
-from seishub.core.config import Option
+from seishub.core.config import BoolOption, IntOption, Option
 from seishub.core.packages.installer import registerIndex
 from seishub.core.packages.interfaces import IPackage, IResourceType
 
 import os
+from sqlalchemy import MetaData, Table, func, select
+from sqlalchemy.engine.reflection import Inspector
 
+from hash_filter import warm_hash_filter
+from jobs import recover_jobs
 from table_definitions import Base
 
 
+def _has_duplicates(engine, index):
+    """
+    Returns True if the columns of the given index have duplicate values in
+    the database.
+    """
+    columns = list(index.columns)
+    query = select(columns).group_by(*columns)\
+        .having(func.count() > 1).limit(1)
+    return engine.execute(query).first() is not None
+
+
+def _create_missing_indices(engine, log=None):
+    """
+    Creates all indices defined for the plug-in's tables that do not yet
+    exist in the database.
+
+    Unique indices are only created if the existing data allows it.
+    Otherwise the duplicate values are reported to the given log and the
+    index is attempted again at the next start. Once created, they replace
+    the non-unique indices of the same columns.
+    """
+    inspector = Inspector.from_engine(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = inspector.get_indexes(table.name)
+        names = set(_i["name"] for _i in existing)
+        for index in table.indexes:
+            if index.name in names:
+                continue
+            if index.unique and _has_duplicates(engine, index):
+                if log is not None:
+                    log.error("Could not create the unique index %s as the "
+                        "table %s contains duplicate values. Remove them "
+                        "and restart the server." % (index.name,
+                        table.name))
+                continue
+            index.create(bind=engine)
+            if not index.unique:
+                continue
+            column_names = [_i.name for _i in index.columns]
+            superseded = [_i["name"] for _i in existing
+                if not _i["unique"] and _i["column_names"] == column_names]
+            if not superseded:
+                continue
+            reflected = Table(table.name, MetaData(), autoload=True,
+                autoload_with=engine)
+            for old_index in reflected.indexes:
+                if old_index.name in superseded:
+                    old_index.drop(bind=engine)
+
+
+def _create_missing_columns(engine):
+    """
+    Adds all columns defined for the plug-in's tables that do not yet exist
+    in the database. Only works for nullable columns which is why all columns
+    added to existing tables have to be nullable.
+    """
+    inspector = Inspector.from_engine(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(_i["name"] for _i in
+            inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            engine.execute("ALTER TABLE %s ADD COLUMN %s %s" % (table.name,
+                column.name, column.type.compile(dialect=engine.dialect)))
+
+
 class EventBasedDataPackage(Component):
     """
     Event-based data package for SeisHub.
@@ -25,12 +96,48 @@ class EventBasedDataPackage(Component):
     Option("event_based_data", "station_filepath", "",
         ("Determines where the station information files will be stored upon "
         "uploading."))
+    Option("event_based_data", "storage_layout", "named",
+        ("Layout of the files managed by SeisHub. 'named' names them after "
+        "the first channel they contain, 'content_addressed' after their md5 "
+        "checksum sharded into prefix directories."))
+    IntOption("event_based_data", "content_addressed_depth", 2,
+        ("Number of prefix directory levels for the 'content_addressed' "
+        "storage layout."))
+    IntOption("event_based_data", "indexing_processes", 0,
+        ("Number of worker processes used to index directories. 0 will use "
+        "the number of CPUs."))
+    BoolOption("event_based_data", "asynchronous_ingest", False,
+        ("If True, uploads and indexing requests return a job id right away "
+        "and are processed in the background. Can be overwritten per "
+        "request with the async parameter."))
+    IntOption("event_based_data", "ingest_workers", 2,
+        ("Number of background worker threads processing queued jobs. With 0 "
+        "jobs are queued but not processed by this server."))
+    IntOption("event_based_data", "waveform_cache_size", 256,
+        ("Maximum size in MB of the cache of decoded and converted "
+        "waveforms. 0 disables the cache."))
+    IntOption("event_based_data", "maintenance_threads", 4,
+        ("Number of threads used by maintenance jobs like the rescan of "
+        "indexed files to read files in parallel."))
+    IntOption("event_based_data", "maintenance_io_limit", 0,
+        ("Maximum rate in MB/s at which maintenance jobs read files. 0 "
+        "disables the limit."))
+    BoolOption("event_based_data", "compute_overviews", True,
+        ("If True, min/max overviews for plotting are computed in the "
+        "background for every uploaded waveform."))
+    Option("event_based_data", "overview_filepath", "",
+        ("Determines where the overviews of the waveforms are stored. "
+        "Defaults to the .overviews folder in the waveform_filepath."))
 
     def __init__(self, *args, **kwargs):
         super(EventBasedDataPackage, self).__init__(*args, **kwargs)
         # Initialize all database tables. They will be created if they do not
         # exist yet.
         Base.metadata.create_all(self.env.db.engine, checkfirst=True)
+        # Columns and indices added to already existing tables are not
+        # created by create_all().
+        _create_missing_columns(self.env.db.engine)
+        _create_missing_indices(self.env.db.engine, self.env.log)
         # Check if the data paths are set, if not assign default paths in the
         # SeisHub instance folder.
         if self.env.config.get("event_based_data", "waveform_filepath") == "":
@@ -47,6 +154,10 @@ class EventBasedDataPackage(Component):
         for path in paths:
             if not os.path.exists(path):
                 os.makedirs(path)
+        # Continue with the jobs left over from the last run.
+        recover_jobs(self.env)
+        # Load the checksums of all known files for the duplicate detection.
+        warm_hash_filter(self.env)
 
 
 class EventResourceType(Component):
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Spatial index over the coordinates of all stations used for radius and
+nearest neighbour queries.
+
+The stations are stored as unit vectors in a KD-tree. The straight line
+distance between two unit vectors (the chord) grows monotonically with the
+great circle distance so radius and nearest neighbour queries on the sphere
+become simple queries in three dimensions. Queries near the poles or across
+the date line need no special treatment.
+
+The index is built once per database engine and updated whenever stations
+are added or get their coordinates. Stations changed by other processes
+using the same database are not seen. The database stays the source of truth
+as all results are checked against the coordinates stored in it.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import numpy as np
+from scipy.spatial import cKDTree
+import threading
+
+from table_definitions import StationObject
+
+
+# One index per database engine.
+_indices = {}
+_indices_lock = threading.Lock()
+
+
+def _to_unit_vectors(latitudes, longitudes):
+    """
+    Converts geographic coordinates in degrees to unit vectors.
+    """
+    latitudes = np.radians(np.asarray(latitudes, dtype=np.float64))
+    longitudes = np.radians(np.asarray(longitudes, dtype=np.float64))
+    cos_lat = np.cos(latitudes)
+    return np.column_stack((cos_lat * np.cos(longitudes),
+        cos_lat * np.sin(longitudes), np.sin(latitudes)))
+
+
+def _degrees_to_chord(degrees):
+    """
+    Converts a great circle distance in degrees to the length of the chord
+    between both points on the unit sphere.
+    """
+    return 2.0 * np.sin(np.radians(min(max(degrees, 0.0), 180.0)) / 2.0)
+
+
+def great_circle_distance(latitude_1, longitude_1, latitude_2,
+        longitude_2):
+    """
+    Returns the great circle distance in degrees between the given points.
+    Works element-wise on arrays. Uses the Vincenty formula which is
+    accurate for all distances.
+    """
+    lat_1 = np.radians(latitude_1)
+    lat_2 = np.radians(latitude_2)
+    delta_lon = np.radians(np.asarray(longitude_2, dtype=np.float64) -
+        longitude_1)
+    sin_lat_1, cos_lat_1 = np.sin(lat_1), np.cos(lat_1)
+    sin_lat_2, cos_lat_2 = np.sin(lat_2), np.cos(lat_2)
+    cos_delta_lon = np.cos(delta_lon)
+    y = np.hypot(cos_lat_2 * np.sin(delta_lon),
+        cos_lat_1 * sin_lat_2 - sin_lat_1 * cos_lat_2 * cos_delta_lon)
+    x = sin_lat_1 * sin_lat_2 + cos_lat_1 * cos_lat_2 * cos_delta_lon
+    return np.degrees(np.arctan2(y, x))
+
+
+def azimuth(latitude_1, longitude_1, latitude_2, longitude_2):
+    """
+    Returns the azimuth in degrees clockwise from north at which the second
+    point is seen from the first one along the great circle. Works
+    element-wise on arrays.
+    """
+    lat_1 = np.radians(latitude_1)
+    lat_2 = np.radians(latitude_2)
+    delta_lon = np.radians(np.asarray(longitude_2, dtype=np.float64) -
+        longitude_1)
+    y = np.sin(delta_lon) * np.cos(lat_2)
+    x = np.cos(lat_1) * np.sin(lat_2) - \
+        np.sin(lat_1) * np.cos(lat_2) * np.cos(delta_lon)
+    return np.degrees(np.arctan2(y, x)) % 360.0
+
+
+class StationIndex(object):
+    """
+    Thread-safe KD-tree over the coordinates of stations. The tree is
+    rebuilt lazily on the first query after stations have been changed.
+    """
+    def __init__(self):
+        self._coordinates = {}
+        self._ids = None
+        self._tree = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._coordinates)
+
+    def update(self, station_id, latitude, longitude):
+        """
+        Sets the coordinates of a station. Stations without coordinates are
+        removed from the index.
+        """
+        with self._lock:
+            if latitude is None or longitude is None:
+                if self._coordinates.pop(station_id, None) is None:
+                    return
+            elif self._coordinates.get(station_id, None) == \
+                    (latitude, longitude):
+                return
+            else:
+                self._coordinates[station_id] = (latitude, longitude)
+            self._tree = None
+
+    def _get_tree(self):
+        """
+        Returns the ids of the stations and the tree, rebuilding it if
+        necessary. Has to be called with the lock being held.
+        """
+        if self._tree is None and self._coordinates:
+            self._ids = np.array(sorted(self._coordinates))
+            coordinates = np.array([self._coordinates[_i]
+                for _i in self._ids])
+            self._tree = cKDTree(_to_unit_vectors(coordinates[:, 0],
+                coordinates[:, 1]))
+        return self._ids, self._tree
+
+    def query_radius(self, latitude, longitude, max_radius):
+        """
+        Returns the ids of all stations at most max_radius degrees away from
+        the given point.
+        """
+        with self._lock:
+            ids, tree = self._get_tree()
+            if tree is None:
+                return []
+            indices = tree.query_ball_point(_to_unit_vectors([latitude],
+                [longitude])[0], _degrees_to_chord(max_radius) * (1 + 1E-9))
+            return ids[sorted(indices)].tolist()
+
+    def query_nearest(self, latitude, longitude, k):
+        """
+        Returns the ids of the k stations closest to the given point sorted
+        by their distance.
+        """
+        with self._lock:
+            ids, tree = self._get_tree()
+            if tree is None or k <= 0:
+                return []
+            k = min(k, len(ids))
+            _, indices = tree.query(_to_unit_vectors([latitude],
+                [longitude])[0], k=k)
+            return ids[np.atleast_1d(indices)].tolist()
+
+
+def _build_index(env):
+    """
+    Builds a new index containing all stations with coordinates in the
+    database.
+    """
+    index = StationIndex()
+    session = env.db.session(bind=env.db.engine)
+    # Stations without coordinates are ignored by the index.
+    query = session.query(StationObject.id, StationObject.latitude,
+        StationObject.longitude)
+    for station_id, latitude, longitude in query.yield_per(10000):
+        index.update(station_id, latitude, longitude)
+    session.close()
+    return index
+
+
+def get_station_index(env):
+    """
+    Returns the station index of the database of the given environment,
+    building it if necessary.
+    """
+    with _indices_lock:
+        index = _indices.get(env.db.engine, None)
+        if index is None:
+            index = _build_index(env)
+            _indices[env.db.engine] = index
+    return index
+
+
+def update_station_index(engine, stations):
+    """
+    Updates the coordinates of the given station objects in the index of the
+    given engine. The stations need to have been flushed so they have ids.
+    Called before the changes are committed. Uncommitted changes are at
+    worst returned as candidates that are then discarded as they are not
+    found in the database.
+    """
+    with _indices_lock:
+        index = _indices.get(engine, None)
+    if index is None:
+        return
+    for station in stations:
+        index.update(station.id, station.latitude, station.longitude)
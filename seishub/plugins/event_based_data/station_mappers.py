@@ -2,21 +2,69 @@
 # -*- coding: utf-8 -*-
 from seishub.core.core import Component, implements
 from seishub.core.exceptions import NotFoundError, InvalidObjectError, \
-    InternalServerError, InvalidParameterError
+    InvalidParameterError
 from seishub.core.packages.interfaces import IMapper
 from seishub.core.db.util import formatResults
 
+import itertools
 import json
 from obspy.core import UTCDateTime
 from obspy.xseed import Parser
 import os
 import sqlalchemy
-from sqlalchemy.exc import IntegrityError
-import StringIO
 
-from table_definitions import ChannelMetadataObject, StationObject
-from util import check_if_file_exist_in_db, write_string_to_filesystem, \
-    add_or_update_channel, add_filepath_to_database
+from indexer import start_directory_indexing
+from ingest import ingest_station_file
+from jobs import get_job_info, submit_job
+from spatial import get_station_index, great_circle_distance
+from table_definitions import ChannelObject, StationObject
+from util import get_md5_of_file, spool_to_filesystem, \
+    lowercase_true_strings, wildcard_filter, get_bounding_box_filters, \
+    get_float_parameter, get_limit, set_next_cursor
+
+
+# The columns of the station list that can be selected with the fields
+# parameter.
+STATION_FIELDS = ("id", "network", "station", "latitude", "longitude",
+    "elevation_in_m", "local_depth_in_m")
+
+# Maximum number of station ids per query.
+ID_BATCH_SIZE = 500
+
+
+def _get_spatial_query(request):
+    """
+    Parses the parameters of a query for the stations around a point.
+
+    Returns None if no point is given or a dictionary with the keyword
+    arguments of StationMapper._get_stations_by_distance().
+    """
+    latitude = get_float_parameter(request, "latitude", -90, 90)
+    longitude = get_float_parameter(request, "longitude", -180, 180)
+    max_radius = get_float_parameter(request, "max_radius", 0, 180)
+    min_radius = get_float_parameter(request, "min_radius", 0, 180)
+    nearest = request.args0.get("nearest", None)
+    if nearest is not None:
+        try:
+            nearest = int(nearest)
+        except ValueError:
+            nearest = 0
+        if nearest <= 0:
+            msg = "'nearest' has to be a positive integer."
+            raise InvalidParameterError(msg)
+    if latitude is None and longitude is None:
+        if max_radius is not None or min_radius is not None or \
+                nearest is not None:
+            msg = "'latitude' and 'longitude' are required for queries " \
+                "around a point."
+            raise InvalidParameterError(msg)
+        return None
+    if latitude is None or longitude is None:
+        msg = "'latitude' and 'longitude' have to be given together."
+        raise InvalidParameterError(msg)
+    return {"latitude": latitude, "longitude": longitude,
+        "max_radius": max_radius, "min_radius": min_radius,
+        "nearest": nearest}
 
 
 class StationMapper(Component):
@@ -51,6 +99,31 @@ class StationMapper(Component):
 
     SEISHUB_SERVER/event_based_data/station?index_file=FILE
 
+    Whole directory trees can be indexed in one go by passing the
+    index_directory parameter and optionally a glob pattern:
+
+    SEISHUB_SERVER/event_based_data/station?index_directory=DIR&pattern=RESP*
+
+    Passing async=true will return right away with the id of a job that
+    ingests the file in the background.
+
+    A GET request without parameters lists all stations. The network and
+    station parameters filter them with the wildcards "*" and "?", fields
+    selects the returned fields, include_channels=false omits the channels,
+    and limit and after paginate the list.
+
+    SEISHUB_SERVER/event_based_data/station?network=G*&fields=network,\
+station,latitude,longitude&include_channels=false&limit=1000
+
+    min_latitude, max_latitude, min_longitude, and max_longitude restrict the
+    list to a bounding box. Given a latitude and longitude, the stations are
+    sorted by their distance to that point. max_radius, min_radius and
+    nearest then select the stations within a distance in degrees or the
+    nearest ones.
+
+    SEISHUB_SERVER/event_based_data/station?latitude=48.1&longitude=11.6&\
+max_radius=5
+
     Take care of correctly encoding the URL, e.g. "/" is encoded as "%2F".
 
     You can use urllib.urlencode() for that task:
@@ -76,72 +149,253 @@ class StationMapper(Component):
         The 'format' argument supports xml, xhtml, json, and geojson and will
         output the appropriate type.
         """
-        # If network and station are given, return details.
+        # If network and station are given, return details. Otherwise they
+        # are patterns filtering the list.
         network = request.args0.get("network", None)
         station = request.args0.get("station", None)
-        if network and station:
-            network = network
-            station = station
+        if network and station and not any(_i in network + station
+                for _i in "*?"):
             return self.get_station_details(request, network, station)
+        return self.get_station_list(request, network, station)
+
+    def get_station_list(self, request, network=None, station=None):
+        """
+        Returns the list of stations ordered by network and station code.
+
+        Only the columns of the fields given with the fields parameter are
+        loaded. The channels of the stations are included unless
+        include_channels=false is given. They are retrieved in the same
+        query by joining the page of stations with the channels. The
+        network and station codes can be filtered with the wildcards "*" and
+        "?" and the coordinates with a bounding box.
+
+        With limit only that many stations are returned. The x-next-after
+        header then contains the value of the after parameter for the next
+        page.
+
+        If a latitude and longitude are given, the stations are ordered by
+        their distance to that point instead, optionally only the ones
+        within max_radius and beyond min_radius degrees or the nearest ones.
+        """
+        fields = request.args0.get("fields", None)
+        if fields is None:
+            fields = list(STATION_FIELDS)
+        else:
+            fields = [_i.strip() for _i in fields.split(",") if _i.strip()]
+            if not fields or set(fields) - set(STATION_FIELDS):
+                msg = "'fields' has to be a comma separated list of: %s" % \
+                    ", ".join(STATION_FIELDS)
+                raise InvalidParameterError(msg)
+        include_channels = request.args0.get("include_channels", "true")\
+            .lower() in lowercase_true_strings
+        limit = get_limit(request)
+        after = request.args0.get("after", None)
+        if after is not None:
+            after = after.split(".")
+            if len(after) != 2:
+                msg = "'after' has to be the value of the x-next-after " \
+                    "header of the previous page."
+                raise InvalidParameterError(msg)
+        formats = request.args0.get("format", [])
+        is_geojson = "geojson" in formats
+        spatial_query = _get_spatial_query(request)
+        if spatial_query is not None and after is not None:
+            msg = "Stations ordered by distance cannot be paginated."
+            raise InvalidParameterError(msg)
+
+        filters = get_bounding_box_filters(request, StationObject.latitude,
+            StationObject.longitude)
+        if network:
+            filters.append(wildcard_filter(StationObject.network, network))
+        if station:
+            filters.append(wildcard_filter(StationObject.station, station))
+
+        # The codes are always needed for the ordering and the cursor.
+        columns = ["network", "station"] + [_i for _i in fields
+            if _i not in ("network", "station")]
+        if include_channels and "id" not in columns:
+            columns.append("id")
+        if is_geojson or spatial_query is not None:
+            columns.extend([_i for _i in ("latitude", "longitude")
+                if _i not in columns])
 
-        # XXX: This is likely not optimal.
         session = self.env.db.session(bind=self.env.db.engine)
-        query = session.query(StationObject).order_by(StationObject.network)\
-            .order_by(StationObject.station).all()
-        query = [{
-            "id": i.id,
-            "network": i.network,
-            "station": i.station,
-            "latitude": i.latitude,
-            "longitude": i.longitude,
-            "elevation_in_m": i.elevation_in_m,
-            "local_depth_in_m": i.local_depth_in_m,
-            "channels": [{"channel": j.channel}
-                for j in i.channel]} for i in query]
+        try:
+            if spatial_query is not None:
+                items = self._get_stations_by_distance(session, columns,
+                    filters, include_channels, **spatial_query)
+                fields = fields + ["distance_in_degree"]
+                if limit is not None:
+                    items = items[:limit]
+            else:
+                query = self._get_station_query(session, columns, filters)
+                if after is not None:
+                    query = query.filter(sqlalchemy.or_(
+                        StationObject.network > after[0],
+                        sqlalchemy.and_(StationObject.network == after[0],
+                            StationObject.station > after[1])))
+                # Get one more to know if there is another page.
+                if limit is not None:
+                    query = query.limit(limit + 1)
+                items = self._load_stations(session, query, columns,
+                    include_channels)
+        finally:
+            session.close()
+
+        if spatial_query is None and limit is not None and \
+                len(items) > limit:
+            items = items[:limit]
+            set_next_cursor(request, "%s.%s" % (items[-1]["network"],
+                items[-1]["station"]))
 
         # Encode geojson manually, let the rest be handled by a convenience
         # method.
-        formats = request.args0.get("format", [])
-        if "geojson" in formats:
+        if is_geojson:
             result = {"type": "FeatureCollection",
                 "features": []}
-            for item in query:
+            for item in items:
+                properties = dict((_i, item[_i]) for _i in fields
+                    if _i != "id")
+                if include_channels:
+                    properties["channels"] = ", ".join([_i["channel"]
+                        for _i in item["channels"]])
                 feature = {"type": "Feature",
                     "geometry": {"type": "Point",
                         "coordinates": [item["longitude"], item["latitude"]]},
-                    "properties": {
-                        "elevation_in_m": item["elevation_in_m"],
-                        "latitude": item["latitude"],
-                        "longitude": item["longitude"],
-                        "network": item["network"],
-                        "station": item["station"],
-                        "local_depth_in_m": item["local_depth_in_m"],
-                        "channels": ", ".join([_i["channel"]
-                            for _i in item["channels"]])},
+                    "properties": properties,
                     "id": "%s.%s" % (item["network"], item["station"])}
                 result["features"].append(feature)
             result = json.dumps(result)
             request.setHeader('content-type',
                 'application/json; charset=UTF-8')
         else:
-            result = formatResults(request, query)
+            # Only return the requested fields.
+            result = formatResults(request, [dict((_i, item[_i])
+                for _i in fields + (["channels"] if include_channels else []))
+                for item in items])
         return result
 
+    def _get_station_query(self, session, columns, filters):
+        """
+        Returns the query for the given columns of all stations fulfilling
+        the given filters ordered by network and station code.
+        """
+        query = session.query(*[getattr(StationObject, _i).label(_i)
+            for _i in columns])
+        for _filter in filters:
+            query = query.filter(_filter)
+        return query.order_by(StationObject.network, StationObject.station)
+
+    def _load_stations(self, session, query, columns, include_channels):
+        """
+        Returns the stations of the given query as a list of dictionaries.
+        The channels are retrieved in the same database query if requested.
+        """
+        if not include_channels:
+            return [dict((_i, getattr(row, _i)) for _i in columns)
+                for row in query]
+
+        stations = query.subquery()
+        rows = session.query(stations, ChannelObject.channel)\
+            .outerjoin(ChannelObject,
+                ChannelObject.station_id == stations.c.id)\
+            .order_by(stations.c.network, stations.c.station,
+                ChannelObject.id).all()
+        # Aggregate the channels of every station.
+        items = []
+        for _, group in itertools.groupby(rows,
+                key=lambda x: (x.network, x.station)):
+            group = list(group)
+            item = dict((_i, getattr(group[0], _i)) for _i in columns)
+            item["channels"] = [{"channel": _i.channel}
+                for _i in group if _i.channel is not None]
+            items.append(item)
+        return items
+
+    def _get_stations_by_distance(self, session, columns, filters,
+            include_channels, latitude, longitude, max_radius=None,
+            min_radius=None, nearest=None):
+        """
+        Returns the stations around the given point sorted by their distance
+        in degrees which is added to every station. The candidates are
+        determined with the spatial index of the stations and then checked
+        against the coordinates in the database.
+        """
+        index = get_station_index(self.env)
+
+        def _load(station_ids):
+            items = []
+            for i in xrange(0, len(station_ids), ID_BATCH_SIZE):
+                query = self._get_station_query(session, columns,
+                    filters + [StationObject.id.in_(
+                        station_ids[i:i + ID_BATCH_SIZE])])
+                items.extend(self._load_stations(session, query, columns,
+                    include_channels))
+            items = [_i for _i in items if _i["latitude"] is not None and
+                _i["longitude"] is not None]
+            if not items:
+                return []
+            distances = great_circle_distance(latitude, longitude,
+                [_i["latitude"] for _i in items],
+                [_i["longitude"] for _i in items])
+            for item, distance in zip(items, distances):
+                item["distance_in_degree"] = float(distance)
+            items = [_i for _i in items
+                if (max_radius is None or
+                    _i["distance_in_degree"] <= max_radius) and
+                (min_radius is None or
+                    _i["distance_in_degree"] >= min_radius)]
+            items.sort(key=lambda x: x["distance_in_degree"])
+            return items
+
+        if nearest is None or max_radius is not None:
+            items = _load(index.query_radius(latitude, longitude,
+                max_radius if max_radius is not None else 180.0))
+            return items[:nearest] if nearest is not None else items
+
+        # Other filters might remove some of the nearest stations. Get more
+        # candidates until enough stations are left.
+        count = nearest
+        while True:
+            items = _load(index.query_nearest(latitude, longitude, count))
+            if len(items) >= nearest or count >= len(index):
+                return items[:nearest]
+            count *= 2
+
     def process_POST(self, request):
         """
         Function that will be called upon receiving a POST request for the
         aforementioned URL.
         """
+        # Jobs can be processed in the background.
+        asynchronous = request.args0.get("async", None)
+        if isinstance(asynchronous, basestring):
+            asynchronous = asynchronous.lower() in lowercase_true_strings
+        else:
+            asynchronous = self.env.config.getbool("event_based_data",
+                "asynchronous_ingest")
+
+        # Index a whole directory tree if requested.
+        directory = request.args0.get("index_directory", None)
+        if directory is not None:
+            job_id = start_directory_indexing(self.env, directory, "station",
+                pattern=request.args0.get("pattern", None),
+                asynchronous=asynchronous)
+            return formatResults(request, [get_job_info(self.env, job_id)])
+
         # There are two possibilities for getting data inside the database:
         # upload the file directly to SeisHub or just give a file URL that the
         # server can find.
         filename = request.args0.get("index_file", None)
 
         # If the 'index_file' parameter is not given, assume the file will be
-        # directly uploaded.
+        # directly uploaded. It is streamed to a temporary file while the
+        # checksum is calculated.
         if filename is None:
             station_data = request.content
             station_data.seek(0, 0)
+            filename, md5_hash, filesize = spool_to_filesystem(station_data,
+                self.env.config.get("event_based_data", "station_filepath"))
             file_is_managed_by_seishub = True
         else:
             filename = os.path.abspath(filename)
@@ -149,109 +403,24 @@ class StationMapper(Component):
                 msg = "File '%s' cannot be found by the SeisHub server." % \
                     filename
                 raise InvalidParameterError(msg)
-            with open(filename, "rb") as open_file:
-                station_data = StringIO.StringIO(open_file.read())
-            station_data.seek(0, 0)
+            # Hashing is potentially expensive and thus left to the job.
+            if asynchronous:
+                md5_hash, filesize = None, None
+            else:
+                md5_hash, filesize = get_md5_of_file(filename)
             file_is_managed_by_seishub = False
 
-        # Check if file exists. Checksum is returned otherwise. Raises on
-        # failure.
-        data = station_data.read()
-        station_data.seek(0, 0)
-        md5_hash = check_if_file_exist_in_db(data, self.env)
-
-        # Attempt to read as a SEED/XSEED file.
-        station_data.seek(0, 0)
-        channels = _read_SEED(station_data)
-        station_data.seek(0, 0)
-        # Otherwise attempt to read as a RESP file.
-        if channels is False:
-            channels = _read_RESP(station_data)
-        # Otherwise raise an Error.
-        if channels is False:
-            msg = "Could not read the station information file."
-            raise InvalidObjectError(msg)
-
-        if file_is_managed_by_seishub is True:
-            network = channels[0]["network"]
-
-            filename = os.path.join(self.env.config.get("event_based_data",
-                "station_filepath"), network,
-                ("{network}.{station}.{location}.{channel}-"
-                "{year}_{month}"))
-            filename = filename.format(network=network,
-                station=channels[0]["station"],
-                location=channels[0]["location"],
-                channel=channels[0]["channel"],
-                year=channels[0]["start_date"].year,
-                month=channels[0]["start_date"].month)
-
-            # Write the data to the filesystem. The final filename is returned.
-            filename = write_string_to_filesystem(filename, data)
-
-        # Use only one session to be able to take advantage of transactions.
-        session = self.env.db.session(bind=self.env.db.engine)
-
-        # Wrap in try/except and rollback changes in case something fails.
-        try:
-            # Add information about the uploaded file into the database.
-            filepath = add_filepath_to_database(session, filename, len(data),
-                md5_hash, is_managed_by_seishub=file_is_managed_by_seishub)
-            # Loop over all channels.
-            for channel in channels:
-                # Add the channel if it does not already exists, or update the
-                # location or just return the existing station. In any case a
-                # channel column object will be returned.
-                channel_row = add_or_update_channel(session,
-                    channel["network"], channel["station"],
-                    channel["location"], channel["channel"],
-                    channel["latitude"], channel["longitude"],
-                    channel["elevation"], channel["local_depth"],
-                    force_update=True)
-
-                # Now add information about the time span of the current
-                # channel information.
-                if hasattr(channel["end_date"], "datetime"):
-                    end_date = channel["end_date"].datetime
-                else:
-                    end_date = None
-
-                metadata = ChannelMetadataObject(channel=channel_row,
-                    filepath=filepath,
-                    starttime=channel["start_date"].datetime,
-                    endtime=end_date,
-                    format=channel["format"])
-                session.add(metadata)
-
-                session.commit()
-        except Exception, e:
-            # Rollback session.
-            session.rollback()
-            session.close()
-
-            # Attempt to return a meaningfull error message.
-            msg = ("(%s) " % e.__class__.__name__) + e.message + \
-                " -- Rolling back all changes."
-            # It is possible that two files with different hashes contain
-            # information about exactly the same time span. In this case the
-            # uniqueness constrains of the database will complain and an
-            # integrity error will be raised. Catch it to give a meaningful
-            # error message.
-            if isinstance(e, IntegrityError) and hasattr(channel, "starttime"):
-                msg = ("\nThe information for the following timespan is "
-                    "already existant in the database:\n")
-                msg += "%s.%s.%s.%s - %s-%s\n" % (channel["network"],
-                    channel["station"], channel["location"],
-                    channel["channel"], str(channel["starttime"]),
-                    str(channel["endtime"]))
-                msg += ("All information contained in this file will not be "
-                    "added to the database.")
-            # Remove the file if something failed.
-            if file_is_managed_by_seishub is True:
-                os.remove(filename)
-            self.env.log.error(msg)
-            raise InternalServerError(msg)
-        session.close()
+        # Return the job right away. The upload has already been spooled to
+        # the disk.
+        if asynchronous:
+            job_id = submit_job(self.env, "station_file", {
+                "filename": filename, "md5_hash": md5_hash,
+                "filesize": filesize,
+                "is_managed_by_seishub": file_is_managed_by_seishub})
+            return formatResults(request, [get_job_info(self.env, job_id)])
+
+        ingest_station_file(self.env, filename, md5_hash, filesize,
+            file_is_managed_by_seishub)
 
     def get_station_details(self, request, network, station):
         session = self.env.db.session(bind=self.env.db.engine)
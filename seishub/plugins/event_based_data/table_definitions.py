@@ -15,7 +15,7 @@ from sqlalchemy import ForeignKey, Column, Integer, DateTime, Float, String, \
     Boolean
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import backref, relationship
-from sqlalchemy.schema import UniqueConstraint
+from sqlalchemy.schema import Index, UniqueConstraint
 
 
 Base = declarative_base()
@@ -61,6 +61,10 @@ class FilepathObject(Base):
     Table containing all physical files stored on the disk.
     """
     __tablename__ = "ebd_filepaths"
+    # Every file can only be stored once. The unique index has its own name
+    # as databases created before it have a non-unique index on the column.
+    __table_args__ = (Index("ix_ebd_filepaths_md5_hash_unique", "md5_hash",
+        unique=True), {})
 
     id = Column(Integer, primary_key=True)
     filepath = Column(String, nullable=False, unique=True)
@@ -73,6 +77,8 @@ class FilepathObject(Base):
     is_managed_by_seishub = Column(Boolean, nullable=False)
     # An XML file containing information about the origin of the file.
     file_origin_resource_id = Column(Integer, nullable=True)
+    # Time the checksum of the file has last been verified by the scrubber.
+    last_verified = Column(DateTime, nullable=True)
 
 
 class ChannelMetadataObject(Base):
@@ -121,6 +127,13 @@ class WaveformChannelObject(Base):
     sampling_rate = Column(Float, nullable=False)
     format = Column(String, nullable=False)
     is_synthetic = Column(Boolean, nullable=False)
+    # Position of the trace in the file. Used to read a single trace of
+    # multi-trace files without searching for it.
+    trace_index = Column(Integer, nullable=True)
+    # Byte range of the records of the trace. Only set for MiniSEED files
+    # whose records of the trace are stored contiguously.
+    byte_offset = Column(Integer, nullable=True)
+    byte_length = Column(Integer, nullable=True)
     # The metadata can be any XML document stored in the database.
     metadata_resource_id = Column(Integer, nullable=True)
     # Information about previous processing of the channel.
@@ -131,3 +144,74 @@ class WaveformChannelObject(Base):
         backref=backref("waveform_channel", order_by=id))
     filepath = relationship("FilepathObject",
         backref=backref("waveform_channel", order_by=id))
+
+
+class JobObject(Base):
+    """
+    Table keeping track of long running jobs, e.g. the indexing of whole
+    directories. The arguments of the job are stored as a JSON string.
+    """
+    __tablename__ = "ebd_jobs"
+
+    id = Column(Integer, primary_key=True)
+    job_type = Column(String, nullable=False, index=True)
+    # One of "queued", "running", "done", or "failed".
+    status = Column(String, nullable=False, index=True)
+    arguments = Column(String, nullable=False)
+    created = Column(DateTime, nullable=False)
+    started = Column(DateTime, nullable=True)
+    finished = Column(DateTime, nullable=True)
+    # Progress counters. total_count is the number of files discovered so far.
+    total_count = Column(Integer, nullable=False, default=0)
+    processed_count = Column(Integer, nullable=False, default=0)
+    failed_count = Column(Integer, nullable=False, default=0)
+
+
+class JobErrorObject(Base):
+    """
+    Table containing the errors of single files encountered while running a
+    job.
+    """
+    __tablename__ = "ebd_job_errors"
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(Integer, ForeignKey("ebd_jobs.id"), nullable=False,
+        index=True)
+    filename = Column(String, nullable=True)
+    message = Column(String, nullable=False)
+
+    job = relationship("JobObject", backref=backref("errors", order_by=id))
+
+
+class EventLocationObject(Base):
+    """
+    Table containing the coordinates of all events the distances to the
+    stations have been computed for. Used to detect new, moved, and removed
+    events.
+    """
+    __tablename__ = "ebd_event_locations"
+
+    event_resource_id = Column(String, primary_key=True)
+    latitude = Column(Float, nullable=False)
+    longitude = Column(Float, nullable=False)
+
+
+class EventStationDistanceObject(Base):
+    """
+    Table containing the epicentral distance, the azimuth, and the back
+    azimuth of every pair of an event and a station with known coordinates.
+    All values are in degree.
+    """
+    __tablename__ = "ebd_event_station_distances"
+
+    event_resource_id = Column(String, primary_key=True)
+    station_id = Column(Integer, ForeignKey("ebd_stations.id"),
+        primary_key=True, index=True)
+    distance_in_degree = Column(Float, nullable=False, index=True)
+    # Azimuth of the station as seen from the event.
+    azimuth = Column(Float, nullable=False, index=True)
+    # Azimuth of the event as seen from the station.
+    back_azimuth = Column(Float, nullable=False, index=True)
+
+    station = relationship("StationObject",
+        backref=backref("event_distances"))
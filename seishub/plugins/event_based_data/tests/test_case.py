@@ -21,7 +21,7 @@ from seishub.core.test import SeisHubEnvironmentTestCase
 from seishub.core.processor import Processor, GET, POST, PUT, DELETE
 
 from seishub.plugins.event_based_data import package, waveform_mappers, \
-    station_mappers, event_mappers
+    station_mappers, event_mappers, job_mappers, distance_mappers
 
 
 class EventBasedDataTestCase(SeisHubEnvironmentTestCase):
@@ -34,6 +34,8 @@ class EventBasedDataTestCase(SeisHubEnvironmentTestCase):
         self.env.enableComponent(station_mappers.StationMapper)
         self.env.enableComponent(event_mappers.EventMapper)
         self.env.enableComponent(waveform_mappers.WaveformMapper)
+        self.env.enableComponent(job_mappers.JobMapper)
+        self.env.enableComponent(distance_mappers.DistanceMapper)
         self.env.tree.update()
         # Create a temporary directory where things are stored.
         self.tempdir = tempfile.mkdtemp()
@@ -43,6 +45,9 @@ class EventBasedDataTestCase(SeisHubEnvironmentTestCase):
             os.path.join(self.tempdir, "station_data"))
         self.env.config.set("event_based_data", "waveform_filepath",
             os.path.join(self.tempdir, "waveform_data"))
+        # Do not process any jobs in the background so the tests can run them
+        # deterministically.
+        self.env.config.set("event_based_data", "ingest_workers", "0")
 
         # Directory with the data test files.
         self.data_dir = os.path.join(os.path.dirname(os.path.abspath(
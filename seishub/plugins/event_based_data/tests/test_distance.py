@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A test suite for the precomputed distances between events and stations.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import json
+import os
+from StringIO import StringIO
+import unittest
+
+from seishub.core.exceptions import InvalidParameterError, NotFoundError
+
+from seishub.plugins.event_based_data import distances
+from seishub.plugins.event_based_data.tests.test_case import \
+    EventBasedDataTestCase
+from seishub.plugins.event_based_data.table_definitions import \
+    EventLocationObject, EventStationDistanceObject, StationObject
+
+
+class DistanceTestCase(EventBasedDataTestCase):
+    """
+    Test case for the distance table and the distance mapper.
+    """
+    def _get_distances(self, **kwargs):
+        kwargs["format"] = "json"
+        response = self._send_request("GET", "/event_based_data/distance",
+            args=kwargs)
+        return json.loads(response)["ResultSet"]["Result"]
+
+    def test_distancesBetweenEventsAndStations(self):
+        """
+        The distances are computed for new events and stations and can be
+        filtered.
+        """
+        # Uploaded via the mapper before any station is known.
+        self._send_request("POST", "/event_based_data/event/event_1",
+            os.path.join(self.data_dir, "event1.xml"))
+        for filename in ("dataless.seed.GR_GEC2.xml", "RESP.PM.PFVI..BHZ"):
+            self._send_request("POST", "/event_based_data/station",
+                os.path.join(self.data_dir, filename))
+        # PM.PFVI has no coordinates.
+        session = self.env.db.session(bind=self.env.db.engine)
+        self.assertEqual(session.query(EventStationDistanceObject).count(),
+            1)
+        station_id, distance = session.query(StationObject.id,
+            EventStationDistanceObject.distance_in_degree).filter(
+            EventStationDistanceObject.station_id == StationObject.id).one()
+        session.close()
+
+        results = self._get_distances(event="event_1")
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]["event"], "event_1")
+        self.assertEqual(results[0]["network"], "GR")
+        self.assertEqual(results[0]["station"], "GEC2")
+        self.assertAlmostEqual(results[0]["distance_in_degree"], 89.0959, 3)
+        self.assertAlmostEqual(results[0]["azimuth"], 31.8039, 3)
+        self.assertAlmostEqual(results[0]["back_azimuth"], 315.3776, 3)
+
+        # Events uploaded without the event mapper are picked up by the
+        # maintenance job. Requesting them does not compute them.
+        self._send_request("POST", "/xml/event_based_data/event/event_2",
+            os.path.join(self.data_dir, "event2.xml"))
+        self.assertEqual([_i["event"] for _i in self._get_distances()],
+            ["event_1"])
+        self.assertEqual(self._get_distances(event="event_2"), [])
+        session = self.env.db.session(bind=self.env.db.engine)
+        self.assertEqual(session.query(EventLocationObject).count(), 1)
+        session.close()
+        response = self._send_request("POST", "/event_based_data/jobs", None,
+            {"job_type": "distances", "format": "json"})
+        job = json.loads(response)["ResultSet"]["Result"][0]
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["processed_count"], 1)
+        results = self._get_distances()
+        self.assertEqual([_i["event"] for _i in results],
+            ["event_1", "event_2"])
+        self.assertAlmostEqual(results[1]["distance_in_degree"], 89.8075, 3)
+        self.assertAlmostEqual(results[1]["azimuth"], 39.2024, 3)
+        self.assertAlmostEqual(results[1]["back_azimuth"], 291.2210, 3)
+
+        def get_events(**kwargs):
+            return [_i["event"] for _i in self._get_distances(**kwargs)]
+
+        self.assertEqual(get_events(event="event_2"), ["event_2"])
+        self.assertEqual(get_events(min_distance=89.5), ["event_2"])
+        self.assertEqual(get_events(max_distance=89.5), ["event_1"])
+        self.assertEqual(get_events(min_azimuth=35), ["event_2"])
+        # Azimuth ranges across north.
+        self.assertEqual(get_events(min_azimuth=350, max_azimuth=35),
+            ["event_1"])
+        self.assertEqual(get_events(max_back_azimuth=300), ["event_2"])
+        self.assertEqual(get_events(network="G?"), ["event_1", "event_2"])
+        self.assertEqual(get_events(network="PM"), [])
+
+        self.assertEqual(get_events(limit=1), ["event_1"])
+        after = "%i,%r,%s" % (station_id, distance, "event_1")
+        self.assertEqual(get_events(limit=1, after=after), ["event_2"])
+
+        self.assertRaises(NotFoundError, self._get_distances,
+            event="unknown")
+        self.assertRaises(InvalidParameterError, self._get_distances,
+            max_distance=200)
+        self.assertRaises(InvalidParameterError, self._get_distances,
+            after="event_1")
+
+    def test_eventsWithSeveralOriginsUseThePreferredOrigin(self):
+        """
+        The distances of events with several origins are computed for the
+        preferred origin, no matter in which order the event view returns
+        the origins.
+        """
+        self._send_request("POST", "/event_based_data/station",
+            os.path.join(self.data_dir, "dataless.seed.GR_GEC2.xml"))
+        with open(os.path.join(self.data_dir, "event1.xml"), "rb") as \
+                open_file:
+            data = open_file.read()
+        # The preferred origin is the second one.
+        first_origin = '<origin publicID="smi:local/Origin/' \
+            '2013-01-05T20:19:58.728068">'
+        self.assertTrue(first_origin in data)
+        data = data.replace("</origin>", "</origin>\n"
+            '<origin publicID="smi:local/Origin/2013-01-05T20:19:58.728789">'
+            "<latitude><value>10.5</value></latitude>"
+            "<longitude><value>20.25</value></longitude></origin>", 1)
+        self._send_request("POST", "/event_based_data/event/event_1",
+            StringIO(data))
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        location = session.query(EventLocationObject).one()
+        self.assertEqual((location.latitude, location.longitude),
+            (10.5, 20.25))
+        session.close()
+        # Nothing changes when checking again.
+        self.assertEqual(distances.update_event_distances(self.env), 0)
+
+        expected = distances.compute_distances([10.5], [20.25],
+            [48.845085], [13.701584])[0][0, 0]
+        results = self._get_distances(event="event_1")
+        self.assertEqual(len(results), 1)
+        self.assertAlmostEqual(results[0]["distance_in_degree"], expected, 5)
+
+
+class DistanceFunctionsTestCase(unittest.TestCase):
+    """
+    Test case for the distance computations that do not need an active
+    SeisHub environment.
+    """
+    def test_computeDistances(self):
+        """
+        Tests the vectorized distance, azimuth, and back azimuth computation.
+        """
+        dist, az, baz = distances.compute_distances([0.0, 45.0],
+            [0.0, 10.0], [0.0, 10.0, 0.0], [90.0, 0.0, 10.0])
+        self.assertEqual(dist.shape, (2, 3))
+        expected = [
+            [(90.0, 90.0, 270.0), (10.0, 0.0, 180.0), (10.0, 90.0, 270.0)],
+            [(82.946978, 97.107076, 315.438549),
+                (36.043286, 196.896131, 12.045134), (45.0, 180.0, 0.0)]]
+        for i, row in enumerate(expected):
+            for j, (distance, azimuth, back_azimuth) in enumerate(row):
+                self.assertAlmostEqual(dist[i, j], distance, 4)
+                self.assertAlmostEqual(az[i, j], azimuth, 4)
+                self.assertAlmostEqual(baz[i, j], back_azimuth, 4)
+        self.assertTrue(((az >= 0) & (az < 360)).all())
+        self.assertTrue(((baz >= 0) & (baz < 360)).all())
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(DistanceFunctionsTestCase, "test"))
+    suite.addTest(unittest.makeSuite(DistanceTestCase, "test"))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -15,6 +15,8 @@ from PIL import Image
 from StringIO import StringIO
 import unittest
 
+from seishub.core.exceptions import InvalidParameterError
+
 from seishub.plugins.event_based_data.tests.test_case import \
     EventBasedDataTestCase
 
@@ -154,6 +156,69 @@ class EventTestCase(EventBasedDataTestCase):
             'longitude', 'magnitude', 'magnitude_type', 'package_id',
             'resource_name', 'resourcetype_id', 'scalar_moment', 'time'])
 
+    def test_filteringSortingAndPagingEventList(self):
+        """
+        The event list can be filtered, sorted and paginated.
+        """
+        for name, filename in (("TEST_EVENT_1", "event1.xml"),
+                ("TEST_EVENT_2", "event2.xml")):
+            self._send_request("POST", "/xml/event_based_data/event/" + name,
+                os.path.join(self.data_dir, filename))
+
+        def get_events(**kwargs):
+            kwargs["format"] = "json"
+            response = self._send_request("GET", "/event_based_data/event",
+                args=kwargs)
+            return [str(_i["resource_name"]) for _i in
+                json.loads(response)[u"ResultSet"][u"Result"]]
+
+        # TEST_EVENT_1: 2012-04-12, mb 6.2, depth 13.0, (28.7, -113.1)
+        # TEST_EVENT_2: 2012-11-07, MS 7.4, depth 28.7, (13.93, -92.47)
+        both = ["TEST_EVENT_1", "TEST_EVENT_2"]
+        self.assertEqual(get_events(), both)
+        self.assertEqual(get_events(starttime="2012-06-01"), ["TEST_EVENT_2"])
+        self.assertEqual(get_events(endtime="2012-06-01"), ["TEST_EVENT_1"])
+        self.assertEqual(get_events(min_magnitude=7), ["TEST_EVENT_2"])
+        self.assertEqual(get_events(max_magnitude=7), ["TEST_EVENT_1"])
+        self.assertEqual(get_events(min_depth=10, max_depth=20),
+            ["TEST_EVENT_1"])
+        self.assertEqual(get_events(min_latitude=20, max_longitude=-100),
+            ["TEST_EVENT_1"])
+        self.assertEqual(get_events(min_longitude=170, max_longitude=-100),
+            ["TEST_EVENT_1"])
+        self.assertEqual(get_events(magnitude_type="?S"), ["TEST_EVENT_2"])
+        self.assertEqual(get_events(magnitude_type="mb"), ["TEST_EVENT_1"])
+
+        self.assertEqual(get_events(order_by="depth", descending="true"),
+            both[::-1])
+        self.assertEqual(get_events(order_by="latitude"), both[::-1])
+        self.assertEqual(get_events(limit=1), ["TEST_EVENT_1"])
+        self.assertEqual(get_events(limit=1, after="TEST_EVENT_1"),
+            ["TEST_EVENT_2"])
+        # The cursor contains the sort value so it does not depend on the
+        # rows of the previous page.
+        self.assertEqual(get_events(order_by="magnitude", descending="true",
+            limit=1, after=json.dumps([7.4, "TEST_EVENT_2"])),
+            ["TEST_EVENT_1"])
+        self.assertEqual(get_events(order_by="magnitude", descending="true",
+            after=json.dumps([6.2, "TEST_EVENT_1"])), [])
+        self.assertEqual(get_events(order_by="time",
+            after=json.dumps(["2012-06-01T00:00:00", "TEST_EVENT_1"])),
+            ["TEST_EVENT_2"])
+        self.assertEqual(get_events(order_by="magnitude",
+            after=json.dumps([None, "TEST_EVENT_1"])), [])
+
+        self.assertRaises(InvalidParameterError, get_events,
+            order_by="unknown")
+        self.assertRaises(InvalidParameterError, get_events,
+            starttime="yesterday")
+        self.assertRaises(InvalidParameterError, get_events,
+            min_magnitude="big")
+        self.assertRaises(InvalidParameterError, get_events,
+            order_by="time", after="TEST_EVENT_1")
+        self.assertRaises(InvalidParameterError, get_events,
+            order_by="depth", after=json.dumps(["deep", "TEST_EVENT_1"]))
+
     def test_getEventBeachball(self):
         """
         Tests the get beachball mapper.
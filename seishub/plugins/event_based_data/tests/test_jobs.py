@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+A test suite for the asynchronous ingestion of data via jobs.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import json
+import os
+import shutil
+import time
+import unittest
+
+from seishub.core.exceptions import NotFoundError
+
+from seishub.plugins.event_based_data.tests.test_case import \
+    EventBasedDataTestCase
+from seishub.plugins.event_based_data.jobs import JOB_DONE, JOB_RUNNING, \
+    create_job, recover_jobs, run_job, set_job_status, update_job_progress
+from seishub.plugins.event_based_data.table_definitions import \
+    ChannelMetadataObject, FilepathObject, WaveformChannelObject
+
+
+class JobsTestCase(EventBasedDataTestCase):
+    """
+    Test case for the job queue and the jobs mapper.
+    """
+    def _get_job(self, job_id):
+        response = self._send_request("GET", "/event_based_data/jobs",
+            args={"job_id": job_id, "format": "json"})
+        return json.loads(response)["ResultSet"]["Result"][0]
+
+    def test_asynchronousWaveformUpload(self):
+        """
+        Asynchronous uploads return a queued job which ingests the file once
+        it is run.
+        """
+        self._upload_event()
+        waveform_file = os.path.join(self.data_dir, "dis.PFVI..BHE")
+        response = self._send_request("POST", "/event_based_data/waveform",
+            waveform_file, {"event": "example_event", "async": "true",
+            "format": "json"})
+        job = json.loads(response)["ResultSet"]["Result"][0]
+        self.assertEqual(job["status"], "queued")
+        self.assertEqual(job["job_type"], "waveform_file")
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        self.assertEqual(session.query(WaveformChannelObject).count(), 0)
+
+        self.assertTrue(run_job(self.env, job["job_id"]))
+        # A job is only run once.
+        self.assertFalse(run_job(self.env, job["job_id"]))
+
+        job = self._get_job(job["job_id"])
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["errors"], [])
+        self.assertEqual(session.query(WaveformChannelObject).count(), 1)
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, "waveform_data",
+            "example_event")), ["PM.PFVI..BHE-2012_8_27_4"])
+
+    def test_failedAsynchronousUploadIsReported(self):
+        """
+        A failing job has the status failed and reports the error.
+        """
+        self._upload_event()
+        event_file = os.path.join(self.data_dir, "event1.xml")
+        response = self._send_request("POST", "/event_based_data/waveform",
+            event_file, {"event": "example_event", "async": "true",
+            "format": "json"})
+        job_id = json.loads(response)["ResultSet"]["Result"][0]["job_id"]
+        run_job(self.env, job_id)
+
+        job = self._get_job(job_id)
+        self.assertEqual(job["status"], "failed")
+        self.assertEqual(job["failed_count"], 1)
+        self.assertEqual(len(job["errors"]), 1)
+        self.assertTrue("InvalidObjectError" in job["errors"][0]["message"])
+        # The spooled file has been removed.
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, "waveform_data",
+            "example_event")), [])
+
+        # It also shows up in the list of failed jobs.
+        response = self._send_request("GET", "/event_based_data/jobs",
+            args={"status": "failed", "format": "json"})
+        jobs = json.loads(response)["ResultSet"]["Result"]
+        self.assertEqual([_i["job_id"] for _i in jobs], [job_id])
+
+    def test_asynchronousStationIndexing(self):
+        """
+        Indexing a station file in the background.
+        """
+        resp_file = os.path.join(self.data_dir, "RESP.PM.PFVI..BHZ")
+        response = self._send_request("POST", "/event_based_data/station",
+            None, {"index_file": resp_file, "async": "true",
+            "format": "json"})
+        job_id = json.loads(response)["ResultSet"]["Result"][0]["job_id"]
+        run_job(self.env, job_id)
+        self.assertEqual(self._get_job(job_id)["status"], "done")
+        session = self.env.db.session(bind=self.env.db.engine)
+        self.assertEqual(session.query(ChannelMetadataObject).count(), 1)
+
+    def test_rescanOfIndexedFiles(self):
+        """
+        The rescan job only reindexes modified files and reports missing
+        ones.
+        """
+        self._upload_event()
+        waveform_file = os.path.join(self.tempdir, "waveform")
+        resp_file = os.path.join(self.tempdir, "resp")
+        shutil.copy(os.path.join(self.data_dir, "dis.PFVI..BHE"),
+            waveform_file)
+        shutil.copy(os.path.join(self.data_dir, "RESP.PM.PFVI..BHZ"),
+            resp_file)
+        self._send_request("POST", "/event_based_data/waveform", None,
+            {"event": "example_event", "index_file": waveform_file,
+            "tag": "raw", "synthetic": "true"})
+        self._send_request("POST", "/event_based_data/station", None,
+            {"index_file": resp_file})
+
+        def rescan():
+            response = self._send_request("POST", "/event_based_data/jobs",
+                None, {"job_type": "rescan", "format": "json"})
+            job_id = json.loads(response)["ResultSet"]["Result"][0]["job_id"]
+            return self._get_job(job_id)
+
+        # Nothing changed.
+        job = rescan()
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["total_count"], 2)
+        self.assertEqual(job["processed_count"], 2)
+        self.assertEqual(job["errors"], [])
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        filepath = session.query(FilepathObject)\
+            .filter(FilepathObject.filepath == waveform_file).one()
+        old_hash = filepath.md5_hash
+        old_id = session.query(WaveformChannelObject).one().id
+        session.close()
+
+        # Only touch the station file and replace the contents of the
+        # waveform file.
+        new_time = time.time() + 3600
+        os.utime(resp_file, (new_time, new_time))
+        shutil.copy(os.path.join(self.data_dir, "dis.PFVI..BHN"),
+            waveform_file)
+        os.utime(waveform_file, (new_time, new_time))
+        job = rescan()
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["errors"], [])
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        self.assertEqual(session.query(ChannelMetadataObject).count(), 1)
+        waveform = session.query(WaveformChannelObject).one()
+        self.assertNotEqual(waveform.id, old_id)
+        self.assertEqual(waveform.channel.channel, "BHN")
+        self.assertEqual(waveform.event_resource_id, "example_event")
+        self.assertEqual(waveform.tag, "raw")
+        self.assertEqual(waveform.is_synthetic, True)
+        self.assertNotEqual(waveform.filepath.md5_hash, old_hash)
+        session.close()
+
+        # Missing files are reported but kept.
+        os.remove(resp_file)
+        job = rescan()
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["failed_count"], 1)
+        self.assertEqual(job["errors"], [{"filename": resp_file,
+            "message": "The file does not exist anymore."}])
+        session = self.env.db.session(bind=self.env.db.engine)
+        self.assertEqual(session.query(FilepathObject).count(), 2)
+        session.close()
+
+    def test_scrubbingReportsBrokenFiles(self):
+        """
+        The scrub job reports missing, corrupted, and orphaned files and
+        stores the time of the last verification of all intact files.
+        """
+        self._upload_event()
+        for filename in ["dis.PFVI..BHE", "dis.PFVI..BHN"]:
+            self._send_request("POST", "/event_based_data/waveform",
+                os.path.join(self.data_dir, filename),
+                {"event": "example_event"})
+        resp_file = os.path.join(self.tempdir, "resp")
+        shutil.copy(os.path.join(self.data_dir, "RESP.PM.PFVI..BHZ"),
+            resp_file)
+        self._send_request("POST", "/event_based_data/station", None,
+            {"index_file": resp_file})
+
+        event_dir = os.path.join(self.tempdir, "waveform_data",
+            "example_event")
+        corrupted_file = os.path.join(event_dir, "PM.PFVI..BHN-2012_8_27_4")
+        with open(corrupted_file, "ab") as open_file:
+            open_file.write("garbage")
+        orphaned_file = os.path.join(event_dir, "orphan")
+        with open(orphaned_file, "wb") as open_file:
+            open_file.write("orphan")
+        os.remove(resp_file)
+
+        response = self._send_request("POST", "/event_based_data/jobs", None,
+            {"job_type": "scrub", "format": "json"})
+        job_id = json.loads(response)["ResultSet"]["Result"][0]["job_id"]
+        job = self._get_job(job_id)
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["total_count"], 4)
+        self.assertEqual(job["processed_count"], 4)
+        self.assertEqual(job["failed_count"], 3)
+        errors = dict((_i["filename"], _i["message"]) for _i in job["errors"])
+        self.assertEqual(sorted(errors.keys()), sorted([resp_file,
+            corrupted_file, orphaned_file]))
+        self.assertTrue("does not exist" in errors[resp_file])
+        self.assertTrue("corrupted" in errors[corrupted_file])
+        self.assertTrue("not known" in errors[orphaned_file])
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        verified = [_i.filepath for _i in session.query(FilepathObject)
+            if _i.last_verified is not None]
+        self.assertEqual(verified, [os.path.join(event_dir,
+            "PM.PFVI..BHE-2012_8_27_4")])
+        session.close()
+
+    def test_interruptedJobsAreRestartedFromScratch(self):
+        """
+        Jobs running when the server stopped are queued again with their
+        progress and errors reset. Finished jobs are not touched.
+        """
+        job_ids = [create_job(self.env, "rescan", {}) for _ in xrange(2)]
+        for job_id, status in zip(job_ids, (JOB_RUNNING, JOB_DONE)):
+            set_job_status(self.env, job_id, status)
+            session = self.env.db.session(bind=self.env.db.engine)
+            update_job_progress(session, job_id, total_count=3,
+                processed_count=2, failed_count=1,
+                errors=[("file", "Could not be read.")])
+            session.commit()
+            session.close()
+
+        recover_jobs(self.env)
+        job = self._get_job(job_ids[0])
+        self.assertEqual(job["status"], "queued")
+        self.assertEqual(job["started"], None)
+        self.assertEqual([job["total_count"], job["processed_count"],
+            job["failed_count"]], [0, 0, 0])
+        self.assertEqual(job["errors"], [])
+        job = self._get_job(job_ids[1])
+        self.assertEqual(job["status"], "done")
+        self.assertEqual([job["total_count"], job["processed_count"],
+            job["failed_count"]], [3, 2, 1])
+        self.assertEqual(len(job["errors"]), 1)
+
+    def test_unknownJob(self):
+        """
+        Requesting an unknown job raises.
+        """
+        self.assertRaises(NotFoundError, self._send_request, "GET",
+            "/event_based_data/jobs", None, {"job_id": 12345})
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(JobsTestCase, "test"))
+    return suite
+
+
+if __name__ == "__main__":
+    unittest.main(defaultTest="suite")
@@ -20,7 +20,7 @@ import unittest
 from seishub.core.exceptions import InvalidObjectError, DuplicateObjectError, \
     InvalidParameterError
 
-from seishub.plugins.event_based_data import station_mappers
+from seishub.plugins.event_based_data import spatial, station_mappers
 from seishub.plugins.event_based_data.tests.test_case import \
     EventBasedDataTestCase
 from seishub.plugins.event_based_data.table_definitions import FilepathObject,\
@@ -147,6 +147,112 @@ class StationTestCase(EventBasedDataTestCase):
         self.assertEqual(response["elevation_in_m"], None)
         self.assertEqual(response["local_depth_in_m"], None)
 
+    def test_filteringAndPagingStationLists(self):
+        """
+        The station list can be filtered by wildcards, paginated and
+        restricted to some fields.
+        """
+        for filename in ("RESP.PM.PFVI..BHZ", "RESP.IW.TPAW..BHE",
+                "dataless.seed.GR_GEC2.xml"):
+            self._send_request("POST", "/event_based_data/station",
+                os.path.join(self.data_dir, filename))
+
+        def get_stations(**kwargs):
+            kwargs["format"] = "json"
+            response = self._send_request("GET", "/event_based_data/station",
+                args=kwargs)
+            return json.loads(response)["ResultSet"]["Result"]
+
+        def get_ids(**kwargs):
+            return ["%s.%s" % (_i["network"], _i["station"])
+                for _i in get_stations(**kwargs)]
+
+        self.assertEqual(get_ids(), ["GR.GEC2", "IW.TPAW", "PM.PFVI"])
+        self.assertEqual(get_ids(network="PM"), ["PM.PFVI"])
+        self.assertEqual(get_ids(network="?M"), ["PM.PFVI"])
+        self.assertEqual(get_ids(station="*A*"), ["IW.TPAW"])
+        self.assertEqual(get_ids(network="G*", station="GEC?"), ["GR.GEC2"])
+        self.assertEqual(get_ids(network="G_"), [])
+
+        self.assertEqual(get_ids(limit=2), ["GR.GEC2", "IW.TPAW"])
+        self.assertEqual(get_ids(limit=2, after="IW.TPAW"), ["PM.PFVI"])
+        self.assertEqual(get_ids(limit=1, after="GR.GEC2",
+            include_channels="false"), ["IW.TPAW"])
+
+        stations = get_stations(fields="network,station",
+            include_channels="false")
+        self.assertEqual(stations[0], {"network": "GR", "station": "GEC2"})
+        stations = get_stations(fields="station", network="GR")
+        self.assertEqual(sorted(stations[0].keys()), ["channels", "station"])
+        self.assertEqual(sorted(_i["channel"] for _i in
+            stations[0]["channels"]), ["HHE", "HHN", "HHZ"])
+
+        self.assertRaises(InvalidParameterError, get_stations,
+            fields="network,unknown")
+        self.assertRaises(InvalidParameterError, get_stations, after="GR")
+
+    def test_geographicStationQueries(self):
+        """
+        The station list can be restricted to a bounding box or to the
+        stations around a point which are then sorted by their distance.
+        """
+        for filename in ("RESP.PM.PFVI..BHZ", "RESP.IW.TPAW..BHE",
+                "dataless.seed.GR_GEC2.xml"):
+            self._send_request("POST", "/event_based_data/station",
+                os.path.join(self.data_dir, filename))
+
+        def get_stations(**kwargs):
+            kwargs["format"] = "json"
+            response = self._send_request("GET", "/event_based_data/station",
+                args=kwargs)
+            return json.loads(response)["ResultSet"]["Result"]
+
+        def get_ids(**kwargs):
+            return ["%s.%s" % (_i["network"], _i["station"])
+                for _i in get_stations(**kwargs)]
+
+        # Only GR.GEC2 (48.845085, 13.701584) has coordinates.
+        self.assertEqual(get_ids(min_latitude=48, max_latitude=49),
+            ["GR.GEC2"])
+        self.assertEqual(get_ids(min_latitude=49), [])
+        self.assertEqual(get_ids(min_longitude=13, max_longitude=14),
+            ["GR.GEC2"])
+        # Boxes across the date line.
+        self.assertEqual(get_ids(min_longitude=170, max_longitude=-170), [])
+        self.assertEqual(get_ids(min_longitude=10, max_longitude=-170),
+            ["GR.GEC2"])
+
+        stations = get_stations(latitude=48, longitude=13, max_radius=2)
+        self.assertEqual(len(stations), 1)
+        self.assertEqual(stations[0]["station"], "GEC2")
+        distance = stations[0]["distance_in_degree"]
+        self.assertTrue(0.9 < distance < 1.1)
+        self.assertEqual(sorted(_i["channel"] for _i in
+            stations[0]["channels"]), ["HHE", "HHN", "HHZ"])
+        self.assertEqual(get_ids(latitude=48, longitude=13, max_radius=0.5),
+            [])
+        self.assertEqual(get_ids(latitude=48, longitude=13, min_radius=2),
+            [])
+        self.assertEqual(get_ids(latitude=-48, longitude=-167, nearest=5),
+            ["GR.GEC2"])
+        self.assertEqual(get_ids(latitude=48, longitude=13, nearest=1,
+            network="PM"), [])
+        stations = get_stations(latitude=48, longitude=13, nearest=1,
+            fields="station", include_channels="false")
+        self.assertEqual(stations, [{"station": "GEC2",
+            "distance_in_degree": distance}])
+
+        self.assertRaises(InvalidParameterError, get_stations, max_radius=2)
+        self.assertRaises(InvalidParameterError, get_stations, latitude=48)
+        self.assertRaises(InvalidParameterError, get_stations, latitude=91,
+            longitude=13)
+        self.assertRaises(InvalidParameterError, get_stations, latitude=48,
+            longitude=13, nearest=0)
+        self.assertRaises(InvalidParameterError, get_stations, latitude=48,
+            longitude=13, after="GR.GEC2")
+        self.assertRaises(InvalidParameterError, get_stations,
+            min_latitude="north")
+
     def test_XSEEDFileUploading(self):
         """
         Tests the uploading via POST of a XSEED RESP file. This is a rather
@@ -349,6 +455,46 @@ class StationUtilityFunctionsTestCase(unittest.TestCase):
         self.data_dir = os.path.join(os.path.dirname(os.path.abspath(
             inspect.getfile(inspect.currentframe()))), "data")
 
+    def test_greatCircleDistance(self):
+        """
+        Tests the great circle distance in degrees.
+        """
+        distances = spatial.great_circle_distance(0.0, 0.0,
+            [0.0, 0.0, 90.0, 0.0, 45.0], [0.0, 90.0, 0.0, 180.0, 180.0])
+        for distance, expected in zip(distances, [0, 90, 90, 180, 135]):
+            self.assertAlmostEqual(distance, expected)
+        # Across the date line.
+        self.assertAlmostEqual(spatial.great_circle_distance(0.0, 179.5,
+            0.0, -179.5), 1.0)
+
+    def test_stationIndex(self):
+        """
+        Tests the radius and nearest neighbour queries of the spatial index.
+        """
+        index = spatial.StationIndex()
+        self.assertEqual(index.query_radius(0.0, 0.0, 10.0), [])
+        self.assertEqual(index.query_nearest(0.0, 0.0, 1), [])
+        index.update(1, 0.0, 0.0)
+        index.update(2, 0.0, 5.0)
+        index.update(3, 89.0, 0.0)
+        index.update(4, 0.0, -179.0)
+        index.update(5, None, None)
+        self.assertEqual(len(index), 4)
+
+        self.assertEqual(index.query_radius(0.0, 1.0, 4.0), [1, 2])
+        self.assertEqual(index.query_radius(0.0, 1.0, 0.5), [])
+        self.assertEqual(index.query_radius(0.0, 179.0, 3.0), [4])
+        self.assertEqual(index.query_radius(90.0, 120.0, 1.0), [3])
+        self.assertEqual(index.query_nearest(0.0, 4.0, 2), [2, 1])
+        self.assertEqual(index.query_nearest(0.0, 4.0, 10), [2, 1, 3, 4])
+
+        # Moving and removing stations.
+        index.update(2, 0.0, 178.0)
+        self.assertEqual(index.query_radius(0.0, 179.0, 3.0), [2, 4])
+        index.update(4, None, None)
+        self.assertEqual(index.query_nearest(0.0, -179.0, 1), [2])
+        self.assertEqual(len(index), 3)
+
     def test_readSEEDFunction(self):
         """
         Tests the _read_SEED() function. The function expects a StringIO.
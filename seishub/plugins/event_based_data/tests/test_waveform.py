@@ -10,19 +10,50 @@ A test suite for waveform uploading.
     (http://www.gnu.org/copyleft/lesser.html)
 """
 import datetime
+import hashlib
 import json
-from obspy import read
+import numpy as np
+from obspy import read, Trace, UTCDateTime
 import os
+import shutil
+import sqlalchemy
+from sqlalchemy.engine.reflection import Inspector
 from StringIO import StringIO
+import tarfile
+import tempfile
+import threading
+import time
 import unittest
 
-from seishub.core.exceptions import InvalidParameterError, InvalidObjectError
+from seishub.core.exceptions import InternalServerError, \
+    InvalidParameterError, InvalidObjectError, DuplicateObjectError, \
+    NotFoundError
 
 from seishub.plugins.event_based_data.tests.test_case import \
     EventBasedDataTestCase
 from seishub.plugins.event_based_data.table_definitions import FilepathObject,\
     StationObject, ChannelObject, WaveformChannelObject
-from seishub.plugins.event_based_data.util import get_all_tags
+from seishub.plugins.event_based_data import util
+from seishub.plugins.event_based_data.package import \
+    _create_missing_indices
+from seishub.plugins.event_based_data.table_definitions import Base
+from seishub.plugins.event_based_data.cache import LRUCache, \
+    get_waveform_cache
+from seishub.plugins.event_based_data.hash_filter import BloomFilter, \
+    might_be_known
+from seishub.plugins.event_based_data.jobs import get_job_list, run_job
+from seishub.plugins.event_based_data.mseed_index import \
+    MSEEDIndexError, get_overlapping_byte_range, validate_records
+from seishub.plugins.event_based_data.overview import compute_overview, \
+    get_overview_directory, select_level
+from seishub.plugins.event_based_data.waveform_output import \
+    _tempfile_formats, write_trace_to_string, get_tar_archive_size, \
+    iter_tar_archive, iter_binary, iter_sized_file_chunks
+from seishub.plugins.event_based_data.util import get_all_tags, \
+    get_md5_of_file, move_file_on_filesystem, spool_to_filesystem, \
+    write_string_to_filesystem, get_file_etag, set_validators, \
+    is_not_modified, respond_not_modified, parse_range_header, send_file, \
+    stream_response, ChunkProducer
 
 
 class WaveformTestCase(EventBasedDataTestCase):
@@ -114,6 +145,66 @@ class WaveformTestCase(EventBasedDataTestCase):
         self.assertEqual(os.listdir(os.path.join(self.tempdir, "waveform_data",
             "example_event")), ["PM.PFVI..BHE-2012_8_27_4"])
 
+    def test_uploadingMultiComponentFile(self):
+        """
+        All traces of a multicomponent file are added in one go and share the
+        same station and filepath. Already existing channels are reused.
+        """
+        # Upload an event to be able to refer to one.
+        self._upload_event()
+        # Upload one of the components to have an already existing channel.
+        waveform_file = os.path.join(self.data_dir, "dis.PFVI..BHE")
+        self._send_request("POST", "/event_based_data/waveform", waveform_file,
+            {"event": "example_event"})
+
+        st = read(os.path.join(self.data_dir, "dis.PFVI..BH?"))
+        w_file = StringIO()
+        st.write(w_file, format="mseed")
+        w_file.seek(0, 0)
+        self._send_request("POST", "/event_based_data/waveform", w_file,
+            {"event": "example_event", "tag": "multi"})
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        self.assertEqual(session.query(FilepathObject).count(), 2)
+        self.assertEqual(session.query(StationObject).count(), 1)
+        self.assertEqual(session.query(ChannelObject).count(), 3)
+        waveforms = session.query(WaveformChannelObject)\
+            .filter(WaveformChannelObject.tag == "multi").all()
+        self.assertEqual(len(waveforms), 3)
+        self.assertEqual(sorted([_i.channel.channel for _i in waveforms]),
+            ["BHE", "BHN", "BHZ"])
+        self.assertEqual(len(set([_i.filepath_id for _i in waveforms])), 1)
+        # The coordinates extracted from the first SAC file are still set.
+        station = session.query(StationObject).one()
+        self.assertAlmostEqual(station.latitude, 37.132832, 5)
+
+    def test_contentAddressedStorageLayout(self):
+        """
+        With the content addressed layout files are named after their md5
+        checksum and sharded into prefix directories.
+        """
+        self.env.config.set("event_based_data", "storage_layout",
+            "content_addressed")
+        # Upload an event to be able to refer to one.
+        self._upload_event()
+        waveform_file = os.path.join(self.data_dir, "dis.PFVI..BHE")
+        self._send_request("POST", "/event_based_data/waveform", waveform_file,
+            {"event": "example_event"})
+        self.env.config.set("event_based_data", "storage_layout", "named")
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        filepath_object = session.query(FilepathObject).one()
+        md5_hash = filepath_object.md5_hash
+        self.assertEqual(filepath_object.filepath, os.path.join(self.tempdir,
+            "waveform_data", md5_hash[:2], md5_hash[2:4], md5_hash))
+        with open(waveform_file, "rb") as open_file:
+            data = open_file.read()
+        with open(filepath_object.filepath, "rb") as open_file:
+            self.assertEqual(open_file.read(), data)
+        # No leftovers of the spooled file.
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, "waveform_data",
+            "example_event")), [])
+
     def test_settingSyntheticsFlagMarksFileAsSynthetic(self):
         """
         Simple test that checks that a file uploaded with synthetic=true marks
@@ -161,6 +252,64 @@ class WaveformTestCase(EventBasedDataTestCase):
             "/event_based_data/waveform", event_file,
             {"event": "example_event"})
 
+    def test_uploadedMiniSEEDFilesAreValidatedInChunks(self):
+        """
+        The records of uploaded MiniSEED files are decoded a few at a time.
+        """
+        # Upload an event to be able to refer to one.
+        self._upload_event()
+        st = read(os.path.join(self.data_dir, "dis.PFVI..BH?"))
+        waveform_file = os.path.join(self.tempdir, "multi.mseed")
+        st.write(waveform_file, format="mseed", reclen=512)
+        validate_records(waveform_file, chunk_bytes=1024)
+
+        # Incomplete records are detected.
+        truncated_file = os.path.join(self.tempdir, "truncated.mseed")
+        with open(waveform_file, "rb") as open_file:
+            data = open_file.read()
+        with open(truncated_file, "wb") as open_file:
+            open_file.write(data[:-100])
+        self.assertRaises(MSEEDIndexError, validate_records, truncated_file,
+            chunk_bytes=1024)
+
+        self._send_request("POST", "/event_based_data/waveform",
+            waveform_file, {"event": "example_event"})
+        session = self.env.db.session(bind=self.env.db.engine)
+        self.assertEqual(session.query(WaveformChannelObject).count(), 3)
+        self.assertEqual(session.query(FilepathObject).one()
+            .is_managed_by_seishub, True)
+        session.close()
+
+    def test_failedUploadsLeaveNoFilesBehind(self):
+        """
+        Uploads are spooled to the disk before being validated. Rejected
+        uploads must not leave any files behind.
+        """
+        # Upload an event to be able to refer to one.
+        self._upload_event()
+        waveform_file = os.path.join(self.data_dir, "dis.PFVI..BHE")
+        self._send_request("POST", "/event_based_data/waveform", waveform_file,
+            {"event": "example_event"})
+
+        # Uploading the same file again fails as it is a duplicate.
+        self.assertRaises(DuplicateObjectError, self._send_request, "POST",
+            "/event_based_data/waveform", waveform_file,
+            {"event": "example_event"})
+        # Event file is not a waveform file.
+        event_file = os.path.join(self.data_dir, "event1.xml")
+        self.assertRaises(InvalidObjectError, self._send_request, "POST",
+            "/event_based_data/waveform", event_file,
+            {"event": "example_event"})
+
+        # Only the first file is stored.
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, "waveform_data",
+            "example_event")), ["PM.PFVI..BHE-2012_8_27_4"])
+
+        # The checksum of the stored file is known to the duplicate filter.
+        with open(waveform_file, "rb") as open_file:
+            md5_hash = hashlib.md5(open_file.read()).hexdigest()
+        self.assertTrue(might_be_known(self.env, md5_hash))
+
     def test_indexingNonExistantFileFailes(self):
         """
         Attempting to upload a non existent file fails.
@@ -249,6 +398,434 @@ class WaveformTestCase(EventBasedDataTestCase):
         # Also check that the actual data directory has no entries!
         self.assertEqual(os.listdir(self.tempdir), [])
 
+    def test_indexMiniSEEDFile(self):
+        """
+        Indexing only reads the headers of the file. Make sure all
+        information is still extracted for MiniSEED files.
+        """
+        # Upload an event to be able to refer to one.
+        self._upload_event()
+        st = read(os.path.join(self.data_dir, "dis.PFVI..BH?"))
+        waveform_file = os.path.join(self.tempdir, "multi.mseed")
+        st.write(waveform_file, format="mseed")
+        self._send_request("POST", "/event_based_data/waveform", None,
+            {"event": "example_event", "index_file": waveform_file})
+        # Compare to the fully read file.
+        st = read(waveform_file)
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        waveforms = session.query(WaveformChannelObject)\
+            .order_by(WaveformChannelObject.id).all()
+        self.assertEqual(len(waveforms), 3)
+        for waveform, tr in zip(waveforms, st):
+            self.assertEqual(waveform.channel.channel, tr.stats.channel)
+            self.assertEqual(waveform.starttime, tr.stats.starttime.datetime)
+            self.assertEqual(waveform.endtime, tr.stats.endtime.datetime)
+            self.assertAlmostEqual(waveform.sampling_rate,
+                tr.stats.sampling_rate)
+            self.assertEqual(waveform.format, "MSEED")
+        self.assertEqual(session.query(FilepathObject).one()
+            .is_managed_by_seishub, False)
+
+    def test_downloadingSingleTraceOfMultiTraceMiniSEEDFile(self):
+        """
+        The byte ranges of the traces of MiniSEED files are stored so single
+        traces can be read without decoding the whole file.
+        """
+        # Upload an event to be able to refer to one.
+        self._upload_event()
+        st = read(os.path.join(self.data_dir, "dis.PFVI..BH?"))
+        waveform_file = os.path.join(self.tempdir, "multi.mseed")
+        st.write(waveform_file, format="mseed", reclen=512)
+        self._send_request("POST", "/event_based_data/waveform", None,
+            {"event": "example_event", "index_file": waveform_file})
+        st = read(waveform_file)
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        waveforms = session.query(WaveformChannelObject)\
+            .order_by(WaveformChannelObject.id).all()
+        offset = 0
+        for index, waveform in enumerate(waveforms):
+            self.assertEqual(waveform.trace_index, index)
+            # The traces are written one after another.
+            self.assertEqual(waveform.byte_offset, offset)
+            self.assertEqual(waveform.byte_length % 512, 0)
+            offset += waveform.byte_length
+        self.assertEqual(offset, os.path.getsize(waveform_file))
+        session.close()
+
+        for tr in st:
+            data = self._send_request("GET", "/event_based_data/waveform",
+                args={"event": "example_event", "channel_id": tr.id,
+                "format": "mseed"})
+            new_st = read(StringIO(data))
+            self.assertEqual(len(new_st), 1)
+            self.assertEqual(new_st[0].id, tr.id)
+            self.assertEqual(new_st[0].stats.starttime, tr.stats.starttime)
+            np.testing.assert_array_equal(new_st[0].data, tr.data)
+
+    def test_downloadingTimeWindow(self):
+        """
+        Only a time window of a waveform is returned if requested. Of
+        MiniSEED files only the overlapping records are read.
+        """
+        self._upload_event()
+        tr = read(os.path.join(self.data_dir, "dis.PFVI..BHZ"))[0]
+        waveform_file = os.path.join(self.tempdir, "BHZ.mseed")
+        tr.write(waveform_file, format="mseed", reclen=512)
+        self._send_request("POST", "/event_based_data/waveform", None,
+            {"event": "example_event", "index_file": waveform_file})
+        tr = read(waveform_file)[0]
+        starttime = tr.stats.starttime + 10 * tr.stats.delta
+        endtime = tr.stats.starttime + 20 * tr.stats.delta
+
+        data = self._send_request("GET", "/event_based_data/waveform",
+            args={"event": "example_event", "channel_id": tr.id,
+            "format": "mseed", "starttime": str(starttime),
+            "endtime": str(endtime)})
+        new_tr = read(StringIO(data))[0]
+        self.assertEqual(new_tr.stats.starttime, starttime)
+        self.assertEqual(new_tr.stats.endtime, endtime)
+        np.testing.assert_array_equal(new_tr.data, tr.data[10:21])
+
+        # The same with offsets relative to the origin time of the event.
+        origin_time = UTCDateTime(2012, 4, 12, 7, 15, 48, 500000)
+        data = self._send_request("GET", "/event_based_data/waveform",
+            args={"event": "example_event", "channel_id": tr.id,
+            "format": "mseed",
+            "start_offset": str(starttime - origin_time),
+            "end_offset": str(endtime - origin_time)})
+        new_tr = read(StringIO(data))[0]
+        self.assertEqual(new_tr.stats.starttime, starttime)
+        self.assertEqual(new_tr.stats.endtime, endtime)
+
+        # Only the first records have to be read.
+        session = self.env.db.session(bind=self.env.db.engine)
+        waveform = session.query(WaveformChannelObject).one()
+        offset, length = get_overlapping_byte_range(waveform_file,
+            waveform.byte_offset, waveform.byte_length, starttime, endtime)
+        session.close()
+        self.assertEqual(offset, 0)
+        self.assertTrue(length < os.path.getsize(waveform_file))
+
+        # Windows outside the data and invalid windows.
+        self.assertRaises(NotFoundError, self._send_request, "GET",
+            "/event_based_data/waveform", None, {"event": "example_event",
+            "channel_id": tr.id, "starttime": str(tr.stats.endtime + 10)})
+        self.assertRaises(InvalidParameterError, self._send_request, "GET",
+            "/event_based_data/waveform", None, {"event": "example_event",
+            "channel_id": tr.id, "starttime": str(endtime),
+            "endtime": str(starttime)})
+        self.assertRaises(InvalidParameterError, self._send_request, "GET",
+            "/event_based_data/waveform", None, {"event": "example_event",
+            "channel_id": tr.id, "starttime": str(starttime),
+            "start_offset": "10"})
+        self.assertRaises(InvalidParameterError, self._send_request, "GET",
+            "/event_based_data/waveform", None, {"event": "example_event",
+            "channel_id": tr.id, "starttime": str(starttime),
+            "format": "raw"})
+
+    def test_downloadingAsJSON(self):
+        """
+        Tests the compact and the pairs JSON output.
+        """
+        self._upload_event()
+        waveform_file = os.path.join(self.data_dir, "dis.PFVI..BHE")
+        self._send_request("POST", "/event_based_data/waveform",
+            waveform_file, {"event": "example_event"})
+        tr = read(waveform_file)[0]
+
+        data = json.loads(self._send_request("GET",
+            "/event_based_data/waveform", args={"event": "example_event",
+            "channel_id": "PM.PFVI..BHE", "format": "json"}))
+        self.assertEqual(data["channel"], tr.id)
+        self.assertEqual(data["npts"], tr.stats.npts)
+        self.assertEqual(data["sampling_rate"], tr.stats.sampling_rate)
+        self.assertEqual(data["delta"], tr.stats.delta)
+        self.assertEqual(UTCDateTime(data["starttime"]), tr.stats.starttime)
+        np.testing.assert_array_almost_equal(data["data"], tr.data)
+
+        data = json.loads(self._send_request("GET",
+            "/event_based_data/waveform", args={"event": "example_event",
+            "channel_id": "PM.PFVI..BHE", "format": "json",
+            "json_layout": "pairs", "endtime": str(tr.stats.starttime +
+            2 * tr.stats.delta)}))
+        self.assertEqual(data["npts"], 3)
+        self.assertEqual(len(data["data"]), 3)
+        for i, (time, value) in enumerate(data["data"]):
+            self.assertEqual(UTCDateTime(time),
+                tr.stats.starttime + i * tr.stats.delta)
+            self.assertAlmostEqual(value, float(tr.data[i]), 5)
+
+        self.assertRaises(InvalidParameterError, self._send_request, "GET",
+            "/event_based_data/waveform", None, {"event": "example_event",
+            "channel_id": "PM.PFVI..BHE", "format": "json",
+            "json_layout": "unknown"})
+
+    def test_downloadingAsBinaryArrays(self):
+        """
+        Tests the npy and the raw floating point output.
+        """
+        self._upload_event()
+        waveform_file = os.path.join(self.data_dir, "dis.PFVI..BHE")
+        self._send_request("POST", "/event_based_data/waveform",
+            waveform_file, {"event": "example_event"})
+        tr = read(waveform_file)[0]
+        args = {"event": "example_event", "channel_id": "PM.PFVI..BHE"}
+
+        args["format"] = "npy"
+        data = np.load(StringIO(self._send_request("GET",
+            "/event_based_data/waveform", args=args)))
+        self.assertEqual(data.dtype, tr.data.dtype)
+        np.testing.assert_array_equal(data, tr.data)
+
+        for format, dtype in (("float32", "<f4"), ("float64", "<f8")):
+            args["format"] = format
+            data = np.frombuffer(self._send_request("GET",
+                "/event_based_data/waveform", args=args), dtype=dtype)
+            np.testing.assert_array_equal(data, tr.data.astype(dtype))
+
+    def test_downloadingAllWaveformsOfAnEvent(self):
+        """
+        All waveform files of an event can be downloaded as one tar archive.
+        """
+        self._upload_event()
+        originals = {}
+        for component, args in (("BHE", {}), ("BHN", {"tag": "filtered"}),
+                ("BHZ", {"synthetic": "true"})):
+            waveform_file = os.path.join(self.data_dir,
+                "dis.PFVI..%s" % component)
+            args["event"] = "example_event"
+            self._send_request("POST", "/event_based_data/waveform",
+                waveform_file, args)
+            with open(waveform_file, "rb") as open_file:
+                originals[component] = open_file.read()
+
+        def get_archive(**kwargs):
+            kwargs["event"] = "example_event"
+            data = self._send_request("GET",
+                "/event_based_data/waveform/getArchive", args=kwargs)
+            archive = tarfile.open(fileobj=StringIO(data))
+            return dict((_i.name, archive.extractfile(_i).read())
+                for _i in archive.getmembers())
+
+        files = get_archive()
+        self.assertEqual(len(files), 3)
+        self.assertEqual(sorted(files.values()), sorted(originals.values()))
+        self.assertEqual(len([_i for _i in files
+            if _i.startswith("filtered/")]), 1)
+
+        files = get_archive(tag="filtered")
+        self.assertEqual(files.values(), [originals["BHN"]])
+        files = get_archive(synthetic="true")
+        self.assertEqual(files.values(), [originals["BHZ"]])
+        files = get_archive(synthetic="false", stations="PM.PFVI,XX.YY")
+        self.assertEqual(sorted(files.values()),
+            sorted([originals["BHE"], originals["BHN"]]))
+        self.assertEqual(get_archive(stations="XX.YY"), {})
+
+        # SAC files cannot be concatenated.
+        self.assertRaises(InvalidParameterError, self._send_request, "GET",
+            "/event_based_data/waveform/getArchive",
+            args={"event": "example_event", "format": "mseed"})
+        self.assertRaises(InvalidParameterError, self._send_request, "GET",
+            "/event_based_data/waveform/getArchive",
+            args={"event": "example_event", "stations": "PFVI"})
+
+    def test_downloadingOverviews(self):
+        """
+        Overviews are computed in the background and return the coarsest
+        level with at least the requested number of bins.
+        """
+        self._upload_event()
+        waveform_file = os.path.join(self.data_dir, "dis.PFVI..BHE")
+        self._send_request("POST", "/event_based_data/waveform",
+            waveform_file, {"event": "example_event"})
+        tr = read(waveform_file)[0]
+
+        jobs = [_i for _i in get_job_list(self.env, status="queued")
+            if _i["job_type"] == "overviews"]
+        self.assertEqual(len(jobs), 1)
+        run_job(self.env, jobs[0]["job_id"])
+        overview_files = []
+        for _, _, filenames in os.walk(get_overview_directory(self.env)):
+            overview_files.extend(filenames)
+        self.assertEqual(len(overview_files), 1)
+
+        def get_overview(**kwargs):
+            kwargs.update({"event": "example_event",
+                "channel_id": "PM.PFVI..BHE", "format": "overview"})
+            return json.loads(self._send_request("GET",
+                "/event_based_data/waveform", args=kwargs))
+
+        overview = get_overview(width=100)
+        level = overview["level"]
+        self.assertTrue(level >= 4)
+        self.assertTrue(100 <= overview["npts"] <= 200)
+        self.assertEqual(overview["samples_per_bin"], 2 ** level)
+        self.assertEqual(UTCDateTime(overview["starttime"]),
+            tr.stats.starttime)
+        self.assertEqual(overview["min"][1],
+            tr.data[2 ** level:2 ** (level + 1)].min())
+        self.assertEqual(overview["max"][-1],
+            tr.data[(overview["npts"] - 1) * 2 ** level:].max())
+
+        # Short windows return the samples themselves.
+        starttime = tr.stats.starttime + 10
+        overview = get_overview(width=1000, starttime=starttime,
+            endtime=starttime + 10)
+        self.assertEqual(overview["level"], 0)
+        self.assertEqual(overview["min"], overview["max"])
+        np.testing.assert_array_equal(overview["min"],
+            tr.slice(starttime, starttime + 10).data)
+
+        self.assertRaises(InvalidParameterError, get_overview, width=0)
+
+    def test_overviewsOfIndexedFilesAreComputedOnRequest(self):
+        """
+        Indexing does not decode the files to compute their overviews. They
+        are computed on the first request instead.
+        """
+        self._upload_event()
+        directory = os.path.join(self.tempdir, "archive")
+        os.makedirs(directory)
+        shutil.copy(os.path.join(self.data_dir, "dis.PFVI..BHZ"), directory)
+        self._send_request("POST", "/event_based_data/waveform", None,
+            {"event": "example_event", "index_directory": directory})
+        self.assertEqual([_i for _i in get_job_list(self.env,
+            status="queued") if _i["job_type"] == "overviews"], [])
+
+        def get_overview_files():
+            overview_files = []
+            for _, _, filenames in os.walk(get_overview_directory(self.env)):
+                overview_files.extend(filenames)
+            return overview_files
+
+        self.assertEqual(get_overview_files(), [])
+        overview = json.loads(self._send_request("GET",
+            "/event_based_data/waveform", args={"event": "example_event",
+            "channel_id": "PM.PFVI..BHZ", "format": "overview",
+            "width": 100}))
+        self.assertTrue(overview["level"] > 0)
+        self.assertEqual(len(get_overview_files()), 1)
+
+    def test_overviewPyramid(self):
+        """
+        Every level has the extrema of the bins of the level below.
+        """
+        data = np.random.randn(10001)
+        levels = compute_overview(data)
+        self.assertEqual(min(levels), 4)
+        self.assertEqual(len(levels[4][0]), 626)
+        self.assertEqual(levels[4][0][-1], data[-1])
+        self.assertEqual(levels[4][1][0], data[:16].max())
+        for level in sorted(levels)[1:]:
+            self.assertEqual(levels[level][0].min(), data.min())
+            self.assertEqual(levels[level][1].max(), data.max())
+        self.assertTrue(len(levels[max(levels)][0]) <= 64)
+        self.assertEqual(select_level(levels, 10001, 100), 6)
+        self.assertEqual(select_level(levels, 10001, 1000), None)
+        self.assertEqual(compute_overview(data[:50]), {})
+
+    def test_downloadsAreCached(self):
+        """
+        Repeated downloads are served from the cache.
+        """
+        self._upload_event()
+        waveform_file = os.path.join(self.data_dir, "dis.PFVI..BHE")
+        self._send_request("POST", "/event_based_data/waveform",
+            waveform_file, {"event": "example_event"})
+        get_waveform_cache(self.env).clear()
+
+        def get_statistics():
+            response = self._send_request("GET",
+                "/event_based_data/waveform/getCacheStatistics",
+                args={"format": "json"})
+            return json.loads(response)["ResultSet"]["Result"][0]
+
+        before = get_statistics()
+        args = {"event": "example_event", "channel_id": "PM.PFVI..BHE",
+            "format": "mseed"}
+        data = self._send_request("GET", "/event_based_data/waveform",
+            args=args)
+        after = get_statistics()
+        # The converted file and the decoded trace have been cached.
+        self.assertEqual(after["count"], 2)
+        self.assertEqual(after["hits"], before["hits"])
+
+        self.assertEqual(self._send_request("GET",
+            "/event_based_data/waveform", args=args), data)
+        # The decoded trace is reused for other formats.
+        args["format"] = "npy"
+        self._send_request("GET", "/event_based_data/waveform", args=args)
+        statistics = get_statistics()
+        self.assertEqual(statistics["hits"], after["hits"] + 2)
+        self.assertEqual(statistics["misses"], after["misses"])
+
+    def test_singleTracesOfOtherFormatsAreFoundByIndex(self):
+        """
+        Only MiniSEED files have byte ranges. Traces of other files are
+        found by their position in the file.
+        """
+        self._upload_event()
+        self._send_request("POST", "/event_based_data/waveform",
+            os.path.join(self.data_dir, "dis.PFVI..BHE"),
+            {"event": "example_event"})
+        session = self.env.db.session(bind=self.env.db.engine)
+        waveform = session.query(WaveformChannelObject).one()
+        self.assertEqual(waveform.trace_index, 0)
+        self.assertEqual(waveform.byte_offset, None)
+        self.assertEqual(waveform.byte_length, None)
+        session.close()
+
+    def test_indexDirectory(self):
+        """
+        Indexes a whole directory. Invalid files and duplicates are reported
+        per file and do not affect the other files.
+        """
+        # Upload an event to be able to refer to one.
+        self._upload_event()
+        directory = os.path.join(self.tempdir, "archive")
+        os.makedirs(os.path.join(directory, "sub"))
+        for filename in ["dis.PFVI..BHE", "dis.PFVI..BHN", "event1.xml"]:
+            shutil.copy(os.path.join(self.data_dir, filename), directory)
+        shutil.copy(os.path.join(self.data_dir, "dis.PFVI..BHZ"),
+            os.path.join(directory, "sub"))
+        # A duplicate of an already existing file.
+        shutil.copy(os.path.join(self.data_dir, "dis.PFVI..BHE"),
+            os.path.join(directory, "sub", "duplicate"))
+
+        response = self._send_request("POST", "/event_based_data/waveform",
+            None, {"event": "example_event", "index_directory": directory,
+            "format": "json"})
+        job = json.loads(response)["ResultSet"]["Result"][0]
+        self.assertEqual(job["status"], "done")
+        self.assertEqual(job["total_count"], 5)
+        self.assertEqual(job["processed_count"], 5)
+        self.assertEqual(job["failed_count"], 2)
+        # The files are processed in parallel so either of the identical files
+        # can be the duplicate.
+        errors = sorted([os.path.basename(_i["filename"])
+            for _i in job["errors"]])
+        self.assertTrue(errors in (["dis.PFVI..BHE", "event1.xml"],
+            ["duplicate", "event1.xml"]))
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        self.assertEqual(session.query(FilepathObject).count(), 3)
+        waveforms = session.query(WaveformChannelObject).all()
+        self.assertEqual(sorted([_i.channel.channel for _i in waveforms]),
+            ["BHE", "BHN", "BHZ"])
+        for filepath in session.query(FilepathObject):
+            self.assertEqual(filepath.is_managed_by_seishub, False)
+
+        # Indexing again only restricted to one file results in a duplicate.
+        response = self._send_request("POST", "/event_based_data/waveform",
+            None, {"event": "example_event", "index_directory": directory,
+            "pattern": "*BHN", "format": "json"})
+        job = json.loads(response)["ResultSet"]["Result"][0]
+        self.assertEqual(job["total_count"], 1)
+        self.assertEqual(job["failed_count"], 1)
+
     def test_settingTags(self):
         """
         Tests if setting the tags works.
@@ -385,6 +962,49 @@ class WaveformTestCase(EventBasedDataTestCase):
             "station": "PFVI",
             "tag": "modified"}, response2)
 
+    def test_filteringAndPagingWaveformLists(self):
+        """
+        The waveform lists can be filtered and are paginated by the id of the
+        waveforms.
+        """
+        self._upload_event()
+        for component, args in (("BHE", {}), ("BHN", {"tag": "filtered"}),
+                ("BHZ", {"synthetic": "true"})):
+            args["event"] = "example_event"
+            self._send_request("POST", "/event_based_data/waveform",
+                os.path.join(self.data_dir, "dis.PFVI..%s" % component),
+                args)
+
+        def get_channels(**kwargs):
+            kwargs.update({"event": "example_event", "format": "json"})
+            response = self._send_request("GET", "/event_based_data/waveform",
+                args=kwargs)
+            return [_i["channel"] for _i in
+                json.loads(response)["ResultSet"]["Result"]]
+
+        self.assertEqual(get_channels(), ["BHE", "BHN", "BHZ"])
+        self.assertEqual(get_channels(station_id="PM.PFVI"),
+            ["BHE", "BHN", "BHZ"])
+        self.assertEqual(get_channels(tag=""), ["BHE", "BHZ"])
+        self.assertEqual(get_channels(tag="filtered"), ["BHN"])
+        self.assertEqual(get_channels(synthetic="true"), ["BHZ"])
+        self.assertEqual(get_channels(synthetic="false"), ["BHE", "BHN"])
+        self.assertEqual(get_channels(channel="BH?"), ["BHE", "BHN", "BHZ"])
+        self.assertEqual(get_channels(channel="*Z"), ["BHZ"])
+        self.assertEqual(get_channels(channel="BH_"), [])
+        self.assertEqual(get_channels(starttime="2012-08-27T05:00:00",
+            endtime="2012-08-27T05:10:00"), ["BHE", "BHN", "BHZ"])
+        self.assertEqual(get_channels(starttime="2012-08-28T00:00:00"), [])
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        ids = [_i[0] for _i in session.query(WaveformChannelObject.id)
+            .order_by(WaveformChannelObject.id)]
+        session.close()
+        self.assertEqual(get_channels(limit=2), ["BHE", "BHN"])
+        self.assertEqual(get_channels(limit=2, after=ids[1]), ["BHZ"])
+        self.assertRaises(InvalidParameterError, get_channels, limit=0)
+        self.assertRaises(InvalidParameterError, get_channels, after="a")
+
     def test_getWaveformFile(self):
         """
         Tests downloading a waveform file.
@@ -500,8 +1120,534 @@ class WaveformTestCase(EventBasedDataTestCase):
         self.assertEqual(data, old_data)
 
 
+class DatabaseUpgradeTestCase(unittest.TestCase):
+    """
+    Test case for the indices created in already existing databases.
+    """
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine("sqlite://")
+        # The state after the checksums got a non-unique index.
+        Base.metadata.create_all(self.engine)
+        self.engine.execute("DROP INDEX ix_ebd_filepaths_md5_hash_unique")
+        self.engine.execute("CREATE INDEX ix_ebd_filepaths_md5_hash ON "
+            "ebd_filepaths (md5_hash)")
+
+    def _get_indexes(self):
+        return sorted((_i["name"], bool(_i["unique"])) for _i in
+            Inspector.from_engine(self.engine).get_indexes("ebd_filepaths")
+            if _i["column_names"] == ["md5_hash"])
+
+    def _add_filepath(self, filepath, md5_hash):
+        self.engine.execute(FilepathObject.__table__.insert(), {
+            "filepath": filepath, "size": 1,
+            "mtime": datetime.datetime.now(), "md5_hash": md5_hash,
+            "is_managed_by_seishub": True})
+
+    def test_uniqueChecksumIndexReplacesOldIndex(self):
+        """
+        The unique index of the checksums replaces the non-unique one.
+        """
+        self._add_filepath("/a", "abc")
+        _create_missing_indices(self.engine)
+        self.assertEqual(self._get_indexes(),
+            [("ix_ebd_filepaths_md5_hash_unique", True)])
+        self.assertRaises(sqlalchemy.exc.IntegrityError, self._add_filepath,
+            "/b", "abc")
+
+    def test_duplicateChecksumsAreReported(self):
+        """
+        Existing duplicate checksums are reported instead of failing. The
+        index is created once they have been removed.
+        """
+        self._add_filepath("/a", "abc")
+        self._add_filepath("/b", "abc")
+        errors = []
+
+        class Log(object):
+            def error(self, msg):
+                errors.append(msg)
+
+        _create_missing_indices(self.engine, Log())
+        self.assertEqual(len(errors), 1)
+        self.assertTrue("ix_ebd_filepaths_md5_hash_unique" in errors[0])
+        self.assertEqual(self._get_indexes(),
+            [("ix_ebd_filepaths_md5_hash", False)])
+
+        self.engine.execute(FilepathObject.__table__.delete().where(
+            FilepathObject.filepath == "/b"))
+        _create_missing_indices(self.engine, Log())
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self._get_indexes(),
+            [("ix_ebd_filepaths_md5_hash_unique", True)])
+
+
+class HashFilterTestCase(unittest.TestCase):
+    """
+    Test case for the membership filter used for duplicate detection.
+    """
+    def test_bloomFilter(self):
+        """
+        Added checksums are always contained, the false positive rate stays
+        close to the desired one.
+        """
+        bloom_filter = BloomFilter(1000, error_rate=0.01)
+        hashes = [hashlib.md5(str(_i)).hexdigest() for _i in xrange(1000)]
+        for md5_hash in hashes:
+            bloom_filter.add(md5_hash)
+        for md5_hash in hashes:
+            self.assertTrue(md5_hash in bloom_filter)
+        false_positives = sum(1 for _i in xrange(1000, 11000)
+            if hashlib.md5(str(_i)).hexdigest() in bloom_filter)
+        self.assertTrue(false_positives < 300)
+
+
+class FileSystemUtilityFunctionsTestCase(unittest.TestCase):
+    """
+    Test case for the functions placing files on the filesystem.
+    """
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_placingFilesNeverOverwrites(self):
+        """
+        Files placed at an existing filename get an increasing integer
+        appended. No temporary files are left behind.
+        """
+        filename = os.path.join(self.tempdir, "sub", "file")
+        filenames = [write_string_to_filesystem(filename, str(_i))
+            for _i in xrange(3)]
+        self.assertEqual(filenames, [filename, filename + ".1",
+            filename + ".2"])
+        for i, filename in enumerate(filenames):
+            with open(filename, "rb") as open_file:
+                self.assertEqual(open_file.read(), str(i))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir,
+            "sub"))), ["file", "file.1", "file.2"])
+
+    def test_spoolingCalculatesChecksum(self):
+        """
+        Spooling a file-like object writes it to a temporary file and returns
+        its checksum and size.
+        """
+        data = "1234567890" * 1000
+        filename, md5_hash, size = spool_to_filesystem(StringIO(data),
+            self.tempdir, chunk_size=333)
+        self.assertEqual(md5_hash, hashlib.md5(data).hexdigest())
+        self.assertEqual(size, len(data))
+        self.assertEqual(get_md5_of_file(filename), (md5_hash, size))
+        self.assertEqual(os.path.dirname(filename), self.tempdir)
+        final_filename = move_file_on_filesystem(filename,
+            os.path.join(self.tempdir, "final"))
+        self.assertEqual(os.listdir(self.tempdir), ["final"])
+        with open(final_filename, "rb") as open_file:
+            self.assertEqual(open_file.read(), data)
+
+    def test_concurrentDirectorySyncsAreBatched(self):
+        """
+        Files placed in the same directory while it is being synced share
+        the next fsync of the directory.
+        """
+        fsync = os.fsync
+        syncs = []
+
+        def slow_fsync(fd):
+            syncs.append(fd)
+            time.sleep(0.2)
+            fsync(fd)
+
+        threads = [threading.Thread(target=write_string_to_filesystem,
+            args=(os.path.join(self.tempdir, "file"), str(_i)))
+            for _i in xrange(10)]
+        os.fsync = slow_fsync
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            os.fsync = fsync
+        self.assertEqual(len(os.listdir(self.tempdir)), 10)
+        # Every file is synced on its own but the directory only a few
+        # times.
+        self.assertTrue(10 < len(syncs) < 20)
+        self.assertEqual(util._directory_syncs, {})
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    """
+    Test case for the cache of decoded and converted waveforms.
+    """
+    def test_leastRecentlyUsedValuesAreEvicted(self):
+        """
+        The cache never exceeds its size and evicts the least recently used
+        values first.
+        """
+        cache = LRUCache(10)
+        cache.put("a", "a", 4)
+        cache.put("b", "b", 4)
+        self.assertEqual(cache.get("a"), "a")
+        cache.put("c", "c", 4)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "a")
+        self.assertEqual(cache.get("c"), "c")
+        self.assertEqual(cache.size, 8)
+        # Values bigger than the cache are never added.
+        self.assertFalse(cache.put("d", "d", 11))
+        statistics = cache.get_statistics()
+        self.assertEqual(statistics["hits"], 3)
+        self.assertEqual(statistics["misses"], 1)
+        self.assertEqual(statistics["evictions"], 1)
+        self.assertEqual(statistics["count"], 2)
+
+    def test_invalidation(self):
+        """
+        All values of a file can be removed at once.
+        """
+        cache = LRUCache(100)
+        cache.put((1, "mseed"), "a", 1)
+        cache.put((1, "trace"), "b", 1)
+        cache.put((2, "trace"), "c", 1)
+        cache.invalidate(lambda key: key[0] == 1)
+        self.assertEqual(cache.get_statistics()["count"], 1)
+        self.assertEqual(cache.size, 1)
+        self.assertEqual(cache.get((2, "trace")), "c")
+
+
+class ConditionalRequestTestCase(unittest.TestCase):
+    """
+    Test case for the handling of conditional requests.
+    """
+    class Request(object):
+        def __init__(self, **headers):
+            self.received_headers = dict((key.replace("_", "-"), value)
+                for key, value in headers.iteritems())
+            self.headers = {}
+            self.code = 200
+
+        def getHeader(self, name):
+            return self.received_headers.get(name, None)
+
+        def setHeader(self, name, value):
+            self.headers[name] = value
+
+        def setResponseCode(self, code):
+            self.code = code
+
+    def test_validators(self):
+        """
+        ETags are derived from the checksum and the variant of the content.
+        """
+        md5_hash = "d41d8cd98f00b204e9800998ecf8427e"
+        self.assertEqual(get_file_etag(md5_hash), '"%s"' % md5_hash)
+        self.assertNotEqual(get_file_etag(md5_hash, 1, "mseed"),
+            get_file_etag(md5_hash, 1, "sac"))
+
+        request = self.Request()
+        set_validators(request, '"abc"', datetime.datetime(2013, 1, 1))
+        self.assertEqual(request.headers["etag"], '"abc"')
+        self.assertTrue(request.headers["last-modified"].endswith("GMT"))
+
+    def test_conditionalRequests(self):
+        """
+        If-None-Match takes precedence over If-Modified-Since.
+        """
+        mtime = datetime.datetime(2013, 1, 1, 12, 0, 0, 500000)
+        request = self.Request()
+        set_validators(request, '"abc"', mtime)
+        last_modified = request.headers["last-modified"]
+
+        self.assertFalse(is_not_modified(self.Request(), '"abc"', mtime))
+        self.assertTrue(is_not_modified(self.Request(
+            if_none_match='"xyz", "abc"'), '"abc"', mtime))
+        self.assertTrue(is_not_modified(self.Request(
+            if_none_match='W/"abc"'), '"abc"', mtime))
+        self.assertTrue(is_not_modified(self.Request(if_none_match='*'),
+            '"abc"', mtime))
+        self.assertFalse(is_not_modified(self.Request(
+            if_none_match='"xyz"', if_modified_since=last_modified),
+            '"abc"', mtime))
+        self.assertTrue(is_not_modified(self.Request(
+            if_modified_since=last_modified), '"abc"', mtime))
+        self.assertFalse(is_not_modified(self.Request(
+            if_modified_since=last_modified), '"abc"',
+            mtime + datetime.timedelta(seconds=1)))
+        self.assertFalse(is_not_modified(self.Request(
+            if_modified_since="invalid"), '"abc"', mtime))
+
+        request = self.Request()
+        self.assertEqual(respond_not_modified(request), "")
+        self.assertEqual(request.code, 304)
+
+    def test_parsingRangeHeaders(self):
+        """
+        Only single byte ranges are supported.
+        """
+        self.assertEqual(parse_range_header(None, 100), None)
+        self.assertEqual(parse_range_header("bytes=0-9", 100), (0, 9))
+        self.assertEqual(parse_range_header("bytes=90-", 100), (90, 99))
+        self.assertEqual(parse_range_header("bytes=90-200", 100), (90, 99))
+        self.assertEqual(parse_range_header("bytes=-10", 100), (90, 99))
+        self.assertEqual(parse_range_header("bytes=-200", 100), (0, 99))
+        self.assertEqual(parse_range_header("bytes=100-", 100), False)
+        self.assertEqual(parse_range_header("bytes=-0", 100), False)
+        self.assertEqual(parse_range_header("bytes=0-1,5-6", 100), None)
+        self.assertEqual(parse_range_header("bytes=9-0", 100), None)
+        self.assertEqual(parse_range_header("items=0-9", 100), None)
+        self.assertEqual(parse_range_header("bytes=a-b", 100), None)
+
+    def test_rangeRequests(self):
+        """
+        Byte ranges of files are answered with 206 Partial Content.
+        """
+        data = "".join(chr(_i % 256) for _i in xrange(3000))
+        tempdir = tempfile.mkdtemp()
+        filename = os.path.join(tempdir, "file")
+        try:
+            with open(filename, "wb") as open_file:
+                open_file.write(data)
+
+            request = self.Request()
+            self.assertEqual(send_file(request, filename, '"abc"'), data)
+            self.assertEqual(request.code, 200)
+            self.assertEqual(request.headers["accept-ranges"], "bytes")
+            self.assertEqual(request.headers["content-length"], "3000")
+
+            request = self.Request(range="bytes=1000-2499")
+            self.assertEqual(send_file(request, filename, '"abc"'),
+                data[1000:2500])
+            self.assertEqual(request.code, 206)
+            self.assertEqual(request.headers["content-range"],
+                "bytes 1000-2499/3000")
+            self.assertEqual(request.headers["content-length"], "1500")
+
+            # The range is ignored if the file has changed.
+            request = self.Request(range="bytes=1000-", if_range='"xyz"')
+            self.assertEqual(send_file(request, filename, '"abc"'), data)
+            self.assertEqual(request.code, 200)
+
+            request = self.Request(range="bytes=5000-")
+            self.assertEqual(send_file(request, filename, '"abc"'), "")
+            self.assertEqual(request.code, 416)
+            self.assertEqual(request.headers["content-range"], "bytes */3000")
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class WaveformOutputTestCase(unittest.TestCase):
+    """
+    Test case for the conversion of traces to waveform formats.
+    """
+    def setUp(self):
+        self.data_dir = os.path.join(os.path.dirname(os.path.abspath(
+            __file__)), "data")
+
+    def test_conversionFallsBackToTemporaryFiles(self):
+        """
+        Formats whose writers cannot write to memory are written to
+        temporary files. This is remembered for later conversions.
+        """
+        tr = read(os.path.join(self.data_dir, "dis.PFVI..BHE"))[0]
+        for format in ("MSEED", "SAC"):
+            data = write_trace_to_string(tr, format)
+            new_tr = read(StringIO(data))[0]
+            np.testing.assert_array_almost_equal(new_tr.data, tr.data)
+
+        writes = []
+
+        class FileOnlyTrace(Trace):
+            def write(self, filename, format):
+                writes.append(filename)
+                if not isinstance(filename, basestring):
+                    # Modify the trace before failing.
+                    self.data[:] = 0
+                    raise TypeError("Can only write to files.")
+                Trace.write(self, filename, format)
+
+        # GSE2 can only store integers.
+        data = tr.data.astype(np.int32)
+        tr = FileOnlyTrace(data=data.copy(), header=tr.stats)
+        try:
+            for _ in xrange(2):
+                new_tr = read(StringIO(write_trace_to_string(tr, "GSE2")))[0]
+                # The temporary file is written from the untouched data.
+                np.testing.assert_array_equal(new_tr.data, data)
+            self.assertTrue("GSE2" in _tempfile_formats)
+            # The in-memory conversion is only attempted once.
+            self.assertEqual(len(writes), 3)
+            self.assertFalse(isinstance(writes[0], basestring))
+        finally:
+            _tempfile_formats.discard("GSE2")
+
+        class FailingTrace(Trace):
+            def write(self, filename, format):
+                raise ValueError("Data type not supported.")
+
+        # Other errors are raised and not taken as a missing support of
+        # file-like objects.
+        tr = FailingTrace(data=data.copy(), header=tr.stats)
+        self.assertRaises(ValueError, write_trace_to_string, tr, "GSE2")
+        self.assertFalse("GSE2" in _tempfile_formats)
+
+    def test_binaryArraysAreStreamed(self):
+        """
+        Binary arrays are written to the request chunk by chunk by a
+        producer paused whenever the transport's buffer is full. Requests
+        that cannot be written to get the whole data returned.
+        """
+        from twisted.internet import error
+        from twisted.python import threadable
+
+        array = np.arange(1000, dtype="<f8")
+        chunks = list(iter_binary(array, "npy", chunk_bytes=1000))
+        # The data chunks reference the array.
+        self.assertTrue(all(isinstance(_i, buffer) for _i in chunks[1:]))
+        expected = "".join(str(_i) for _i in chunks)
+        self.assertEqual(np.load(StringIO(expected)).tolist(),
+            array.tolist())
+
+        class Request(object):
+            """
+            Pauses the producer once 2000 bytes are buffered.
+            """
+            def __init__(self):
+                self.chunks = []
+                self.buffered = 0
+                self.producer = None
+
+            def registerProducer(self, producer, streaming):
+                self.producer = producer
+
+            def unregisterProducer(self):
+                self.producer = None
+
+            def write(self, data):
+                self.chunks.append(data)
+                self.buffered += len(data)
+                if self.buffered >= 2000:
+                    self.producer.pauseProducing()
+
+        request = Request()
+        producer = ChunkProducer(request,
+            iter_binary(array, "npy", chunk_bytes=1000))
+        results = []
+        producer.start().addBoth(results.append)
+        # Nothing more is produced until the buffer has been drained.
+        self.assertEqual(len(request.chunks), 3)
+        self.assertEqual(results, [])
+        while not results:
+            request.buffered = 0
+            producer.resumeProducing()
+            self.assertTrue(request.buffered <= 2000)
+        self.assertEqual(results, [None])
+        self.assertEqual(request.producer, None)
+        self.assertTrue(all(isinstance(_i, str) and len(_i) <= 1000
+            for _i in request.chunks))
+        self.assertEqual("".join(request.chunks), expected)
+
+        # Lost connections stop the producer and close the chunks.
+        closed = []
+
+        def iter_chunks():
+            try:
+                while True:
+                    yield "x" * 1000
+            finally:
+                closed.append(True)
+
+        request = Request()
+        results = []
+        producer = ChunkProducer(request, iter_chunks())
+        producer.start().addBoth(results.append)
+        producer.stopProducing()
+        self.assertTrue(results[0].check(error.ConnectionLost))
+        self.assertEqual(closed, [True])
+        self.assertEqual(request.producer, None)
+
+        # The reactor thread must never be blocked.
+        io_thread = threadable.ioThread
+        threadable.registerAsIOThread()
+        try:
+            self.assertRaises(InternalServerError, stream_response,
+                Request(), chunks)
+        finally:
+            threadable.ioThread = io_thread
+
+        self.assertEqual(stream_response(object(),
+            iter_binary(array, "float64", chunk_bytes=1000)),
+            array.tostring())
+
+    def test_tarArchivesAreStreamed(self):
+        """
+        Tar archives are streamed in chunks and have a predictable size even
+        if a file is shorter than announced.
+        """
+        filename = os.path.join(self.data_dir, "event1.xml")
+        with open(filename, "rb") as open_file:
+            data = open_file.read()
+        members = [(filename, "event1.xml", len(data), 0),
+            (filename, "%s/truncated.xml" % ("x" * 120), len(data) + 1000,
+                0)]
+        chunks = list(iter_tar_archive(members, chunk_bytes=1000))
+        # The files are not read at once.
+        self.assertTrue(len(chunks) > 10)
+        archive_data = "".join(chunks)
+        self.assertEqual(len(archive_data), get_tar_archive_size(members))
+        archive = tarfile.open(fileobj=StringIO(archive_data))
+        names = archive.getnames()
+        self.assertEqual(names, ["event1.xml", members[1][1]])
+        self.assertEqual(archive.extractfile(names[0]).read(), data)
+        self.assertEqual(archive.extractfile(names[1]).read(),
+            data + "\0" * 1000)
+
+    def test_filesRemovedAfterTheirStatArePadded(self):
+        """
+        Files removed after their size has been determined are sent as
+        zeros so the announced length of the response stays correct.
+        """
+        tempdir = tempfile.mkdtemp()
+        try:
+            filenames = []
+            for i in xrange(2):
+                filename = os.path.join(tempdir, "file%i" % i)
+                with open(filename, "wb") as open_file:
+                    open_file.write(str(i) * 2500)
+                filenames.append(filename)
+            sizes = [os.stat(_i).st_size for _i in filenames]
+            os.remove(filenames[1])
+
+            data = "".join(iter_sized_file_chunks(filenames[1], sizes[1],
+                chunk_bytes=1000))
+            self.assertEqual(data, "\0" * 2500)
+            # Longer files are cut.
+            data = "".join(iter_sized_file_chunks(filenames[0], 1000))
+            self.assertEqual(data, "0" * 1000)
+
+            members = [(_i, os.path.basename(_i), size, 0)
+                for _i, size in zip(filenames, sizes)]
+            archive_data = "".join(iter_tar_archive(members,
+                chunk_bytes=1000))
+            self.assertEqual(len(archive_data),
+                get_tar_archive_size(members))
+            archive = tarfile.open(fileobj=StringIO(archive_data))
+            self.assertEqual(archive.extractfile("file0").read(), "0" * 2500)
+            self.assertEqual(archive.extractfile("file1").read(),
+                "\0" * 2500)
+        finally:
+            shutil.rmtree(tempdir)
+
+
 def suite():
     suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ConditionalRequestTestCase, "test"))
+    suite.addTest(unittest.makeSuite(DatabaseUpgradeTestCase, "test"))
+    suite.addTest(unittest.makeSuite(FileSystemUtilityFunctionsTestCase,
+        "test"))
+    suite.addTest(unittest.makeSuite(HashFilterTestCase, "test"))
+    suite.addTest(unittest.makeSuite(LRUCacheTestCase, "test"))
+    suite.addTest(unittest.makeSuite(WaveformOutputTestCase, "test"))
     suite.addTest(unittest.makeSuite(WaveformTestCase, "test"))
     return suite
 
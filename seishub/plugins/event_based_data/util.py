@@ -9,15 +9,37 @@ Shared utility function.
     GNU Lesser General Public License, Version 3
     (http://www.gnu.org/copyleft/lesser.html)
 """
-from seishub.core.exceptions import DuplicateObjectError
+from seishub.core.exceptions import DuplicateObjectError, \
+    InternalServerError, InvalidParameterError
 
 import datetime
+import email.utils
+import errno
 import hashlib
+from obspy import UTCDateTime
 import os
 import sqlalchemy
+import tempfile
+import threading
+import time
+from twisted.internet import defer, error
+from twisted.internet.interfaces import IPushProducer
+from twisted.python import failure
+from twisted.python.threadable import isInIOThread
+from zope.interface import implementer
 
-from table_definitions import ChannelObject, FilepathObject, StationObject, \
-    WaveformChannelObject
+from distances import update_station_distances
+from hash_filter import add_known_hash, might_be_known
+from mseed_index import get_trace_byte_ranges
+from spatial import update_station_index
+from table_definitions import ChannelObject, ChannelMetadataObject, \
+    FilepathObject, StationObject, WaveformChannelObject
+
+
+# Size of the chunks in which files are streamed from and to the disk.
+CHUNK_SIZE = 1024 * 1024
+
+lowercase_true_strings = ("true", "yes", "y")
 
 
 def event_exists(event_name, env):
@@ -43,6 +65,388 @@ def event_exists(event_name, env):
     return bool(count)
 
 
+def wildcards_to_like(pattern):
+    """
+    Converts a pattern with the wildcards "*" and "?" to a pattern for the
+    SQL LIKE operator. Characters special to LIKE are escaped with a
+    backslash which therefore has to be passed as the escape character.
+    """
+    pattern = pattern.replace("\\", "\\\\").replace("%", "\\%")\
+        .replace("_", "\\_")
+    return pattern.replace("*", "%").replace("?", "_")
+
+
+def wildcard_filter(column, pattern):
+    """
+    Returns a filter expression matching the given column against a pattern
+    with the wildcards "*" and "?". Patterns without wildcards are compared
+    for equality which is faster and case sensitive on all databases.
+    """
+    if "*" not in pattern and "?" not in pattern:
+        return column == pattern
+    return column.like(wildcards_to_like(pattern), escape="\\")
+
+
+def get_limit(request, default=None):
+    """
+    Parses the optional limit parameter of a listing.
+
+    Returns the limit as an integer or the default if not given.
+    """
+    limit = request.args0.get("limit", None)
+    if limit is None:
+        return default
+    try:
+        limit = int(limit)
+    except ValueError:
+        limit = 0
+    if limit <= 0:
+        msg = "'limit' has to be a positive integer."
+        raise InvalidParameterError(msg)
+    return limit
+
+
+def get_float_parameter(request, name, minimum=None, maximum=None):
+    """
+    Parses an optional floating point parameter, optionally within the given
+    bounds.
+
+    Returns None if it is not given.
+    """
+    value = request.args0.get(name, None)
+    if value is None:
+        return None
+    try:
+        value = float(value)
+    except ValueError:
+        value = None
+    # Not a number and infinite values are rejected as well.
+    if value is None or value != value or abs(value) == float("inf"):
+        msg = "'%s' has to be a number." % name
+        raise InvalidParameterError(msg)
+    if minimum is not None and maximum is not None and \
+            not minimum <= value <= maximum:
+        msg = "'%s' has to be a number between %g and %g." % (name,
+            minimum, maximum)
+        raise InvalidParameterError(msg)
+    return value
+
+
+def get_bounding_box_filters(request, latitude_column, longitude_column):
+    """
+    Returns the filters of the optional bounding box given with the
+    min_latitude, max_latitude, min_longitude, and max_longitude parameters.
+    Boxes crossing the date line have a min_longitude bigger than their
+    max_longitude.
+    """
+    filters = []
+    min_latitude = get_float_parameter(request, "min_latitude", -90, 90)
+    max_latitude = get_float_parameter(request, "max_latitude", -90, 90)
+    min_longitude = get_float_parameter(request, "min_longitude", -180,
+        180)
+    max_longitude = get_float_parameter(request, "max_longitude", -180,
+        180)
+    if min_latitude is not None:
+        filters.append(latitude_column >= min_latitude)
+    if max_latitude is not None:
+        filters.append(latitude_column <= max_latitude)
+    if min_longitude is not None and max_longitude is not None and \
+            min_longitude > max_longitude:
+        filters.append(sqlalchemy.or_(longitude_column >= min_longitude,
+            longitude_column <= max_longitude))
+    else:
+        if min_longitude is not None:
+            filters.append(longitude_column >= min_longitude)
+        if max_longitude is not None:
+            filters.append(longitude_column <= max_longitude)
+    return filters
+
+
+def set_next_cursor(request, value):
+    """
+    Passes the cursor of the next page of a listing to the client in the
+    x-next-after header. It has to be passed as the after parameter to get
+    the next page.
+    """
+    request.setHeader("x-next-after", str(value))
+
+
+@implementer(IPushProducer)
+class ChunkProducer(object):
+    """
+    Writes an iterable of strings or buffers to a request. It is registered
+    as a streaming producer with the request so the transport pauses it
+    whenever its write buffer is full. Only a few chunks are thus kept in
+    memory, no matter how slow the client is.
+
+    Has to be started in the reactor thread. start() returns a Deferred
+    which fires once all chunks have been written or fails if the
+    connection has been lost or the chunks could not be produced.
+    """
+    def __init__(self, request, chunks):
+        self.request = request
+        self._chunks = iter(chunks)
+        self._paused = False
+        self.deferred = defer.Deferred()
+
+    def start(self):
+        self.request.registerProducer(self, True)
+        self.resumeProducing()
+        return self.deferred
+
+    def resumeProducing(self):
+        self._paused = False
+        # Writing might pause or stop the producer.
+        while not self._paused and self._chunks is not None:
+            try:
+                chunk = next(self._chunks)
+            except StopIteration:
+                self._finish()
+                return
+            except:
+                self._finish(failure.Failure())
+                return
+            # Twisted transports only accept strings. Buffers are therefore
+            # copied to strings one at a time right before they are written.
+            self.request.write(str(chunk))
+
+    def pauseProducing(self):
+        self._paused = True
+
+    def stopProducing(self):
+        self._finish(failure.Failure(error.ConnectionLost(
+            "The connection has been lost while streaming the response.")))
+
+    def _finish(self, reason=None):
+        if self._chunks is None:
+            return
+        chunks, self._chunks = self._chunks, None
+        # Closes the files of generators.
+        if hasattr(chunks, "close"):
+            chunks.close()
+        self.request.unregisterProducer()
+        if reason is None:
+            self.deferred.callback(None)
+        else:
+            self.deferred.errback(reason)
+
+
+def stream_response(request, chunks):
+    """
+    Sends the given iterable of strings or buffers to the client chunk by
+    chunk so the response never has to be kept in memory as a whole.
+    Requests that cannot be written to, e.g. the ones directly handled by a
+    Processor, get the joined chunks returned instead.
+
+    SeisHub renders mappers in a thread pool and finishes the request once
+    they return. The calling thread is therefore blocked until a
+    ChunkProducer has written all chunks in the reactor thread.
+
+    Returns the string the mapper has to return.
+    """
+    if getattr(request, "write", None) is None:
+        return "".join(str(_i) for _i in chunks)
+    if isInIOThread():
+        msg = "Responses cannot be streamed from the reactor thread."
+        raise InternalServerError(msg)
+    # Importing the reactor installs it. Leave the choice to SeisHub.
+    from twisted.internet import reactor, threads
+    threads.blockingCallFromThread(reactor,
+        ChunkProducer(request, chunks).start)
+    return ""
+
+
+def get_request_header(request, name):
+    """
+    Returns the value of the given header of the request or None if it has
+    not been sent. Requests not coming in via HTTP have no headers.
+    """
+    get_header = getattr(request, "getHeader", None)
+    if get_header is None:
+        return None
+    return get_header(name)
+
+
+def get_file_etag(md5_hash, *variant):
+    """
+    Returns a strong entity tag for content derived from the file with the
+    given md5 checksum. The file itself is identified by its checksum.
+    Derived content additionally depends on all given variant arguments,
+    e.g. the output format.
+    """
+    if not variant:
+        return '"%s"' % md5_hash
+    return '"%s"' % hashlib.md5("|".join([md5_hash] +
+        [str(_i) for _i in variant])).hexdigest()
+
+
+def set_validators(request, etag, last_modified):
+    """
+    Sets the ETag and Last-Modified headers of a response.
+
+    :type last_modified: datetime.datetime
+    :param last_modified: The local modification time of the file.
+    """
+    request.setHeader("etag", etag)
+    request.setHeader("last-modified", email.utils.formatdate(
+        time.mktime(last_modified.timetuple()), usegmt=True))
+
+
+def is_not_modified(request, etag, last_modified):
+    """
+    Evaluates the If-None-Match and If-Modified-Since headers of a request.
+    If-Modified-Since is ignored if If-None-Match is given.
+
+    Returns True if the client already has the current version and a 304
+    response can be sent.
+    """
+    if_none_match = get_request_header(request, "if-none-match")
+    if if_none_match is not None:
+        tags = [_i.strip() for _i in if_none_match.split(",")]
+        # Weak comparison is allowed for GET requests.
+        tags = [_i[2:] if _i.startswith("W/") else _i for _i in tags]
+        return "*" in tags or etag in tags
+
+    if_modified_since = get_request_header(request, "if-modified-since")
+    if if_modified_since is not None:
+        since = email.utils.parsedate_tz(if_modified_since)
+        if since is None:
+            return False
+        # HTTP dates only have a resolution of one second.
+        return int(time.mktime(last_modified.timetuple())) <= \
+            email.utils.mktime_tz(since)
+    return False
+
+
+def _set_response_code(request, code):
+    """
+    Sets the HTTP status code of the response if the request supports it.
+    """
+    set_response_code = getattr(request, "setResponseCode", None)
+    if set_response_code is not None:
+        set_response_code(code)
+
+
+def respond_not_modified(request):
+    """
+    Turns the response into a 304 Not Modified response. Returns the empty
+    body the mapper has to return.
+    """
+    _set_response_code(request, 304)
+    return ""
+
+
+def parse_range_header(value, size):
+    """
+    Parses the value of a Range header for a file of the given size. Only
+    single byte ranges are supported, the whole file is sent for all other
+    ranges.
+
+    Returns an inclusive (start, end) tuple, None if the whole file has to be
+    sent, or False if the range cannot be satisfied.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if not value.startswith("bytes=") or "," in value:
+        return None
+    start, separator, end = value[6:].strip().partition("-")
+    if not separator:
+        return None
+    try:
+        start = int(start) if start.strip() else None
+        end = int(end) if end.strip() else None
+    except ValueError:
+        return None
+
+    # Suffix ranges request the last bytes of the file.
+    if start is None:
+        if end is None:
+            return None
+        if end <= 0 or size == 0:
+            return False
+        return max(0, size - end), size - 1
+    if start < 0 or (end is not None and end < start):
+        return None
+    if start >= size:
+        return False
+    if end is None or end >= size:
+        end = size - 1
+    return start, end
+
+
+def iter_file_chunks(filename, offset=0, length=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields the given byte range of a file in chunks.
+    """
+    with open(filename, "rb") as open_file:
+        open_file.seek(offset, 0)
+        while length is None or length > 0:
+            size = chunk_size if length is None else min(chunk_size, length)
+            chunk = open_file.read(size)
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            yield chunk
+
+
+def send_file(request, filename, etag):
+    """
+    Streams a file to the client in chunks. Single byte ranges requested
+    with a Range header are answered with 206 Partial Content so
+    interrupted downloads can be resumed. The range is ignored if an
+    If-Range header does not match the given entity tag.
+
+    Returns the string the mapper has to return.
+    """
+    size = os.path.getsize(filename)
+    request.setHeader("accept-ranges", "bytes")
+
+    byte_range = parse_range_header(get_request_header(request, "range"),
+        size)
+    if_range = get_request_header(request, "if-range")
+    if if_range is not None and if_range.strip() != etag:
+        byte_range = None
+
+    if byte_range is False:
+        _set_response_code(request, 416)
+        request.setHeader("content-range", "bytes */%i" % size)
+        return ""
+    if byte_range is None:
+        start, end = 0, size - 1
+    else:
+        start, end = byte_range
+        _set_response_code(request, 206)
+        request.setHeader("content-range", "bytes %i-%i/%i" % (start, end,
+            size))
+    request.setHeader("content-length", str(end - start + 1))
+    return stream_response(request, iter_file_chunks(filename, start,
+        end - start + 1))
+
+
+def get_event_origin_time(event_name, env):
+    """
+    Returns the indexed origin time of the given event as a UTCDateTime
+    object or None if the event or its origin time is not known.
+
+    :type event_name: String
+    :param event_name: The name of the event.
+    :type env: seishub.core.Environment
+    :param env: The current SeisHub environment
+    """
+    session = env.db.session(bind=env.db.engine)
+    event_view = sqlalchemy.Table("/event_based_data/event", env.db.metadata,
+        autoload=True)
+    result = session.query(event_view.columns["time"]).filter(
+        event_view.columns["resource_name"] == event_name).first()
+    session.close()
+
+    if result is None or result[0] is None:
+        return None
+    return UTCDateTime(result[0])
+
+
 def check_if_file_exist_in_db(data, env):
     """
     Checks if a file with the same md5 checksum exists in the filepaths table.
@@ -55,7 +459,24 @@ def check_if_file_exist_in_db(data, env):
     :param env: The current SeisHub environment
     """
     md5_hash = hashlib.md5(data).hexdigest()
+    check_if_hash_exists_in_db(md5_hash, env)
+    return md5_hash
 
+
+def check_if_hash_exists_in_db(md5_hash, env):
+    """
+    Checks if a file with the given md5 checksum exists in the filepaths
+    table. Raises an appropriate error if it does.
+
+    :type md5_hash: String
+    :param md5_hash: The hex digest of the md5 checksum of the file.
+    :type env: seishub.core.Environment
+    :param env: The current SeisHub environment
+    """
+    # Most files are new which can be determined without querying the
+    # database.
+    if not might_be_known(env, md5_hash):
+        return
     session = env.db.session(bind=env.db.engine)
     query = session.query(FilepathObject.md5_hash).filter(
         FilepathObject.md5_hash == md5_hash)
@@ -64,7 +485,101 @@ def check_if_file_exist_in_db(data, env):
     if count != 0:
         msg = "This file already exists in the database."
         raise DuplicateObjectError(msg)
-    return md5_hash
+
+
+class IOThrottle(object):
+    """
+    Limits the rate at which data is read from the disk. A single instance
+    can be shared by several threads which then share the given bandwidth.
+
+    :type bytes_per_second: Integer
+    :param bytes_per_second: The maximum read rate. 0 disables the limit.
+    """
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self._available_at = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, byte_count):
+        """
+        Blocks until the given number of bytes may be read.
+        """
+        if self.bytes_per_second <= 0:
+            return
+        with self._lock:
+            now = time.time()
+            start = max(now, self._available_at)
+            self._available_at = start + \
+                byte_count / float(self.bytes_per_second)
+        if start > now:
+            time.sleep(start - now)
+
+
+def get_md5_of_file(filename, chunk_size=CHUNK_SIZE, throttle=None):
+    """
+    Calculates the md5 checksum of the given file by reading it in chunks so
+    the memory usage is independent of the file size.
+
+    Returns a tuple of the hex digest of the md5 checksum and the file size in
+    bytes.
+
+    :type throttle: IOThrottle
+    :param throttle: Optionally limits the read rate.
+    """
+    md5 = hashlib.md5()
+    size = 0
+    with open(filename, "rb") as open_file:
+        while True:
+            if throttle is not None:
+                throttle.consume(chunk_size)
+            chunk = open_file.read(chunk_size)
+            if not chunk:
+                break
+            md5.update(chunk)
+            size += len(chunk)
+    return md5.hexdigest(), size
+
+
+def get_file_mtime(filename):
+    """
+    Returns the modification time of the given file as a datetime object.
+    """
+    return datetime.datetime.fromtimestamp(os.path.getmtime(filename))
+
+
+def spool_to_filesystem(fileobject, directory, chunk_size=CHUNK_SIZE):
+    """
+    Streams the contents of the given file-like object in chunks to a new
+    temporary file in the given directory while calculating the md5 checksum
+    on the fly. Any intermediate directories will be created in case they do
+    not exist. The file will be written in the same directory as the final
+    file to be able to later move it with a cheap rename.
+
+    Returns a tuple of the temporary filename, the hex digest of the md5
+    checksum and the file size in bytes.
+    """
+    _makedirs(directory)
+    # mkstemp() opens the file with O_EXCL so concurrent uploads never share
+    # a file.
+    fd, filename = tempfile.mkstemp(prefix=".upload-", dir=directory)
+    md5 = hashlib.md5()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as open_file:
+            while True:
+                chunk = fileobject.read(chunk_size)
+                if not chunk:
+                    break
+                md5.update(chunk)
+                size += len(chunk)
+                open_file.write(chunk)
+            # Make sure the data is on the disk before the file is placed.
+            open_file.flush()
+            os.fsync(open_file.fileno())
+    except:
+        os.remove(filename)
+        raise
+    return filename, md5.hexdigest(), size
 
 
 def get_station_id(network, station, session):
@@ -104,6 +619,105 @@ def get_all_tags(network, station, location, channel, event_id, env):
     return [_i[0] for _i in query.all()]
 
 
+def _makedirs(directory):
+    """
+    Creates the directory including all intermediate ones. Does not fail if
+    it already exists, e.g. because it has been concurrently created.
+    """
+    try:
+        os.makedirs(directory)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class _DirectorySync(object):
+    """
+    State of the fsync calls of a single directory.
+
+    Files placed in the directory while an fsync of it is running have to
+    wait for the next one. All of them are then covered by that single
+    fsync. Concurrent uploads to the same directory thus share their
+    directory fsyncs.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        # Number of requested and completed syncs.
+        self.requested = 0
+        self.synced = 0
+        self.is_syncing = False
+        self.waiters = 0
+
+
+# Sync state of all directories currently being synced.
+_directory_syncs = {}
+_directory_syncs_lock = threading.Lock()
+
+
+def _fsync_directory(directory):
+    """
+    Flushes the directory entries to the disk so newly placed files survive a
+    crash. Concurrent calls for the same directory are batched into as few
+    fsyncs as possible. Returns once an fsync started after the call has
+    finished.
+    """
+    directory = os.path.abspath(directory)
+    with _directory_syncs_lock:
+        state = _directory_syncs.setdefault(directory, _DirectorySync())
+        state.waiters += 1
+    try:
+        with state.condition:
+            state.requested += 1
+            ticket = state.requested
+            while state.synced < ticket:
+                if state.is_syncing:
+                    state.condition.wait()
+                    continue
+                # Sync on behalf of everyone that has requested it so far.
+                state.is_syncing = True
+                target = state.requested
+                state.condition.release()
+                try:
+                    fd = os.open(directory, os.O_RDONLY)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                finally:
+                    state.condition.acquire()
+                    state.is_syncing = False
+                    state.condition.notify_all()
+                state.synced = max(state.synced, target)
+    finally:
+        with _directory_syncs_lock:
+            state.waiters -= 1
+            if not state.waiters:
+                del _directory_syncs[directory]
+
+
+def _link_to_free_filename(source, filename):
+    """
+    Hard links source to filename. If the file already exists, an increasing
+    integer will be appended to it until a non-taken filename is found.
+    Linking fails atomically for existing files so concurrent writers can
+    never overwrite each other's files.
+
+    Returns the final filename.
+    """
+    candidate = filename
+    i = 0
+    while True:
+        try:
+            os.link(source, candidate)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            i += 1
+            candidate = "%s.%i" % (filename, i)
+            continue
+        return candidate
+
+
 def write_string_to_filesystem(filename, string):
     """
     Takes a given string and writes it to the given filename. Any intermediate
@@ -111,42 +725,116 @@ def write_string_to_filesystem(filename, string):
     exists, an increasing integer will be appended to it until a non-take
     filename is found.
 
+    The data is written to a temporary file first which is then atomically
+    placed at the final filename.
+
     Returns the final filename.
     """
-    # If it exists, append a number. Repeat until a non taken one if found.
-    if os.path.exists(filename):
-        i = 1
-        while True:
-            new_filename = "%s.%i" % (filename, i)
-            if not os.path.exists(new_filename):
-                filename = new_filename
-                break
-            i += 1
-
     # Get the directory and if it does not exist, create it.
     directory = os.path.dirname(filename)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    _makedirs(directory)
     # Write the file
-    with open(filename, "wb") as open_file:
-        open_file.write(string)
+    fd, temp_filename = tempfile.mkstemp(prefix=".upload-", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as open_file:
+            open_file.write(string)
+            open_file.flush()
+            os.fsync(open_file.fileno())
+    except:
+        os.remove(temp_filename)
+        raise
+    return move_file_on_filesystem(temp_filename, filename)
+
+
+def move_file_on_filesystem(source, filename):
+    """
+    Moves the file source to the given filename. Any intermediate directories
+    will be created in case they do not exist. If the file already exists, an
+    increasing integer will be appended to it until a non-take filename is
+    found. Existing files are never overwritten, even with concurrent
+    writers.
+
+    Returns the final filename.
+    """
+    directory = os.path.dirname(filename)
+    _makedirs(directory)
+    try:
+        filename = _link_to_free_filename(source, filename)
+    finally:
+        os.remove(source)
+    _fsync_directory(directory)
+    return filename
+
+
+def get_content_addressed_filename(directory, md5_hash, depth=2):
+    """
+    Returns the filename of a file in a content addressed layout. The file is
+    named after its md5 checksum and sharded into depth levels of directories
+    named after successive two character prefixes of the checksum, e.g.
+
+        directory/d4/1d/d41d8cd98f00b204e9800998ecf8427e
+    """
+    shards = [md5_hash[2 * _i:2 * _i + 2] for _i in xrange(depth)]
+    return os.path.join(directory, *(shards + [md5_hash]))
+
+
+def store_managed_file(env, source, filename, directory, md5_hash):
+    """
+    Moves an already written file to its final location. Where that is
+    depends on the storage_layout option.
+
+    With the "named" layout the file is moved to the given filename. If it
+    already exists, an increasing integer will be appended.
+
+    With the "content_addressed" layout the file is moved to a path derived
+    from its md5 checksum below the given directory. No probing for free
+    filenames is necessary. If the file already exists, it is a duplicate
+    and a DuplicateObjectError is raised after removing the source.
+
+    Returns the final filename.
+    """
+    layout = env.config.get("event_based_data", "storage_layout")
+    if layout != "content_addressed":
+        return move_file_on_filesystem(source, filename)
+
+    filename = get_content_addressed_filename(directory, md5_hash,
+        env.config.getint("event_based_data", "content_addressed_depth"))
+    _makedirs(os.path.dirname(filename))
+    # Hard linking fails atomically if the file already exists.
+    try:
+        os.link(source, filename)
+    except OSError, e:
+        if e.errno == errno.EEXIST:
+            msg = "This file already exists in the database."
+            raise DuplicateObjectError(msg)
+        raise
+    finally:
+        os.remove(source)
+    _fsync_directory(os.path.dirname(filename))
     return filename
 
 
 def add_filepath_to_database(open_session, filepath, filesize, md5_hash,
-        is_managed_by_seishub):
+        is_managed_by_seishub, mtime=None):
     """
     Add information about a filepath to the database. Expects an open
     SQLAlchemy session.
 
     Returns the Column object.
+
+    :param mtime: The modification time of the file when it was hashed. Will
+        be determined from the file if not given. It is used to detect
+        modified files upon rescanning.
     """
     filepath = os.path.abspath(filepath)
+    if mtime is None:
+        mtime = get_file_mtime(filepath)
     # Add information about the uploaded file into the database.
     filepath = FilepathObject(filepath=filepath, size=filesize,
-        mtime=datetime.datetime.now(), md5_hash=md5_hash,
+        mtime=mtime, md5_hash=md5_hash,
         is_managed_by_seishub=is_managed_by_seishub)
     open_session.add(filepath)
+    add_known_hash(open_session.bind, md5_hash)
     return filepath
 
 
@@ -205,3 +893,205 @@ def add_or_update_channel(open_session, network, station, location, channel,
     open_session.add(channel_object)
 
     return channel_object
+
+
+def get_or_create_channels(open_session, channels, force_update=False):
+    """
+    Set-based version of add_or_update_channel(). Resolves all given channels
+    with one query for the stations and one for the channels and creates the
+    missing ones. The session will be flushed so all returned objects have
+    their primary keys set.
+
+    Returns a dictionary mapping (network, station, location, channel) tuples
+    to the channel objects from SQLAlchemy's ORM.
+
+    :type channels: list of dictionaries
+    :param channels: Each dictionary has to contain the keys network,
+        station, location, channel, latitude, longitude, elevation, and
+        local_depth.
+    :param force_update: If True, always overwrite everything, otherwise only
+        write previously not-existing values.
+    """
+    if not channels:
+        return {}
+    networks = set(_i["network"] for _i in channels)
+    station_codes = set(_i["station"] for _i in channels)
+
+    # Fetch a superset of all potentially existing stations and channels and
+    # filter them afterwards. This is portable across databases in contrast to
+    # tuple comparisons.
+    stations = {}
+    query = open_session.query(StationObject)\
+        .filter(StationObject.network.in_(networks))\
+        .filter(StationObject.station.in_(station_codes))
+    for station_object in query:
+        stations[(station_object.network, station_object.station)] = \
+            station_object
+
+    channel_objects = {}
+    if stations:
+        query = open_session.query(ChannelObject)\
+            .filter(ChannelObject.station_id.in_(
+                [_i.id for _i in stations.itervalues()]))
+        station_keys = dict((_i.id, key) for key, _i in stations.iteritems())
+        for channel_object in query:
+            key = station_keys[channel_object.station_id] + \
+                (channel_object.location, channel_object.channel)
+            channel_objects[key] = channel_object
+
+    # Stations whose coordinates changed.
+    moved_stations = set()
+    for channel in channels:
+        station_key = (channel["network"], channel["station"])
+        key = station_key + (channel["location"], channel["channel"])
+
+        station_object = stations.get(station_key, None)
+        if station_object is None:
+            station_object = StationObject(network=channel["network"],
+                station=channel["station"])
+            stations[station_key] = station_object
+            open_session.add(station_object)
+
+        if key not in channel_objects:
+            channel_object = ChannelObject(channel=channel["channel"],
+                location=channel["location"], station=station_object)
+            channel_objects[key] = channel_object
+            open_session.add(channel_object)
+
+        # Update only if either not set or force_update is True
+        for attrib, column in (("latitude", "latitude"),
+                ("longitude", "longitude"), ("elevation", "elevation_in_m"),
+                ("local_depth", "local_depth_in_m")):
+            value = channel[attrib]
+            if value is not None and (not getattr(station_object, column) or
+                    force_update is True):
+                if column in ("latitude", "longitude") and \
+                        getattr(station_object, column) != value:
+                    moved_stations.add(station_key)
+                setattr(station_object, column, value)
+
+    open_session.flush()
+    # Keep the spatial index of the stations and the distances to the events
+    # up to date.
+    update_station_index(open_session.bind, stations.values())
+    update_station_distances(open_session,
+        [stations[_i] for _i in sorted(moved_stations)])
+    return channel_objects
+
+
+def get_waveform_channel_info(st, filename=None):
+    """
+    Extracts all information about the traces of an ObsPy Stream object that
+    will be stored in the database.
+
+    Returns a list of dictionaries, one for each trace, suitable to be passed
+    to get_or_create_channels() and add_waveform_channels_to_database().
+
+    :param filename: The file the Stream object has been read from. If given,
+        the byte ranges of the traces of MiniSEED files will be determined.
+    """
+    byte_ranges = [None] * len(st)
+    if filename is not None and st and \
+            all(_i.stats._format == "MSEED" for _i in st):
+        byte_ranges = get_trace_byte_ranges(filename, st)
+
+    channels = []
+    for trace_index, (trace, byte_range) in \
+            enumerate(zip(st, byte_ranges)):
+        stats = trace.stats
+
+        # Extract coordinates if it is a sac file. Else set them to None.
+        if hasattr(stats, "sac"):
+            # Invalid floating point value according to the sac definition.
+            iv = -12345.0
+            sac = stats.sac
+            latitude = sac.stla if sac.stla != iv else None
+            longitude = sac.stlo if sac.stlo != iv else None
+            elevation = sac.stel if sac.stel != iv else None
+            local_depth = sac.stdp if sac.stdp != iv else None
+        else:
+            latitude, longitude, elevation, local_depth = [None] * 4
+
+        channels.append({
+            "network": stats.network,
+            "station": stats.station,
+            "location": stats.location,
+            "channel": stats.channel,
+            "latitude": latitude,
+            "longitude": longitude,
+            "elevation": elevation,
+            "local_depth": local_depth,
+            "starttime": stats.starttime.datetime,
+            "endtime": stats.endtime.datetime,
+            "sampling_rate": stats.sampling_rate,
+            "format": stats._format,
+            "trace_index": trace_index,
+            "byte_offset": byte_range[0] if byte_range else None,
+            "byte_length": byte_range[1] if byte_range else None})
+    return channels
+
+
+def add_waveform_channels_to_database(open_session, filepath, channels,
+        event_id, tag, is_synthetic):
+    """
+    Adds all waveform channels of one file to the database. Stations and
+    channels are resolved in one go and the waveform channels are added with
+    a single bulk insert. Expects an open SQLAlchemy session and does not
+    commit it.
+
+    :param filepath: The already flushed filepath object of the file.
+    :param channels: List of dictionaries as returned by
+        get_waveform_channel_info().
+    """
+    channel_rows = get_or_create_channels(open_session, channels)
+
+    waveform_channels = []
+    for channel in channels:
+        channel_row = channel_rows[(channel["network"], channel["station"],
+            channel["location"], channel["channel"])]
+        waveform_channels.append({
+            "channel_id": channel_row.id,
+            "filepath_id": filepath.id,
+            "event_resource_id": event_id,
+            "starttime": channel["starttime"],
+            "endtime": channel["endtime"],
+            "tag": tag,
+            "sampling_rate": channel["sampling_rate"],
+            "format": channel["format"],
+            "is_synthetic": is_synthetic,
+            "trace_index": channel.get("trace_index", None),
+            "byte_offset": channel.get("byte_offset", None),
+            "byte_length": channel.get("byte_length", None)})
+    open_session.execute(WaveformChannelObject.__table__.insert(),
+        waveform_channels)
+
+
+def add_station_channels_to_database(open_session, filepath, channels):
+    """
+    Adds the channel information of one station file to the database. The
+    coordinates of the stations will always be overwritten. Expects an open
+    SQLAlchemy session and does not commit it.
+
+    :param filepath: The filepath object of the file.
+    :param channels: List of dictionaries as returned by the station file
+        readers.
+    """
+    channel_rows = get_or_create_channels(open_session, channels,
+        force_update=True)
+    for channel in channels:
+        channel_row = channel_rows[(channel["network"], channel["station"],
+            channel["location"], channel["channel"])]
+
+        # Now add information about the time span of the current channel
+        # information.
+        if hasattr(channel["end_date"], "datetime"):
+            end_date = channel["end_date"].datetime
+        else:
+            end_date = None
+
+        metadata = ChannelMetadataObject(channel=channel_row,
+            filepath=filepath,
+            starttime=channel["start_date"].datetime,
+            endtime=end_date,
+            format=channel["format"])
+        open_session.add(metadata)
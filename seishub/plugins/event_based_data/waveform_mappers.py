@@ -1,24 +1,136 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 from seishub.core.core import Component, implements
-from seishub.core.exceptions import InvalidObjectError, InternalServerError, \
+from seishub.core.exceptions import InternalServerError, \
     InvalidParameterError, NotFoundError
 from seishub.core.packages.interfaces import IMapper
 from seishub.core.db.util import formatResults
 
-import json
+import itertools
+import math
 from obspy import read, UTCDateTime
-from obspy.core.util import NamedTemporaryFile
 import os
 import sqlalchemy
-from StringIO import StringIO
 
-from table_definitions import ChannelObject, WaveformChannelObject
-from util import check_if_file_exist_in_db, write_string_to_filesystem, \
-    add_filepath_to_database, add_or_update_channel, get_all_tags, \
-    event_exists, get_station_id
+from cache import get_waveform_cache
+from indexer import start_directory_indexing
+from ingest import ingest_waveform_file
+from jobs import get_job_info, submit_job
+from mseed_index import get_overlapping_byte_range, read_byte_range
+from overview import compute_overview, get_overview_filename, \
+    get_overview_size, get_overview_window, overview_to_json, \
+    read_overview, select_level, write_overview
+from table_definitions import ChannelObject, FilepathObject, \
+    StationObject, WaveformChannelObject
+from util import get_md5_of_file, spool_to_filesystem, event_exists, \
+    get_event_origin_time, get_station_id, lowercase_true_strings, \
+    stream_response, get_file_etag, set_validators, is_not_modified, \
+    respond_not_modified, send_file, wildcard_filter, \
+    get_limit, set_next_cursor
+from waveform_output import BINARY_FORMATS, JSON_LAYOUTS, \
+    get_binary_array, get_binary_headers, iter_binary, iter_compact_json, \
+    iter_pairs_json, write_trace_to_string, get_tar_archive_size, \
+    iter_sized_file_chunks, iter_tar_archive
+
+
+def _get_time_window(request, event_id, env):
+    """
+    Parses the optional time window of a waveform request. Both bounds can
+    either be given as absolute times with starttime/endtime or as offsets in
+    seconds relative to the origin time of the event with
+    start_offset/end_offset.
+
+    Returns a (starttime, endtime) tuple. Bounds not given are None.
+    """
+    window = []
+    origin_time = None
+    for bound in ("start", "end"):
+        absolute = request.args0.get(bound + "time", None)
+        offset = request.args0.get(bound + "_offset", None)
+        if absolute is not None and offset is not None:
+            msg = "'%stime' and '%s_offset' cannot be given at the same " \
+                "time." % (bound, bound)
+            raise InvalidParameterError(msg)
+        if absolute is not None:
+            try:
+                value = UTCDateTime(absolute)
+            except:
+                msg = "'%stime' is not a valid time." % bound
+                raise InvalidParameterError(msg)
+        elif offset is not None:
+            try:
+                offset = float(offset)
+            except ValueError:
+                msg = "'%s_offset' has to be a number of seconds." % bound
+                raise InvalidParameterError(msg)
+            if origin_time is None:
+                origin_time = get_event_origin_time(event_id, env)
+            if origin_time is None:
+                msg = "The origin time of event '%s' is not known." % \
+                    event_id
+                raise InvalidParameterError(msg)
+            value = origin_time + offset
+        else:
+            value = None
+        window.append(value)
 
-lowercase_true_strings = ("true", "yes", "y")
+    starttime, endtime = window
+    if starttime is not None and endtime is not None and \
+            starttime >= endtime:
+        msg = "The start of the time window has to be before its end."
+        raise InvalidParameterError(msg)
+    return starttime, endtime
+
+
+def _read_trace(waveform_channel, starttime=None, endtime=None):
+    """
+    Reads the trace of the given waveform channel from its file. If the byte
+    range of the trace is known only its records will be read and decoded,
+    and of those only the ones overlapping the given time window. The trace
+    is not yet trimmed to the time window.
+
+    Returns an ObsPy Trace object or None if the trace cannot be found.
+    """
+    filename = waveform_channel.filepath.filepath
+    chan = waveform_channel.channel
+    trace_id = ".".join([chan.station.network, chan.station.station,
+        chan.location, chan.channel])
+
+    if waveform_channel.byte_offset is not None:
+        byte_range = None
+        if starttime is not None or endtime is not None:
+            byte_range = get_overlapping_byte_range(filename,
+                waveform_channel.byte_offset, waveform_channel.byte_length,
+                starttime, endtime)
+        if byte_range is None:
+            byte_range = (waveform_channel.byte_offset,
+                waveform_channel.byte_length)
+        st = read_byte_range(filename, *byte_range)
+        if len(st) == 1 and st[0].id == trace_id:
+            return st[0]
+
+    if waveform_channel.format == "MSEED":
+        # Only decode the records of the trace. The position of the trace in
+        # the file is then no longer of use.
+        st = read(filename, format="MSEED", sourcename=trace_id)
+    else:
+        st = read(filename)
+        index = waveform_channel.trace_index
+        if index is not None and index < len(st) and \
+                st[index].id == trace_id:
+            return st[index]
+
+    # Files indexed without the position of the traces. Attempt to find the
+    # correct trace in case of more then one trace. This should enable
+    # multicomponent files.
+    starttime = UTCDateTime(waveform_channel.starttime)
+    endtime = UTCDateTime(waveform_channel.endtime)
+    for tr in st.select(id=trace_id):
+        if abs(tr.stats.starttime - starttime) > 1 or \
+                abs(tr.stats.endtime - endtime) > 1:
+            continue
+        return tr
+    return None
 
 
 class WaveformMapper(Component):
@@ -65,6 +177,63 @@ class WaveformMapper(Component):
 
     SEISHUB_SERVER/event_based_data/waveform?event=EVENT_NAME&index_file=FILE
 
+    Indexed files will only have their headers read, the actual samples are
+    never decoded.
+
+    Whole directory trees can be indexed in one go by passing the
+    index_directory parameter. The optional pattern parameter restricts the
+    indexing to files matching the given glob pattern. The files are parsed
+    by a pool of worker processes and a summary of the indexing job is
+    returned.
+
+    SEISHUB_SERVER/event_based_data/waveform?event=EVENT_NAME&\
+index_directory=DIR&pattern=*.mseed
+
+    Passing async=true will return right away with the id of a job that
+    ingests the file in the background. Its status is available at
+    SEISHUB_SERVER/event_based_data/jobs?job_id=JOB_ID.
+
+    A single waveform is downloaded by passing a channel_id. Only a time
+    window of it will be returned if starttime and/or endtime are given.
+    Alternatively start_offset and end_offset give the window in seconds
+    relative to the origin time of the event. Of MiniSEED files only the
+    records overlapping the window are read.
+
+    SEISHUB_SERVER/event_based_data/waveform?event=EVENT_NAME&\
+channel_id=NET.STA.LOC.CHA&start_offset=-60&end_offset=600
+
+    Without a channel_id the waveforms of the event, or of the station given
+    with station_id, are listed. The list can be filtered with the tag,
+    synthetic, channel (e.g. BH?), and time window parameters and paginated
+    with limit and after.
+
+    Downloaded waveforms are kept in a size-bounded cache. Its statistics
+    are available at
+
+    SEISHUB_SERVER/event_based_data/waveform/getCacheStatistics
+
+    Besides the waveform formats, the data can be downloaded as a npy file
+    with format=npy or as little-endian floating point numbers with
+    format=float32 or format=float64. The stats of the trace are then given
+    in the x-channel-id, x-starttime, x-sampling-rate, x-delta, x-npts, and
+    x-dtype headers.
+
+    All waveform files of an event are downloaded at once as a tar archive
+    with one folder per tag. The tag, synthetic, and stations parameters
+    restrict the files. Passing format=mseed concatenates MiniSEED files
+    instead.
+
+    SEISHUB_SERVER/event_based_data/waveform/getArchive?event=EVENT_NAME&\
+tag=TAG&stations=NET.STA,NET.STA
+
+    Passing format=overview returns the minima and maxima of the time window
+    in at least width bins, e.g. to plot it. They are taken from a
+    precomputed min/max pyramid so the cost is independent of the length of
+    the trace.
+
+    SEISHUB_SERVER/event_based_data/waveform?event=EVENT_NAME&\
+channel_id=NET.STA.LOC.CHA&format=overview&width=1000
+
     Take care of correctly encoding the URL, e.g. "/" is encoded as "%2F".
 
     You can use urllib.urlencode() for that task:
@@ -88,6 +257,12 @@ class WaveformMapper(Component):
         Function that will be called upon receiving a GET request for the
         aforementioned URL.
         """
+        # getCacheStatistics returns the counters of the waveform cache.
+        if request.postpath and \
+                request.postpath[0].startswith("getCacheStatistics"):
+            return formatResults(request,
+                [get_waveform_cache(self.env).get_statistics()])
+
         # Parse the given parameters.
         event_id = request.args0.get("event", None)
         channel_id = request.args0.get("channel_id", None)
@@ -106,6 +281,11 @@ class WaveformMapper(Component):
             msg += "is not known to SeisHub."
             raise InvalidParameterError(msg)
 
+        # getArchive streams all matching waveform files of the event at
+        # once.
+        if request.postpath and request.postpath[0].startswith("getArchive"):
+            return self.getArchiveForEvent(event_id, request)
+
         # Returns different things based on parameter combinations.
         # Return all waveforms available for a given event.
         if channel_id is None and station_id is None and event_id is not None:
@@ -116,7 +296,8 @@ class WaveformMapper(Component):
                 request)
 
         # At this step format will mean a waveform output format.
-        acceptable_formats = ["mseed", "sac", "gse2", "segy", "raw", "json"]
+        acceptable_formats = ["mseed", "sac", "gse2", "segy", "raw", "json",
+            "npy", "float32", "float64", "overview"]
         if format and format.lower() not in acceptable_formats:
             msg = "'%s' is an unsupported format. Supported formats: %s" % \
                 (format, ", ".join(acceptable_formats))
@@ -133,6 +314,30 @@ class WaveformMapper(Component):
 
         network, station, location, channel = split_channel
 
+        json_layout = request.args0.get("json_layout", "compact")
+        if json_layout not in JSON_LAYOUTS:
+            msg = "'json_layout' has to be one of %s." % \
+                ", ".join(JSON_LAYOUTS)
+            raise InvalidParameterError(msg)
+
+        # The number of pixels overviews are requested for.
+        width = None
+        if format and format.lower() == "overview":
+            try:
+                width = int(request.args0.get("width", 1000))
+            except ValueError:
+                width = 0
+            if width <= 0:
+                msg = "'width' has to be a positive integer."
+                raise InvalidParameterError(msg)
+
+        # Optionally only return a time window of the trace.
+        starttime, endtime = _get_time_window(request, event_id, self.env)
+        if format and format.lower() == "raw" and \
+                (starttime is not None or endtime is not None):
+            msg = "Time windows are not supported for the 'raw' format."
+            raise InvalidParameterError(msg)
+
         session = self.env.db.session(bind=self.env.db.engine)
         station_id = get_station_id(network, station, session)
         if station_id is False:
@@ -156,145 +361,414 @@ class WaveformMapper(Component):
             msg = "No matching data found in the database."
             raise NotFoundError(msg)
 
-        if format and format.lower() == "raw":
-            with open(result.filepath.filepath, "rb") as open_file:
-                data = open_file.read()
+        if (starttime is not None and starttime > UTCDateTime(
+                result.endtime)) or (endtime is not None and
+                endtime < UTCDateTime(result.starttime)):
+            session.close()
+            msg = "No data available in the requested time window."
+            raise NotFoundError(msg)
+
+        # Clients already having the current version get a 304 response
+        # without the file ever being opened.
+        output_format = (format or result.format).lower()
+        if output_format == "raw":
+            etag = get_file_etag(result.filepath.md5_hash)
+        else:
+            etag = get_file_etag(result.filepath.md5_hash, result.id,
+                starttime, endtime, output_format, json_layout, width)
+        set_validators(request, etag, result.filepath.mtime)
+        if is_not_modified(request, etag, result.filepath.mtime):
+            session.close()
+            return respond_not_modified(request)
+
+        if output_format == "raw":
+            filename = result.filepath.filepath
+            session.close()
             # Set the corresponding headers.
             request.setHeader("content-type", "application/octet-stream")
-            filename = os.path.basename(result.filepath.filepath)\
-                .encode("utf-8")
             request.setHeader("content-disposition", "attachment; filename=%s"
-                % filename)
+                % os.path.basename(filename).encode("utf-8"))
+            # The file is streamed in chunks.
+            return send_file(request, filename, etag)
+
+        # Everything derived from the file is cached. The keys start with the
+        # file so modified files are never served from the cache.
+        cache = get_waveform_cache(self.env)
+        key = (result.filepath_id, result.filepath.md5_hash,
+            result.filepath.mtime, result.id,
+            float(starttime) if starttime is not None else None,
+            float(endtime) if endtime is not None else None)
+
+        # Overviews are small enough to not need to be streamed.
+        if output_format == "overview":
+            try:
+                data = self._get_overview(cache, key, result, starttime,
+                    endtime, width)
+            finally:
+                session.close()
+            request.setHeader('content-type',
+                'application/json; charset=UTF-8')
             return data
 
-        chan = result.channel
-        stat = chan.station
-        network = stat.network
-        station = stat.station
-        location = chan.location
-        channel = chan.channel
-        starttime = UTCDateTime(result.starttime) if result.starttime else None
-        endtime = UTCDateTime(result.endtime) if result.endtime else None
-        default_format = result.format
-
-        # Read and filter the file.
-        st = read(result.filepath.filepath).select(network=network,
-            station=station, location=location, channel=channel)
-        session.close()
+        # Waveform formats are cached in their converted form.
+        if output_format not in BINARY_FORMATS and output_format != "json":
+            data = cache.get(key + (output_format,))
+            if data is None:
+                try:
+                    selected_trace = self._get_trace(cache, key, result,
+                        starttime, endtime)
+                finally:
+                    session.close()
+                # Some writers modify the trace. The cached one must stay
+                # untouched.
+                data = write_trace_to_string(selected_trace.copy(),
+                    output_format)
+                cache.put(key + (output_format,), data, len(data))
+            session.close()
 
-        # Now attempt to find the correct trace in case of more then one trace.
-        # This should enable multicomponent files.
-        selected_trace = None
-        for tr in st:
-            if (starttime and abs(tr.stats.starttime - starttime) > 1) or \
-                    (endtime and abs(tr.stats.endtime - endtime) > 1):
-                continue
-            selected_trace = tr
-            break
+            # Set the corresponding headers.
+            request.setHeader("content-type", "application/octet-stream")
+            filename = "%s.%s" % (channel_id, output_format)
+            filename = filename.encode("utf-8")
+            request.setHeader("content-disposition",
+                "attachment; filename=%s" % filename)
+            return data
 
-        if selected_trace is None:
-            msg = "Could not find the corresponding waveform file."
-            raise InternalServerError(msg)
+        try:
+            selected_trace = self._get_trace(cache, key, result, starttime,
+                endtime)
+        finally:
+            session.close()
 
-        # Deal with json format conversion.
-        if format and format == "json":
-            output = {
-                "channel": selected_trace.id,
-                "sampling_rate": selected_trace.stats.sampling_rate,
-                "npts": selected_trace.stats.npts,
-                "data": []
-            }
-            time = selected_trace.stats.starttime
-            delta = selected_trace.stats.delta
-            for value in selected_trace.data:
-                output["data"].append([time.isoformat(), float(value)])
-                time += delta
+        # Deal with json format conversion. The output is streamed in
+        # chunks.
+        if output_format == "json":
             request.setHeader('content-type',
                 'application/json; charset=UTF-8')
-            return json.dumps(output)
-
-        # XXX: Fix some ObsPy modules to be able to write to memory files.
-        tempfile = NamedTemporaryFile()
-        if format:
-            default_format = format
-        selected_trace.write(tempfile.name, format=default_format)
-        with open(tempfile.name, "rb") as open_file:
-            data = open_file.read()
-        tempfile.close()
-        os.remove(tempfile.name)
-
-        # Set the corresponding headers.
+            if json_layout == "pairs":
+                chunks = iter_pairs_json(selected_trace)
+            else:
+                chunks = iter_compact_json(selected_trace)
+            return stream_response(request, chunks)
+
+        # Binary arrays are written chunk by chunk from the memory of the
+        # trace.
+        # The stats are sent as headers.
+        array = get_binary_array(selected_trace, output_format)
+        for name, value in get_binary_headers(selected_trace,
+                array).iteritems():
+            request.setHeader(name, value)
         request.setHeader("content-type", "application/octet-stream")
-        filename = "%s.%s" % (selected_trace.id, default_format.lower())
-        filename = filename.encode("utf-8")
-        request.setHeader("content-disposition", "attachment; filename=%s" %
-            filename)
-        return data
+        filename = "%s.%s" % (selected_trace.id,
+            "npy" if output_format == "npy" else "bin")
+        request.setHeader("content-disposition",
+            "attachment; filename=%s" % filename.encode("utf-8"))
+        return stream_response(request, iter_binary(array, output_format))
+
+    def _get_trace(self, cache, key, waveform_channel, starttime, endtime):
+        """
+        Returns the trace of the given waveform channel trimmed to the given
+        time window. Decoded traces are cached under the given key. Expects
+        the waveform channel to still be bound to an open session.
+        """
+        selected_trace = cache.get(key + ("trace",))
+        if selected_trace is not None:
+            return selected_trace
+
+        selected_trace = _read_trace(waveform_channel, starttime, endtime)
+        if selected_trace is None:
+            msg = "Could not find the corresponding waveform file."
+            raise InternalServerError(msg)
+
+        if starttime is not None or endtime is not None:
+            selected_trace.trim(starttime, endtime)
+            if not selected_trace.stats.npts:
+                msg = "No data available in the requested time window."
+                raise NotFoundError(msg)
+
+        cache.put(key + ("trace",), selected_trace,
+            selected_trace.data.nbytes)
+        return selected_trace
+
+    def _get_overview(self, cache, key, waveform_channel, starttime,
+            endtime, width):
+        """
+        Returns the JSON representation of the coarsest overview level of the
+        given waveform channel that has at least width bins in the given time
+        window. The samples themselves are returned if no level is coarse
+        enough. Overviews not yet computed by the background job are computed
+        and stored right away. Expects the waveform channel to still be bound
+        to an open session.
+        """
+        chan = waveform_channel.channel
+        trace_id = ".".join([chan.station.network, chan.station.station,
+            chan.location, chan.channel])
+        trace_start = UTCDateTime(waveform_channel.starttime)
+        sampling_rate = waveform_channel.sampling_rate
+        npts = int(round((UTCDateTime(waveform_channel.endtime) -
+            trace_start) * sampling_rate)) + 1
+
+        # The sample range of the time window.
+        first_sample = 0
+        last_sample = npts - 1
+        if starttime is not None:
+            first_sample = max(first_sample,
+                int((starttime - trace_start) * sampling_rate))
+        if endtime is not None:
+            last_sample = min(last_sample,
+                int(math.ceil((endtime - trace_start) * sampling_rate)))
+
+        overview_key = key[:4] + ("overview",)
+        levels = cache.get(overview_key)
+        if levels is None:
+            filename = get_overview_filename(self.env,
+                waveform_channel.filepath.md5_hash, waveform_channel.id)
+            levels = read_overview(filename)
+            if levels is None:
+                trace = self._get_trace(cache, key[:4] + (None, None),
+                    waveform_channel, None, None)
+                levels = compute_overview(trace.data)
+                try:
+                    write_overview(filename, levels)
+                except (IOError, OSError):
+                    pass
+            cache.put(overview_key, levels, get_overview_size(levels))
+
+        level = select_level(levels, last_sample - first_sample + 1, width)
+        if level is None:
+            trace = self._get_trace(cache, key, waveform_channel, starttime,
+                endtime)
+            return overview_to_json(trace_id, trace.stats.starttime,
+                sampling_rate, 0, trace.data, trace.data)
+
+        first_bin, minima, maxima = get_overview_window(levels, level, npts,
+            first_sample, last_sample)
+        return overview_to_json(trace_id, trace_start + first_bin *
+            2 ** level / float(sampling_rate), sampling_rate, level, minima,
+            maxima)
+
+    def getArchiveForEvent(self, event_id, request):
+        """
+        Streams all waveform files of an event matching the optional tag,
+        synthetic, and stations filters either as a tar archive or, with
+        format=mseed, as concatenated MiniSEED files. Files containing more
+        than one channel are sent as a whole.
+
+        The files are read one after another in the order they are stored
+        on the disk. Files not existing anymore are skipped and counted in
+        the x-missing-files header.
+        """
+        archive_format = request.args0.get("format", "tar").lower()
+        if archive_format not in ("tar", "mseed"):
+            msg = "'format' has to be either 'tar' or 'mseed'."
+            raise InvalidParameterError(msg)
+
+        stations = request.args0.get("stations", None)
+        if stations is not None:
+            stations = [_i.strip().split(".") for _i in stations.split(",")
+                if _i.strip()]
+            if not stations or any(len(_i) != 2 for _i in stations):
+                msg = "'stations' has to be a comma separated list of " \
+                    "NET.STA station ids."
+                raise InvalidParameterError(msg)
 
-    def getListForEvent(self, event_id, request):
-        # Get all waveform channels corresponding to that id.
         session = self.env.db.session(bind=self.env.db.engine)
-        query = session.query(WaveformChannelObject)\
-            .filter(WaveformChannelObject.event_resource_id == event_id)\
-            .all()
-        result = []
-        for q in query:
-            chan = q.channel
-            stat = chan.station
-            result.append({
-                "network": stat.network,
-                "station": stat.station,
-                "location": chan.location,
-                "channel": chan.channel,
-                "filepath_id": q.filepath_id,
-                "tag": q.tag,
-                "starttime": q.starttime.isoformat(),
-                "endtime": q.endtime.isoformat(),
-                "sampling_rate": q.sampling_rate,
-                "format": q.format,
-                "is_synthetic": q.is_synthetic})
-
-        result = formatResults(request, result)
-        return result
+        query = session.query(FilepathObject.id, FilepathObject.filepath,
+                WaveformChannelObject.format, WaveformChannelObject.tag)\
+            .join(WaveformChannelObject,
+                WaveformChannelObject.filepath_id == FilepathObject.id)\
+            .filter(WaveformChannelObject.event_resource_id == event_id)
+        tag = request.args0.get("tag", None)
+        if tag is not None:
+            query = query.filter(WaveformChannelObject.tag == tag)
+        is_synthetic = request.args0.get("synthetic", None)
+        if is_synthetic is not None:
+            query = query.filter(WaveformChannelObject.is_synthetic ==
+                (is_synthetic.lower() in lowercase_true_strings))
+        if stations is not None:
+            query = query\
+                .join(ChannelObject,
+                    WaveformChannelObject.channel_id == ChannelObject.id)\
+                .join(StationObject,
+                    ChannelObject.station_id == StationObject.id)\
+                .filter(sqlalchemy.or_(*[sqlalchemy.and_(
+                    StationObject.network == network,
+                    StationObject.station == station)
+                    for network, station in stations]))
+        try:
+            files = {}
+            for filepath_id, filepath, file_format, file_tag in query:
+                files.setdefault(filepath_id, (filepath, file_format,
+                    file_tag))
+        finally:
+            session.close()
+
+        if archive_format == "mseed":
+            formats = set(_i[1].upper() for _i in files.itervalues())
+            if formats - set(["MSEED"]):
+                msg = "Only MiniSEED files can be concatenated. The " \
+                    "matching files also have the formats: %s" % \
+                    ", ".join(sorted(formats - set(["MSEED"])))
+                raise InvalidParameterError(msg)
+
+        # Read the files in the order of their inodes which approximates
+        # their order on the disk and avoids seeking back and forth.
+        members = []
+        missing = 0
+        for filepath, _, file_tag in files.itervalues():
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                missing += 1
+                continue
+            members.append(((stat.st_dev, stat.st_ino), filepath, file_tag,
+                stat.st_size, int(stat.st_mtime)))
+        members.sort()
+
+        request.setHeader("x-missing-files", str(missing))
+        if archive_format == "mseed":
+            request.setHeader("content-type", "application/octet-stream")
+            request.setHeader("content-disposition",
+                "attachment; filename=%s.mseed" % event_id.encode("utf-8"))
+            request.setHeader("content-length",
+                str(sum(_i[3] for _i in members)))
+            # Files changed since their size was determined are cut or
+            # padded to keep the announced length.
+            return stream_response(request, itertools.chain.from_iterable(
+                iter_sized_file_chunks(_i[1], _i[3]) for _i in members))
+
+        # Files are put in one folder per tag. Equally named files get a
+        # running number.
+        names = set()
+        tar_members = []
+        for _, filepath, file_tag, size, mtime in members:
+            name = os.path.basename(filepath)
+            if file_tag:
+                name = "%s/%s" % (file_tag, name)
+            unique_name = name
+            i = 0
+            while unique_name in names:
+                i += 1
+                unique_name = "%s.%i" % (name, i)
+            names.add(unique_name)
+            tar_members.append((filepath, unique_name.encode("utf-8"), size,
+                mtime))
+
+        request.setHeader("content-type", "application/x-tar")
+        request.setHeader("content-disposition",
+            "attachment; filename=%s.tar" % event_id.encode("utf-8"))
+        request.setHeader("content-length",
+            str(get_tar_archive_size(tar_members)))
+        return stream_response(request, iter_tar_archive(tar_members))
+
+    def getListForEvent(self, event_id, request):
+        """
+        Returns all waveforms of the given event.
+        """
+        return self._getWaveformList(event_id, request)
 
     def getListForStationAndEvent(self, event_id, station_id, request):
+        """
+        Returns all waveforms of the given event and station.
+        """
         split_station = station_id.split(".")
         if len(split_station) != 2:
             msg = "'station_id' has to be of the form NET.STA"
             raise InvalidParameterError(msg)
         network, station = split_station
-        print network, station
 
         session = self.env.db.session(bind=self.env.db.engine)
         stat_id = get_station_id(network, station, session)
+        session.close()
         if stat_id is False:
             msg = "Could not find station '%s'" % station_id
             raise InvalidParameterError(msg)
+        return self._getWaveformList(event_id, request, stat_id)
 
-        query = session.query(WaveformChannelObject)\
-            .join(ChannelObject)\
-            .filter(WaveformChannelObject.event_resource_id == event_id)\
-            .filter(ChannelObject.station_id == stat_id).all()
-
-        result = []
-        for q in query:
-            chan = q.channel
-            stat = chan.station
-            result.append({
-                "network": stat.network,
-                "station": stat.station,
-                "location": chan.location,
-                "channel": chan.channel,
-                "filepath_id": q.filepath_id,
-                "tag": q.tag,
-                "starttime": q.starttime.isoformat(),
-                "endtime": q.endtime.isoformat(),
-                "sampling_rate": q.sampling_rate,
-                "format": q.format,
-                "is_synthetic": q.is_synthetic})
-
-        result = formatResults(request, result)
-        return result
+    def _getWaveformList(self, event_id, request, station_id=None):
+        """
+        Lists the waveforms of an event, optionally only of one station. A
+        single query joining the channels and stations is used and only the
+        listed columns are loaded.
+
+        The optional tag, synthetic, channel (with the wildcards "*" and
+        "?"), and time window parameters filter the waveforms. With limit
+        only that many waveforms are returned. The x-next-after header then
+        contains the value of the after parameter for the next page.
+        """
+        limit = get_limit(request)
+        after = request.args0.get("after", None)
+        if after is not None:
+            try:
+                after = int(after)
+            except ValueError:
+                msg = "'after' has to be the value of the x-next-after " \
+                    "header of the previous page."
+                raise InvalidParameterError(msg)
+        starttime, endtime = _get_time_window(request, event_id, self.env)
+
+        session = self.env.db.session(bind=self.env.db.engine)
+        query = session.query(WaveformChannelObject.id,
+                StationObject.network, StationObject.station,
+                ChannelObject.location, ChannelObject.channel,
+                WaveformChannelObject.filepath_id, WaveformChannelObject.tag,
+                WaveformChannelObject.starttime,
+                WaveformChannelObject.endtime,
+                WaveformChannelObject.sampling_rate,
+                WaveformChannelObject.format,
+                WaveformChannelObject.is_synthetic)\
+            .join(ChannelObject,
+                WaveformChannelObject.channel_id == ChannelObject.id)\
+            .join(StationObject, ChannelObject.station_id == StationObject.id)\
+            .filter(WaveformChannelObject.event_resource_id == event_id)
+        if station_id is not None:
+            query = query.filter(ChannelObject.station_id == station_id)
+        tag = request.args0.get("tag", None)
+        if tag is not None:
+            query = query.filter(WaveformChannelObject.tag == tag)
+        is_synthetic = request.args0.get("synthetic", None)
+        if is_synthetic is not None:
+            query = query.filter(WaveformChannelObject.is_synthetic ==
+                (is_synthetic.lower() in lowercase_true_strings))
+        channel = request.args0.get("channel", None)
+        if channel is not None:
+            query = query.filter(wildcard_filter(ChannelObject.channel,
+                channel))
+        # All waveforms overlapping the time window.
+        if starttime is not None:
+            query = query.filter(
+                WaveformChannelObject.endtime >= starttime.datetime)
+        if endtime is not None:
+            query = query.filter(
+                WaveformChannelObject.starttime <= endtime.datetime)
+        if after is not None:
+            query = query.filter(WaveformChannelObject.id > after)
+        query = query.order_by(WaveformChannelObject.id)
+        # Get one more to know if there is another page.
+        if limit is not None:
+            query = query.limit(limit + 1)
+        try:
+            rows = query.all()
+        finally:
+            session.close()
+
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            set_next_cursor(request, rows[-1].id)
+
+        result = [{
+            "network": row.network,
+            "station": row.station,
+            "location": row.location,
+            "channel": row.channel,
+            "filepath_id": row.filepath_id,
+            "tag": row.tag,
+            "starttime": row.starttime.isoformat(),
+            "endtime": row.endtime.isoformat(),
+            "sampling_rate": row.sampling_rate,
+            "format": row.format,
+            "is_synthetic": row.is_synthetic} for row in rows]
+        return formatResults(request, result)
 
     def process_POST(self, request):
         """
@@ -322,15 +796,37 @@ class WaveformMapper(Component):
             msg += "is not known to SeisHub."
             raise InvalidParameterError(msg)
 
+        # Jobs can be processed in the background.
+        asynchronous = request.args0.get("async", None)
+        if isinstance(asynchronous, basestring):
+            asynchronous = asynchronous.lower() in lowercase_true_strings
+        else:
+            asynchronous = self.env.config.getbool("event_based_data",
+                "asynchronous_ingest")
+
+        # Index a whole directory tree if requested.
+        directory = request.args0.get("index_directory", None)
+        if directory is not None:
+            job_id = start_directory_indexing(self.env, directory,
+                "waveform", pattern=request.args0.get("pattern", None),
+                event_id=event_id, tag=tag, is_synthetic=is_synthetic,
+                asynchronous=asynchronous)
+            return formatResults(request, [get_job_info(self.env, job_id)])
+
         # There are two possibilities for getting data inside the database:
         # upload the file directly to SeisHub or just give a file URL that the
         # server can find.
         filename = request.args0.get("index_file", None)
         # If the 'index_file' parameter is not given, assume the file will be
-        # directly uploaded.
+        # directly uploaded. The upload is streamed to a temporary file next
+        # to its final location while the checksum is calculated so the
+        # memory usage does not depend on the size of the file.
         if filename is None:
             waveform_data = request.content
             waveform_data.seek(0, 0)
+            filename, md5_hash, filesize = spool_to_filesystem(waveform_data,
+                os.path.join(self.env.config.get("event_based_data",
+                "waveform_filepath"), event_id))
             file_is_managed_by_seishub = True
         else:
             filename = os.path.abspath(filename)
@@ -339,109 +835,23 @@ class WaveformMapper(Component):
                 msg = "File '%s' cannot be found by the SeisHub server." % \
                     filename
                 raise InvalidParameterError(msg)
-            with open(filename, "rb") as open_file:
-                waveform_data = StringIO(open_file.read())
-            waveform_data.seek(0, 0)
+            # Hashing is potentially expensive and thus left to the job.
+            if asynchronous:
+                md5_hash, filesize = None, None
+            else:
+                md5_hash, filesize = get_md5_of_file(filename)
             file_is_managed_by_seishub = False
 
-        # Check if file exists. Checksum is returned otherwise. Raises on
-        # failure.
-        data = waveform_data.read()
-        waveform_data.seek(0, 0)
-        md5_hash = check_if_file_exist_in_db(data, self.env)
-
-        msg = ("The data does not appear to be a valid waveform file. Only "
-               "data readable by ObsPy is acceptable.")
-        # Only valid waveforms files will be stored in the database. Valid is
-        # defined by being readable by ObsPy.
-        try:
-            st = read(waveform_data)
-        except:
-            raise InvalidObjectError(msg)
-
-        # Replace network, station and channel codes with placeholders if they
-        # do not exist. Location can be an empty string.
-        network = st[0].stats.network if st[0].stats.network else "XX"
-        station = st[0].stats.station if st[0].stats.station else "XX"
-        location = st[0].stats.location
-        channel = st[0].stats.channel if st[0].stats.channel else "XX"
-
-        # Check if the tag is valid, e.g. that it fulfulls the constraints of
-        # being unique per channel_id and event.
-        tags = get_all_tags(network, station, location, channel, event_id,
-            self.env)
-        if tag in tags:
-            msg = "Tag already exists for the given channel id and event."
-            raise InvalidParameterError(msg)
-
-        if file_is_managed_by_seishub is True:
-            # Otherwise create the filename for the file, and check if it
-            # exists.
-            filename = os.path.join(self.env.config.get("event_based_data",
-                "waveform_filepath"), event_id,
-                ("{network}.{station}.{location}.{channel}-"
-                "{year}_{month}_{day}_{hour}"))
-            t = st[0].stats.starttime
-            filename = filename.format(network=network, station=station,
-                channel=channel, location=location, year=t.year, month=t.month,
-                day=t.day, hour=t.hour)
-
-            # Write the data to the filesystem. The final filename is returned.
-            filename = write_string_to_filesystem(filename, data)
-
-        # Use only one session to be able to take advantage of transactions.
-        session = self.env.db.session(bind=self.env.db.engine)
-
-        # Wrap in try/except and rollback changes in case something fails.
-        try:
-            # Add information about the uploaded file into the database.
-            filepath = add_filepath_to_database(session, filename, len(data),
-                    md5_hash, is_managed_by_seishub=file_is_managed_by_seishub)
-
-            # Loop over all traces in the file.
-            for trace in st:
-                stats = trace.stats
-
-                # Extract coordinates if it is a sac file. Else set them to
-                # None.
-                if hasattr(stats, "sac"):
-                    # Invalid floating point value according to the sac
-                    # definition.
-                    iv = -12345.0
-                    sac = stats.sac
-                    latitude = sac.stla if sac.stla != iv else None
-                    longitude = sac.stlo if sac.stlo != iv else None
-                    elevation = sac.stel if sac.stel != iv else None
-                    local_depth = sac.stdp if sac.stdp != iv else None
-                else:
-                    latitude, longitude, elevation, local_depth = [None] * 4
-
-                # Add the channel if it does not already exists, or update the
-                # location or just return the existing station. In any case a
-                # channel column object will be returned.
-                channel_row = add_or_update_channel(session,
-                    stats.network, stats.station, stats.location,
-                    stats.channel, latitude, longitude, elevation, local_depth)
-
-                # Add the current waveform channel as well.
-                waveform_channel = WaveformChannelObject(
-                    channel=channel_row, filepath=filepath,
-                    event_resource_id=event_id,
-                    starttime=stats.starttime.datetime,
-                    endtime=stats.endtime.datetime, tag=tag,
-                    sampling_rate=stats.sampling_rate, format=stats._format,
-                    is_synthetic=is_synthetic)
-                session.add(waveform_channel)
-
-                session.commit()
-        except Exception, e:
-            # Rollback session.
-            session.rollback()
-            session.close()
-
-            # Remove the file if something failes..
-            if file_is_managed_by_seishub:
-                os.remove(filename)
-            msg = e.message + " - Rolling back all changes."
-            raise InternalServerError(msg)
-        session.close()
+        # Return the job right away. The upload has already been spooled to
+        # the disk.
+        if asynchronous:
+            job_id = submit_job(self.env, "waveform_file", {
+                "filename": filename, "md5_hash": md5_hash,
+                "filesize": filesize,
+                "is_managed_by_seishub": file_is_managed_by_seishub,
+                "event_id": event_id, "tag": tag,
+                "is_synthetic": is_synthetic})
+            return formatResults(request, [get_job_info(self.env, job_id)])
+
+        ingest_waveform_file(self.env, filename, md5_hash, filesize,
+            file_is_managed_by_seishub, event_id, tag, is_synthetic)
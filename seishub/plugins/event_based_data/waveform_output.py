@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Encoders for the waveform downloads. All of them produce the output in
+chunks so big traces can be streamed to the client without building the
+whole response in memory.
+
+:copyright:
+    Lion Krischer (krischer@geophysik.uni-muenchen.de), 2013
+:license:
+    GNU Lesser General Public License, Version 3
+    (http://www.gnu.org/copyleft/lesser.html)
+"""
+import io
+import json
+import numpy as np
+from obspy.core.util import NamedTemporaryFile
+import os
+import struct
+import tarfile
+
+
+# Number of samples encoded at once.
+CHUNK_SAMPLES = 65536
+
+# Size of the chunks of binary output in bytes.
+CHUNK_BYTES = 1024 * 1024
+
+# The available layouts of the JSON output.
+JSON_LAYOUTS = ("compact", "pairs")
+
+# Size of the blocks and records of tar archives.
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+TAR_RECORD_SIZE = tarfile.RECORDSIZE
+
+# Waveform formats whose ObsPy writers turned out to only be able to write
+# to actual files.
+_tempfile_formats = set()
+
+
+def _json_header(trace, **kwargs):
+    """
+    Returns the beginning of the JSON representation of a trace up to the
+    opening bracket of the data array.
+    """
+    header = {
+        "channel": trace.id,
+        "sampling_rate": trace.stats.sampling_rate,
+        "npts": trace.stats.npts}
+    header.update(kwargs)
+    # Cut the closing brace to be able to append the data.
+    return json.dumps(header)[:-1] + ', "data": ['
+
+
+def iter_compact_json(trace, chunk_samples=CHUNK_SAMPLES):
+    """
+    Yields the compact JSON representation of a trace in chunks. The time of
+    every sample is given implicitly by the start time and the sample
+    spacing:
+
+    {"channel": "BW.FURT..EHZ", "sampling_rate": 2.0, "npts": 3,
+     "starttime": "2009-04-06T01:32:00", "delta": 0.5, "data": [1, 2, 3]}
+    """
+    yield _json_header(trace, starttime=trace.stats.starttime.isoformat(),
+        delta=trace.stats.delta)
+    data = trace.data
+    for i in xrange(0, len(data), chunk_samples):
+        # The conversion to a list and the serialization both run in C.
+        chunk = json.dumps(data[i:i + chunk_samples].tolist())[1:-1]
+        yield chunk if i == 0 else ", " + chunk
+    yield "]}"
+
+
+def iter_pairs_json(trace, chunk_samples=CHUNK_SAMPLES):
+    """
+    Yields the JSON representation of a trace with an explicit time for
+    every sample in chunks:
+
+    {"channel": "BW.FURT..EHZ", "sampling_rate": 2.0, "npts": 2,
+     "data": [["2009-04-06T01:32:00", 1.0],
+              ["2009-04-06T01:32:00.500000", 2.0]]}
+
+    Considerably bigger and slower than the compact representation.
+    """
+    yield _json_header(trace)
+    starttime = trace.stats.starttime
+    delta = trace.stats.delta
+    data = trace.data
+    for i in xrange(0, len(data), chunk_samples):
+        values = data[i:i + chunk_samples].astype(np.float64).tolist()
+        offsets = (np.arange(i, i + len(values)) * delta).tolist()
+        chunk = json.dumps([[(starttime + offset).isoformat(), value]
+            for offset, value in zip(offsets, values)])[1:-1]
+        yield chunk if i == 0 else ", " + chunk
+    yield "]}"
+
+
+# The binary array formats and their data types. The npy format keeps the
+# data type of the trace.
+BINARY_FORMATS = {
+    "npy": None,
+    "float32": "<f4",
+    "float64": "<f8"}
+
+
+def get_binary_array(trace, format):
+    """
+    Returns the data of the trace as a C-contiguous array with the data type
+    of the given binary format. The data is only copied if necessary.
+    """
+    return np.require(trace.data, dtype=BINARY_FORMATS[format],
+        requirements="C")
+
+
+def get_binary_headers(trace, array):
+    """
+    Returns the HTTP headers describing the binary representation of a
+    trace. They carry the stats the data array itself does not contain.
+    """
+    return {
+        "x-channel-id": trace.id,
+        "x-starttime": trace.stats.starttime.isoformat(),
+        "x-sampling-rate": repr(float(trace.stats.sampling_rate)),
+        "x-delta": repr(float(trace.stats.delta)),
+        "x-npts": str(trace.stats.npts),
+        "x-dtype": array.dtype.str}
+
+
+def _npy_header(array):
+    """
+    Returns the header of a version 1.0 npy file for a one-dimensional
+    array.
+    """
+    header = "{'descr': %r, 'fortran_order': False, 'shape': (%i,), }" % (
+        array.dtype.str, len(array))
+    # The data has to start at a multiple of 16 bytes. 10 bytes are taken
+    # by the magic string, the version and the header length.
+    header += " " * ((16 - (10 + len(header) + 1) % 16) % 16) + "\n"
+    return "\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header
+
+
+def iter_binary(array, format, chunk_bytes=CHUNK_BYTES):
+    """
+    Yields the binary representation of the given array in chunks. The data
+    chunks are buffers referencing the memory of the array so at most one
+    chunk of it is copied at a time.
+    """
+    if format == "npy":
+        yield _npy_header(array)
+    for offset in xrange(0, array.nbytes, chunk_bytes):
+        yield buffer(array, offset, chunk_bytes)
+
+
+def _write_to_memory(trace, format):
+    """
+    Writes the trace to a byte buffer. Returns None if the writer of the
+    format cannot write to file-like objects. All other errors are raised.
+    """
+    buf = io.BytesIO()
+    try:
+        trace.write(buf, format=format)
+    except (TypeError, AttributeError, io.UnsupportedOperation):
+        # Writers expecting a filename fail with one of these.
+        return None
+    data = buf.getvalue()
+    return data if data else None
+
+
+def _write_to_tempfile(trace, format):
+    """
+    Writes the trace to a temporary file and returns its contents.
+    """
+    tempfile = NamedTemporaryFile()
+    try:
+        trace.write(tempfile.name, format=format)
+        with open(tempfile.name, "rb") as open_file:
+            data = open_file.read()
+    finally:
+        tempfile.close()
+        if os.path.exists(tempfile.name):
+            os.remove(tempfile.name)
+    return data
+
+
+def write_trace_to_string(trace, format):
+    """
+    Converts a trace to the given waveform format and returns the result as
+    a string. The conversion happens in memory. Only formats whose writers
+    cannot write to file-like objects are written to temporary files. These
+    formats are remembered so the in-memory conversion is not attempted
+    again.
+
+    Some writers modify the trace they write. It has to be a copy if the
+    original must stay untouched.
+    """
+    format = format.upper()
+    if format not in _tempfile_formats:
+        # The failed writer might already have modified the trace. The
+        # temporary file is thus written from the untouched original.
+        data = _write_to_memory(trace.copy(), format)
+        if data is not None:
+            return data
+    data = _write_to_tempfile(trace, format)
+    # Only remember the format once writing to a file worked. Otherwise the
+    # data itself could not be written.
+    _tempfile_formats.add(format)
+    return data
+
+
+def _tar_header(name, size, mtime):
+    """
+    Returns the header blocks of a regular file in a tar archive.
+    """
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = mtime
+    info.mode = 0644
+    return info.tobuf(tarfile.GNU_FORMAT, "utf-8", "strict")
+
+
+def _tar_padding(size, block_size):
+    """
+    Returns the number of bytes needed to fill up the last block.
+    """
+    return (block_size - size % block_size) % block_size
+
+
+def get_tar_archive_size(members):
+    """
+    Returns the size of the tar archive of the given members in bytes. The
+    members are (filename, name, size, mtime) tuples as accepted by
+    iter_tar_archive().
+    """
+    size = 0
+    for _, name, member_size, mtime in members:
+        size += len(_tar_header(name, member_size, mtime)) + member_size + \
+            _tar_padding(member_size, TAR_BLOCK_SIZE)
+    size += 2 * TAR_BLOCK_SIZE
+    return size + _tar_padding(size, TAR_RECORD_SIZE)
+
+
+def iter_sized_file_chunks(filename, size, chunk_bytes=CHUNK_BYTES):
+    """
+    Yields exactly size bytes of the given file in chunks. Files that have
+    been truncated or removed since their size has been determined, or that
+    cannot be read any more, are padded with zeros so responses whose length
+    has already been announced stay consistent.
+    """
+    remaining = size
+    try:
+        with open(filename, "rb") as open_file:
+            while remaining > 0:
+                chunk = open_file.read(min(chunk_bytes, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    except (IOError, OSError):
+        pass
+    while remaining > 0:
+        yield "\0" * min(chunk_bytes, remaining)
+        remaining -= chunk_bytes
+
+
+def iter_tar_archive(members, chunk_bytes=CHUNK_BYTES):
+    """
+    Yields a tar archive of the given members in chunks. Every member is a
+    (filename, name, size, mtime) tuple with name being the name of the file
+    in the archive. The files are read one after another in the given order
+    and only one chunk is held in memory at any time.
+
+    Exactly size bytes are written per file so the archive stays valid even
+    if a file changes or is removed while it is being sent.
+    """
+    total = 0
+    for filename, name, size, mtime in members:
+        header = _tar_header(name, size, mtime)
+        yield header
+        for chunk in iter_sized_file_chunks(filename, size, chunk_bytes):
+            yield chunk
+        # Pad the last block of every file.
+        padding = _tar_padding(size, TAR_BLOCK_SIZE)
+        if padding:
+            yield "\0" * padding
+        total += len(header) + size + _tar_padding(size, TAR_BLOCK_SIZE)
+    # Two empty blocks mark the end of the archive which is padded to a
+    # whole record.
+    total += 2 * TAR_BLOCK_SIZE
+    yield "\0" * (2 * TAR_BLOCK_SIZE + _tar_padding(total, TAR_RECORD_SIZE))